@@ -0,0 +1,340 @@
+import argparse
+import hashlib
+import os
+from collections import defaultdict
+
+from db_connection import STORAGE_TABLES, connect, hash_storage
+
+# Addresses are network specific; use the same names as import-blocks --network.
+ADDRESS_NETWORK = os.getenv("ADDRESS_NETWORK", "main")
+
+# (bech32 human-readable part, P2PKH version byte, P2SH version byte)
+NETWORK_PREFIXES = {
+    "main": ("bc", 0x00, 0x05),
+    "test": ("tb", 0x6F, 0xC4),
+    "testnet4": ("tb", 0x6F, 0xC4),
+    "signet": ("tb", 0x6F, 0xC4),
+    "regtest": ("bcrt", 0x6F, 0xC4),
+}
+
+# An address gets a balance checkpoint once this many activity rows were
+# added since its previous one, so balance_at() sums at most about this many
+# rows (plus those of one commit) on top of a checkpoint.
+ADDRESS_CHECKPOINT_INTERVAL = int(os.getenv("ADDRESS_CHECKPOINT_INTERVAL", "100"))
+
+# One row per (address, transaction) with the net change of the address's
+# balance in that transaction: positive for outputs paying it, negative for
+# inputs spending its outputs.
+ADDRESS_ACTIVITY_SQL = """
+    CREATE TABLE IF NOT EXISTS {address_activity} (
+        address TEXT NOT NULL,
+        height INTEGER NOT NULL,
+        txid {hash_type} NOT NULL,
+        delta_sat INTEGER NOT NULL
+    )
+"""
+
+ADDRESS_ACTIVITY_VIEW_SQL = """
+    CREATE VIEW IF NOT EXISTS address_activity AS
+    SELECT address, height, lower(hex(txid)) AS txid, delta_sat
+    FROM address_activity_bin
+"""
+
+# Current balance of every address, and its activity count at its latest
+# checkpoint.
+ADDRESS_BALANCE_SQL = """
+    CREATE TABLE IF NOT EXISTS address_balance (
+        address TEXT PRIMARY KEY,
+        balance_sat INTEGER NOT NULL,
+        activity_count INTEGER NOT NULL,
+        checkpoint_count INTEGER NOT NULL
+    ) WITHOUT ROWID
+"""
+
+# The balance of an address after every block up to and including `height`.
+ADDRESS_CHECKPOINT_SQL = """
+    CREATE TABLE IF NOT EXISTS address_checkpoint (
+        address TEXT NOT NULL,
+        height INTEGER NOT NULL,
+        balance_sat INTEGER NOT NULL,
+        activity_count INTEGER NOT NULL,
+        PRIMARY KEY (address, height)
+    ) WITHOUT ROWID
+"""
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32_CONSTANT = 1
+BECH32M_CONSTANT = 0x2BC830A3
+
+
+def base58check(version, payload):
+    """
+    Base58Check encoding of a version byte followed by `payload`.
+    """
+    data = bytes([version]) + payload
+    data += hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, digit = divmod(number, 58)
+        encoded = BASE58_ALPHABET[digit] + encoded
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + encoded
+
+
+def bech32_polymod(values):
+    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1FFFFFF) << 5 ^ value
+        for i in range(5):
+            if (top >> i) & 1:
+                checksum ^= generator[i]
+    return checksum
+
+
+def convert_bits(data, from_bits, to_bits):
+    """
+    Regroups bytes into 5-bit words (with padding), as bech32 requires.
+    """
+    accumulator, bits, words = 0, 0, []
+    for value in data:
+        accumulator = (accumulator << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            words.append((accumulator >> bits) & ((1 << to_bits) - 1))
+    if bits:
+        words.append((accumulator << (to_bits - bits)) & ((1 << to_bits) - 1))
+    return words
+
+
+def segwit_address(hrp, witness_version, program):
+    """
+    BIP 173 (bech32, version 0) or BIP 350 (bech32m, version 1+) address.
+    """
+    data = [witness_version] + convert_bits(program, 8, 5)
+    constant = BECH32_CONSTANT if witness_version == 0 else BECH32M_CONSTANT
+    expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    polymod = bech32_polymod(expanded + data + [0] * 6) ^ constant
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def script_to_address(script_pubkey, network=ADDRESS_NETWORK):
+    """
+    The address of a standard P2PKH, P2SH, P2WPKH, P2WSH or P2TR output
+    script (hex), or None for any other script.
+    """
+    hrp, p2pkh_version, p2sh_version = NETWORK_PREFIXES[network]
+    length = len(script_pubkey)
+    if length == 50 and script_pubkey.startswith("76a914") and script_pubkey.endswith("88ac"):
+        return base58check(p2pkh_version, bytes.fromhex(script_pubkey[6:46]))
+    if length == 46 and script_pubkey.startswith("a914") and script_pubkey.endswith("87"):
+        return base58check(p2sh_version, bytes.fromhex(script_pubkey[4:44]))
+    if length == 44 and script_pubkey.startswith("0014"):
+        return segwit_address(hrp, 0, bytes.fromhex(script_pubkey[4:]))
+    if length == 68 and script_pubkey.startswith("0020"):
+        return segwit_address(hrp, 0, bytes.fromhex(script_pubkey[4:]))
+    if length == 68 and script_pubkey.startswith("5120"):
+        return segwit_address(hrp, 1, bytes.fromhex(script_pubkey[4:]))
+    return None
+
+
+class AddressIndex:
+    """
+    BlockWriter extension that records, for every address an output pays or
+    an input spends from, its net balance change per transaction. Spent
+    outputs come from the UtxoSet (which must be flushed first), so an
+    address's debits are only complete when the chain is ingested from
+    genesis. Balances are checkpointed every ADDRESS_CHECKPOINT_INTERVAL
+    activity rows; rollback just deletes everything above the fork.
+    """
+
+    def __init__(self, conn, utxos, network=ADDRESS_NETWORK,
+                 checkpoint_interval=ADDRESS_CHECKPOINT_INTERVAL):
+        self.network = network
+        self.checkpoint_interval = checkpoint_interval
+        self.blob_hashes = hash_storage(conn) == "blob"
+        self.table = STORAGE_TABLES[hash_storage(conn)]["address_activity"]
+        hash_type = "BLOB" if self.blob_hashes else "VARCHAR(255)"
+        conn.execute(ADDRESS_ACTIVITY_SQL.format(address_activity=self.table, hash_type=hash_type))
+        if self.blob_hashes:
+            conn.execute(ADDRESS_ACTIVITY_VIEW_SQL)
+        conn.execute(ADDRESS_BALANCE_SQL)
+        conn.execute(ADDRESS_CHECKPOINT_SQL)
+        conn.commit()
+        self.addresses = {}
+        self.rows = 0
+        self.discard()
+        utxos.spend_listeners.append(self.spend)
+
+    def discard(self):
+        # (height, address, txid) -> net satoshis
+        self.pending = defaultdict(int)
+        # address -> (balance_sat, activity_count, checkpoint_count) of the
+        # addresses whose balance changed since the last flush.
+        self.touched = {}
+
+    def address(self, script_pubkey):
+        """
+        script_to_address with a small memo: change and pool payout
+        addresses repeat within a commit group.
+        """
+        if script_pubkey not in self.addresses:
+            if len(self.addresses) >= 100_000:
+                self.addresses.clear()
+            self.addresses[script_pubkey] = script_to_address(script_pubkey, self.network)
+        return self.addresses[script_pubkey]
+
+    def add_rows(self, height, input_rows, output_rows):
+        for txid, _, value_sat, script_pubkey in output_rows:
+            address = self.address(script_pubkey)
+            if address:
+                self.pending[(height, address, txid)] += value_sat
+
+    def spend(self, height, txid, value_sat, script_pubkey):
+        address = self.address(script_pubkey)
+        if address:
+            self.pending[(height, address, txid)] -= value_sat
+
+    def write_activity(self, cursor):
+        """
+        Writes the pending activity rows and applies them to address_balance.
+        """
+        cursor.executemany(
+            f"INSERT INTO {self.table} (address, height, txid, delta_sat) VALUES (?, ?, ?, ?)",
+            ((address, h, bytes.fromhex(txid) if self.blob_hashes else txid, delta)
+             for (h, address, txid), delta in self.pending.items())
+        )
+        changes = defaultdict(lambda: [0, 0])
+        for (_, address, _), delta in self.pending.items():
+            changes[address][0] += delta
+            changes[address][1] += 1
+        for address, (delta, count) in changes.items():
+            self.touched[address] = cursor.execute("""
+                INSERT INTO address_balance (address, balance_sat, activity_count, checkpoint_count)
+                VALUES (?, ?, ?, 0)
+                ON CONFLICT(address) DO UPDATE SET
+                    balance_sat = balance_sat + excluded.balance_sat,
+                    activity_count = activity_count + excluded.activity_count
+                RETURNING balance_sat, activity_count, checkpoint_count
+            """, (address, delta, count)).fetchone()
+        self.rows += len(self.pending)
+        self.pending = defaultdict(int)
+
+    def flush(self, cursor, height):
+        """
+        Writes the pending activity, updates the balances and adds the
+        checkpoints that came due, inside the writer's transaction. `height`
+        must be the end of a block: a checkpoint covers all of its activity.
+        """
+        self.write_activity(cursor)
+        checkpoints = [
+            (address, height, balance_sat, activity_count)
+            for address, (balance_sat, activity_count, checkpoint_count) in self.touched.items()
+            if activity_count - checkpoint_count >= self.checkpoint_interval
+        ]
+        cursor.executemany(
+            "INSERT OR REPLACE INTO address_checkpoint (address, height, balance_sat, activity_count) "
+            "VALUES (?, ?, ?, ?)", checkpoints
+        )
+        cursor.executemany(
+            "UPDATE address_balance SET checkpoint_count = ? WHERE address = ?",
+            ((count, address) for address, _, _, count in checkpoints)
+        )
+        self.discard()
+
+    def spill(self, cursor, height):
+        """
+        Writes the activity of a partly received streamed block. Must follow
+        the UtxoSet's spill, which reports the spends. Checkpoints wait for
+        the block-end flush, since balance_at treats a checkpoint at a height
+        as covering the whole block.
+        """
+        self.write_activity(cursor)
+
+    def rollback(self, cursor, fork_height):
+        """
+        Deletes the activity and checkpoints above `fork_height` and
+        recomputes the balances of the addresses involved from their latest
+        remaining checkpoint.
+        """
+        self.discard()
+        affected = [row[0] for row in cursor.execute(
+            f"SELECT DISTINCT address FROM {self.table} WHERE height > ?", (fork_height,))]
+        cursor.execute(f"DELETE FROM {self.table} WHERE height > ?", (fork_height,))
+        for address in affected:
+            cursor.execute("DELETE FROM address_checkpoint WHERE address = ? AND height > ?",
+                           (address, fork_height))
+            checkpoint = cursor.execute("""
+                SELECT height, balance_sat, activity_count FROM address_checkpoint
+                WHERE address = ? ORDER BY height DESC LIMIT 1
+            """, (address,)).fetchone() or (-1, 0, 0)
+            count, delta = cursor.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(delta_sat), 0) FROM {self.table} WHERE address = ? AND height > ?",
+                (address, checkpoint[0])
+            ).fetchone()
+            if checkpoint[2] + count == 0:
+                cursor.execute("DELETE FROM address_balance WHERE address = ?", (address,))
+            else:
+                cursor.execute(
+                    "UPDATE address_balance SET balance_sat = ?, activity_count = ?, checkpoint_count = ? "
+                    "WHERE address = ?",
+                    (checkpoint[1] + delta, checkpoint[2] + count, checkpoint[2], address)
+                )
+
+    def report(self):
+        return f"Address index: {self.rows} activity rows written"
+
+
+def balance_at(conn, address, height=None):
+    """
+    Balance of `address` in satoshis after the block at `height` (default:
+    the current balance): the latest checkpoint at or below `height` plus the
+    activity after it, a bounded read of idx_address_activity_address.
+    """
+    if height is None:
+        row = conn.execute("SELECT balance_sat FROM address_balance WHERE address = ?", (address,)).fetchone()
+        return row[0] if row else 0
+    checkpoint = conn.execute("""
+        SELECT height, balance_sat FROM address_checkpoint
+        WHERE address = ? AND height <= ? ORDER BY height DESC LIMIT 1
+    """, (address, height)).fetchone() or (-1, 0)
+    delta = conn.execute(
+        "SELECT COALESCE(SUM(delta_sat), 0) FROM address_activity WHERE address = ? AND height > ? AND height <= ?",
+        (address, checkpoint[0], height)
+    ).fetchone()[0]
+    return checkpoint[1] + delta
+
+
+def address_history(conn, address, limit=20):
+    """
+    The latest activity of `address` as (height, txid, delta_sat), newest first.
+    """
+    return conn.execute(
+        "SELECT height, txid, delta_sat FROM address_activity WHERE address = ? ORDER BY height DESC LIMIT ?",
+        (address, limit)
+    ).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up the balance and activity of an address")
+    parser.add_argument("address")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--height", type=int, help="balance after this block (default: current)")
+    parser.add_argument("--limit", type=int, default=20, help="activity rows to show")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.db, "serve")
+    try:
+        print(f"Balance: {balance_at(conn, args.address, args.height) / 1e8:.8f} BTC")
+        for height, txid, delta_sat in address_history(conn, args.address, args.limit):
+            print(f"{height:>8} {txid} {delta_sat / 1e8:+.8f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import asyncio
+import base64
+import json
+import os
+from collections import deque
+from decimal import Decimal
+from time import perf_counter
+from dotenv import load_dotenv
+
+import metrics
+import profiling
+
+# Load environment variables from .env file
+load_dotenv()
+
+# bitcoind works on at most rpcworkqueue requests at once and answers anything
+# beyond that with HTTP 503, so never keep more than this many in flight.
+RPC_WORK_QUEUE = int(os.getenv("RPC_WORK_QUEUE", "32"))
+
+
+class AsyncBitcoinRPC:
+    """
+    asyncio counterpart of update_db.BitcoinRPC.
+    Requests are sent over a small pool of keep-alive HTTP/1.1 connections and
+    a semaphore caps the number of requests in flight at `concurrency`, which
+    is itself capped by the node's rpcworkqueue.
+    """
+
+    def __init__(self, concurrency=None, read_timeout=None):
+        self.rpc_user = os.getenv("RPC_USERNAME")
+        self.rpc_password = os.getenv("RPC_PASSWORD")
+        self.rpc_host = os.getenv("RPC_HOST", "127.0.0.1")
+        self.rpc_port = int(os.getenv("RPC_PORT", "8332"))
+        self.read_timeout = read_timeout or float(os.getenv("RPC_READ_TIMEOUT", "120"))
+        self.concurrency = min(concurrency or RPC_WORK_QUEUE, RPC_WORK_QUEUE)
+        credentials = f"{self.rpc_user or ''}:{self.rpc_password or ''}".encode()
+        self._auth_header = "Basic " + base64.b64encode(credentials).decode()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._idle = []
+        self._next_id = 0
+
+    async def _open_connection(self):
+        if self._idle:
+            return self._idle.pop(), True
+        reader, writer = await asyncio.open_connection(self.rpc_host, self.rpc_port)
+        return (reader, writer), False
+
+    async def _post(self, body):
+        """
+        POSTs `body` and returns (status, response body). A reused keep-alive
+        connection that the node already closed is retried once on a fresh one.
+        """
+        request = (
+            f"POST / HTTP/1.1\r\n"
+            f"Host: {self.rpc_host}:{self.rpc_port}\r\n"
+            f"Authorization: {self._auth_header}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"\r\n"
+        ).encode() + body
+        for attempt in range(2):
+            (reader, writer), reused = await self._open_connection()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, reply, keep_alive = await asyncio.wait_for(
+                    read_http_response(reader), self.read_timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return status, reply
+
+    async def call(self, method, params=()):
+        """
+        Sends one JSON-RPC call and returns its result, or None on failure.
+        """
+        self._next_id += 1
+        payload = {
+            "jsonrpc": "1.0",
+            "id": self._next_id,
+            "method": method,
+            "params": list(params)
+        }
+        async with self._semaphore:
+            started = perf_counter()
+            try:
+                status, reply = await self._post(json.dumps(payload).encode())
+                # bitcoind reports RPC errors with HTTP 500 and a JSON body.
+                if status != 200 and not reply.startswith(b"{"):
+                    raise RuntimeError(f"HTTP {status}")
+                # Decimal keeps vout amounts exact for the satoshi conversion.
+                data = json.loads(reply, parse_float=Decimal)
+                if data.get("error"):
+                    raise RuntimeError(data["error"])
+                return data["result"]
+            except Exception as e:
+                metrics.RPC_ERRORS.inc(1, method)
+                print(f"Async RPC call error for method {method}: {e}")
+                return None
+            finally:
+                elapsed = perf_counter() - started
+                metrics.RPC_SECONDS.observe(elapsed, method)
+                profiling.record_async_span(f"rpc {method}", started, elapsed)
+
+    async def get_block(self, height, verbosity=2):
+        """
+        Returns the block at `height` decoded at the given getblock verbosity.
+        """
+        block_hash = await self.call("getblockhash", [height])
+        if block_hash is None:
+            return None
+        return await self.call("getblock", [block_hash, verbosity])
+
+    async def iter_blocks(self, start_height, end_height, verbosity=2):
+        """
+        Yields (height, block) for every height in [start_height, end_height]
+        in height order. Up to `concurrency` blocks are fetched ahead of the
+        consumer; blocks that arrive early wait in the window until every
+        lower height has been yielded.
+        """
+        heights = iter(range(start_height, end_height + 1))
+        window = deque()
+
+        def schedule():
+            height = next(heights, None)
+            if height is not None:
+                window.append((height, asyncio.ensure_future(self.get_block(height, verbosity))))
+
+        for _ in range(self.concurrency):
+            schedule()
+        try:
+            while window:
+                height, future = window.popleft()
+                block = await future
+                schedule()
+                yield height, block
+        finally:
+            for _, future in window:
+                future.cancel()
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+async def read_http_response(reader):
+    """
+    Reads one HTTP/1.1 response and returns (status, body, keep_alive).
+    Handles both Content-Length and chunked bodies.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by node")
+    status = int(status_line.split(None, 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = headers.get("connection", "").lower() != "close"
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                # Skip optional trailers up to the terminating blank line.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+        return status, bytes(body), keep_alive
+    if "content-length" in headers:
+        return status, await reader.readexactly(int(headers["content-length"])), keep_alive
+    return status, await reader.read(), False
+
+
+def fetch_blocks_ordered(start_height, end_height, handle_block, concurrency=None, verbosity=2):
+    """
+    Synchronous entry point for update_db.py: fetches the height range with
+    the async client and calls handle_block(height, block) in height order.
+    Stops at the first block that could not be fetched and returns the last
+    height that was handed to handle_block (start_height - 1 if none).
+    """
+    async def run():
+        rpc = AsyncBitcoinRPC(concurrency=concurrency)
+        last_height = start_height - 1
+        try:
+            async for height, block in rpc.iter_blocks(start_height, end_height, verbosity):
+                if block is None:
+                    print(f"Failed to fetch block at height {height}; stopping.")
+                    break
+                handle_block(height, block)
+                last_height = height
+        finally:
+            await rpc.close()
+        return last_height
+
+    return asyncio.run(run())
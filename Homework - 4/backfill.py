@@ -0,0 +1,48 @@
+from time import time
+
+from block_writer import BlockWriter, default_extensions
+from db_connection import connect
+from indexes import deferred_indexes
+from pipeline import BlockPipeline
+from update_db import BitcoinRPC, record_node_tip
+
+
+def backfill(db_path, start_height, end_height, workers=8, checkpoint_every=500, profile="bulk-ingest",
+             raw=False, defer_indexes=True, decoders=None):
+    """
+    Loads every block in [start_height, end_height] into the database
+    through a pipeline.BlockPipeline: `workers` fetcher threads download the
+    blocks, `decoders` processes (default: one per core) decode them from
+    shared memory, and this thread hands them to a BlockWriter in strict
+    height order, which commits a checkpoint every `checkpoint_every` blocks.
+    With `defer_indexes` the secondary indexes are dropped during the load
+    and rebuilt once at the end. Returns the last committed height, so an
+    interrupted run can be resumed with --from <returned height + 1>.
+    """
+    rpc = BitcoinRPC(pool_size=workers)
+    conn = connect(db_path, profile)
+    writer = BlockWriter(conn, blocks_per_commit=checkpoint_every, extensions=default_extensions(conn, rpc))
+    pipeline = BlockPipeline(rpc, writer, fetchers=workers, decoders=decoders, raw=raw)
+
+    print(f"Backfilling heights {start_height}..{end_height} with {workers} fetchers "
+          f"and {pipeline.decoders} decoders...")
+    started = time()
+    tip_height = rpc.call("getblockcount")
+    if tip_height is not None:
+        record_node_tip(rpc, tip_height)
+    try:
+        with deferred_indexes(conn, defer_indexes):
+            pipeline.run(start_height, end_height)
+            writer.flush()
+    finally:
+        conn.close()
+        rpc.close()
+
+    elapsed = time() - started
+    last_committed = writer.last_committed_height
+    if last_committed is None:
+        last_committed = start_height - 1
+    count = last_committed - start_height + 1
+    print(f"Backfill finished: {count} blocks committed through height {last_committed} in {elapsed:.1f}s.")
+    print(pipeline.report())
+    return last_committed
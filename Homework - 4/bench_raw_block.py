@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+from time import perf_counter
+
+from block_writer import decode_block_json
+from raw_block import decode_raw_block
+
+
+def fetch_samples(start_height, end_height):
+    """
+    Fetches every block in the range both ways from the node and returns a
+    list of (height, getblock JSON body, serialized block, header).
+    """
+    from update_db import BitcoinRPC
+
+    rpc = BitcoinRPC()
+    samples = []
+    for height, block_hash in zip(range(start_height, end_height + 1),
+                                  rpc.get_block_hashes(start_height, end_height)):
+        header = rpc.call("getblockheader", [block_hash, True])
+        body = rpc.call_raw("getblock", [block_hash, 2])
+        raw = rpc.get_raw_block(block_hash)
+        if None in (header, body, raw):
+            print(f"Skipping height {height}: fetch failed.")
+            continue
+        samples.append((height, body, raw, header))
+    rpc.close()
+    return samples
+
+
+def save_samples(samples, directory):
+    os.makedirs(directory, exist_ok=True)
+    for height, body, raw, header in samples:
+        with open(os.path.join(directory, f"{height}.json"), "wb") as f:
+            f.write(body)
+        with open(os.path.join(directory, f"{height}.bin"), "wb") as f:
+            f.write(raw)
+        with open(os.path.join(directory, f"{height}.header.json"), "w") as f:
+            json.dump(header, f)
+
+
+def load_samples(directory):
+    samples = []
+    heights = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".bin"))
+    for height in heights:
+        with open(os.path.join(directory, f"{height}.json"), "rb") as f:
+            body = f.read()
+        with open(os.path.join(directory, f"{height}.bin"), "rb") as f:
+            raw = f.read()
+        with open(os.path.join(directory, f"{height}.header.json")) as f:
+            header = json.load(f)
+        samples.append((height, body, raw, header))
+    return samples
+
+
+def best_time(func, repeat):
+    """
+    Returns (fastest wall time over `repeat` runs, result of the last run).
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        started = perf_counter()
+        result = func()
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmark(samples, repeat=3):
+    """
+    Decodes every sample with the JSON path and the raw path, checks that
+    both produce the same rows and prints per-block and total timings.
+    """
+    total_json = total_raw = 0.0
+    mismatches = 0
+    print(f"{'height':>8} {'txs':>6} {'json MB':>8} {'raw MB':>8} {'json ms':>9} {'raw ms':>9} {'speedup':>8}")
+    for height, body, raw, header in samples:
+        json_time, json_rows = best_time(lambda: decode_block_json(body), repeat)
+        raw_time, raw_rows = best_time(lambda: decode_raw_block(raw, header), repeat)
+        if json_rows != raw_rows:
+            mismatches += 1
+            print(f"Height {height}: raw rows differ from JSON rows!")
+        total_json += json_time
+        total_raw += raw_time
+        print(f"{height:>8} {len(json_rows.transaction_rows):>6} {len(body) / 1e6:>8.2f} {len(raw) / 1e6:>8.2f} "
+              f"{json_time * 1000:>9.1f} {raw_time * 1000:>9.1f} {json_time / raw_time:>7.2f}x")
+
+    count = len(samples)
+    if count:
+        print(f"\nJSON path: {count / total_json:.1f} blocks/s   raw path: {count / total_raw:.1f} blocks/s   "
+              f"speedup: {total_json / total_raw:.2f}x   row mismatches: {mismatches}")
+    return total_json, total_raw, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare getblock JSON decoding with raw block parsing")
+    parser.add_argument("--from", dest="from_height", type=int, help="first height to fetch from the node")
+    parser.add_argument("--to", dest="to_height", type=int, help="last height to fetch from the node")
+    parser.add_argument("--fixtures", help="directory of saved samples to benchmark instead of the node")
+    parser.add_argument("--save", help="store the fetched samples in this directory for later runs")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        samples = load_samples(args.fixtures)
+    elif args.from_height is not None and args.to_height is not None:
+        samples = fetch_samples(args.from_height, args.to_height)
+        if args.save:
+            save_samples(samples, args.save)
+    else:
+        parser.error("give either --fixtures or --from/--to")
+    run_benchmark(samples, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
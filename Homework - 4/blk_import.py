@@ -0,0 +1,263 @@
+import glob
+import mmap
+import os
+from collections import namedtuple
+from time import time
+
+from block_writer import BlockWriter, default_extensions, load_sync_state
+from db_connection import connect
+from indexes import deferred_indexes
+from raw_block import double_sha256, hash_to_hex, parse_block
+
+# Message start bytes that prefix every block record in blk*.dat.
+NETWORK_MAGIC = {
+    "main": bytes.fromhex("f9beb4d9"),
+    "test": bytes.fromhex("0b110907"),
+    "testnet4": bytes.fromhex("1c163f28"),
+    "signet": bytes.fromhex("0a03cf40"),
+    "regtest": bytes.fromhex("fabfb5da"),
+}
+
+NULL_HASH_HEX = "00" * 32
+
+# Where one block lives on disk, plus the header links needed for ordering.
+BlockLocation = namedtuple("BlockLocation", ["file_index", "offset", "size", "hash", "prev_hash"])
+
+
+def load_xor_key(blocks_dir):
+    """
+    Returns the 8-byte obfuscation key from blocks/xor.dat (Bitcoin Core 28+),
+    or None when the files are stored in the clear.
+    """
+    path = os.path.join(blocks_dir, "xor.dat")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        key = f.read()
+    return key if any(key) else None
+
+
+def xor_bytes(data, key, offset):
+    """
+    Undoes the obfuscation of `data` read from file position `offset`.
+    The key repeats every 8 bytes, aligned to the start of the file.
+    """
+    if key is None:
+        return data
+    shift = offset % len(key)
+    rotated = key[shift:] + key[:shift]
+    stream = (rotated * (len(data) // len(rotated) + 1))[:len(data)]
+    value = int.from_bytes(data, "little") ^ int.from_bytes(stream, "little")
+    return value.to_bytes(len(data), "little")
+
+
+class BlockFile:
+    """
+    A memory-mapped blk*.dat file. Reads return memoryview slices of the
+    mapping when the file is not obfuscated, so they are not copied.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def read(self, offset, size):
+        data = self.view[offset:offset + size]
+        return xor_bytes(bytes(data), self.key, offset) if self.key else data
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+
+def scan_block_file(block_file, file_index, magic):
+    """
+    Yields a BlockLocation for every block record in the file. Scanning
+    stops at the zero-filled space Bitcoin Core preallocates at the end.
+    """
+    offset, end = 0, len(block_file.map)
+    while offset + 8 + 80 <= end:
+        record = block_file.read(offset, 8)
+        if record[:4] != magic:
+            break
+        size = int.from_bytes(record[4:8], "little")
+        header = block_file.read(offset + 8, 80)
+        yield BlockLocation(
+            file_index, offset + 8, size,
+            hash_to_hex(double_sha256(header)),
+            hash_to_hex(header[4:36])
+        )
+        offset += 8 + size
+
+
+def best_chain(locations, parent_hash=NULL_HASH_HEX):
+    """
+    Orders the scanned blocks by their previous-hash links. Starting from
+    the children of `parent_hash`, it follows the branch with the most
+    blocks, so stale blocks left in the files are skipped. If nothing builds
+    on `parent_hash` (e.g. a pruned node without genesis), the chain starts
+    at the block whose parent is missing from the files.
+    Returns the blocks of the best chain in height order.
+    """
+    by_hash = {loc.hash: loc for loc in locations}
+    children = {}
+    for loc in locations:
+        children.setdefault(loc.prev_hash, []).append(loc.hash)
+    roots = children.get(parent_hash)
+    if not roots:
+        roots = [loc.hash for loc in locations if loc.prev_hash not in by_hash]
+
+    # Iterative depth computation: the height of the longest branch below
+    # each block, filled in children-first.
+    depth = {}
+    stack = [(root, False) for root in roots]
+    while stack:
+        block_hash, expanded = stack.pop()
+        kids = children.get(block_hash, [])
+        if expanded:
+            depth[block_hash] = 1 + max((depth[k] for k in kids), default=0)
+        else:
+            stack.append((block_hash, True))
+            stack.extend((k, False) for k in kids)
+
+    chain = []
+    candidates = roots
+    while candidates:
+        best = max(candidates, key=lambda h: depth[h])
+        chain.append(by_hash[best])
+        candidates = children.get(best, [])
+    return chain
+
+
+def coinbase_height(block):
+    """
+    Reads the BIP34 height pushed at the start of the coinbase script.
+    """
+    script = bytes.fromhex(block["tx"][0]["vin"][0]["coinbase"])
+    opcode = script[0]
+    if 0x51 <= opcode <= 0x60:  # OP_1..OP_16
+        return opcode - 0x50
+    return int.from_bytes(script[1:1 + opcode], "little")
+
+
+def bits_to_work(bits_hex):
+    """
+    Expected number of hashes for a block at this target, as in chainwork.
+    """
+    bits = int(bits_hex, 16)
+    exponent, mantissa = bits >> 24, bits & 0x007fffff
+    if exponent <= 3:
+        target = mantissa >> (8 * (3 - exponent))
+    else:
+        target = mantissa << (8 * (exponent - 3))
+    return (1 << 256) // (target + 1) if target else 0
+
+
+def import_blocks(datadir, db_path="blockchain.db", network="main", commit_every=1000,
+                  profile="bulk-ingest", start_height=None, defer_indexes=True):
+    """
+    Imports blocks straight from <datadir>/blocks/blk*.dat into the database
+    without any RPC. The import continues after the sync checkpoint when
+    there is one, otherwise it starts at genesis (or at the first block
+    present on a pruned node), or at `start_height` if that is later: the
+    blocks below it are skipped, but heights are always counted from genesis
+    or read from the BIP34 coinbase. The chain-context fields getblock would
+    report (height, mediantime, chainwork, confirmations, nextblockhash) are
+    derived from the ordered chain. With `defer_indexes` the secondary indexes are
+    dropped while the blocks are written and rebuilt once at the end. The
+    tables maintained by the writer's extensions are filled as well.
+    Returns the number of blocks imported.
+    """
+    blocks_dir = os.path.join(datadir, "blocks")
+    paths = sorted(glob.glob(os.path.join(blocks_dir, "blk*.dat")))
+    if not paths:
+        print(f"No blk*.dat files found in {blocks_dir}.")
+        return 0
+    key = load_xor_key(blocks_dir)
+    magic = NETWORK_MAGIC[network]
+    files = [BlockFile(path, key) for path in paths]
+
+    conn = connect(db_path, profile)
+    state = load_sync_state(conn)
+    started = time()
+    try:
+        locations = []
+        for index, block_file in enumerate(files):
+            locations.extend(scan_block_file(block_file, index, magic))
+        print(f"Indexed {len(locations)} blocks in {len(files)} files in {time() - started:.1f}s.")
+
+        chain = best_chain(locations, state[1] if state else NULL_HASH_HEX)
+        if state and chain and chain[0].prev_hash != state[1]:
+            print(f"No blocks in the files build on the checkpoint {state[1]}; nothing to import.")
+            return 0
+        if not chain:
+            print("No importable blocks found.")
+            return 0
+
+        # Seed the rolling chain context from what is already stored.
+        recent_times = []
+        chainwork = 0
+        skip = 0
+        if state:
+            height = state[0] + 1
+            rows = conn.execute(
+                "SELECT time, chainwork FROM block WHERE height <= ? ORDER BY height DESC LIMIT 11",
+                (state[0],)
+            ).fetchall()
+            recent_times = [row[0] for row in reversed(rows)]
+            chainwork = int(rows[0][1], 16) if rows else 0
+        else:
+            first = chain[0]
+            if first.prev_hash == NULL_HASH_HEX:
+                height = 0
+            else:
+                height = coinbase_height(parse_block(files[first.file_index].read(first.offset, first.size)))
+            print(f"The chain in the files starts at height {height}.")
+            if height:
+                print("Chainwork is counted from this block because earlier blocks are not available.")
+            if start_height is not None and start_height > height:
+                # The skipped blocks still count towards chainwork and
+                # mediantime; only their headers are read.
+                skip = min(start_height - height, len(chain))
+                for loc in chain[:skip]:
+                    header = files[loc.file_index].read(loc.offset, 80)
+                    recent_times = (recent_times + [int.from_bytes(header[68:72], "little")])[-11:]
+                    chainwork += bits_to_work(f"{int.from_bytes(header[72:76], 'little'):08x}")
+                print(f"Skipping {skip} blocks below height {start_height}.")
+        tip_height = height + len(chain) - 1
+        height += skip
+        if skip == len(chain):
+            print(f"The files end at height {tip_height}; nothing to import.")
+            return 0
+
+        # The derived tables (UTXO set, addresses, rollups, fees, headers) are
+        # filled too, so a later follow() continues them; without a node,
+        # fees whose inputs predate the import are left out.
+        writer = BlockWriter(conn, blocks_per_commit=commit_every, track_sync_state=True,
+                             extensions=default_extensions(conn, None))
+        with deferred_indexes(conn, defer_indexes):
+            for position in range(skip, len(chain)):
+                loc = chain[position]
+                block = parse_block(files[loc.file_index].read(loc.offset, loc.size))
+                recent_times = (recent_times + [block["time"]])[-11:]
+                chainwork += bits_to_work(block["bits"])
+                block["height"] = height
+                block["confirmations"] = tip_height - height + 1
+                block["mediantime"] = sorted(recent_times)[len(recent_times) // 2]
+                block["chainwork"] = f"{chainwork:064x}"
+                block["nextblockhash"] = chain[position + 1].hash if position + 1 < len(chain) else None
+                writer.add_block(block)
+                height += 1
+            writer.flush()
+    finally:
+        conn.close()
+        for block_file in files:
+            block_file.close()
+
+    imported = len(chain) - skip
+    elapsed = time() - started
+    print(f"Imported {imported} blocks in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.1f} blocks/s).")
+    return imported
@@ -0,0 +1,235 @@
+import os
+import queue
+import struct
+from time import monotonic, sleep
+
+from db_connection import connect
+from indexes import create_indexes
+from update_db import BitcoinRPC, sync_to_tip, sync_writer
+
+# bitcoind publishes new tips on this endpoint when started with
+# -zmqpubhashblock=tcp://0.0.0.0:28332.
+ZMQ_HASHBLOCK_ENDPOINT = os.getenv("ZMQ_HASHBLOCK_ENDPOINT")
+
+
+class LocalBlockPublisher:
+    """
+    Stand-in for bitcoind's ZMQ hashblock publisher, for testing the
+    push-driven follower offline. Messages use bitcoind's wire format:
+    [b"hashblock", 32-byte hash, 4-byte little-endian sequence number].
+    Without an endpoint it delivers in-process to the sockets returned by
+    subscriber(); with an endpoint it binds a real ZMQ PUB socket (pyzmq).
+    """
+
+    def __init__(self, endpoint=None):
+        self.sequence = 0
+        self.subscribers = []
+        self.socket = None
+        if endpoint:
+            import zmq
+
+            self.socket = zmq.Context.instance().socket(zmq.PUB)
+            self.socket.bind(endpoint)
+
+    def subscriber(self):
+        socket = _LocalSubscriberSocket()
+        self.subscribers.append(socket)
+        return socket
+
+    def publish(self, block_hash):
+        message = [b"hashblock", bytes.fromhex(block_hash), struct.pack("<I", self.sequence)]
+        self.sequence += 1
+        if self.socket is not None:
+            self.socket.send_multipart(message)
+        for socket in self.subscribers:
+            socket.messages.put(message)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+
+class _LocalSubscriberSocket:
+    """
+    The subset of a pyzmq SUB socket that ZMQBlockNotifier uses.
+    """
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self._next = None
+
+    def poll(self, timeout_ms):
+        try:
+            self._next = self.messages.get(timeout=timeout_ms / 1000)
+            return 1
+        except queue.Empty:
+            return 0
+
+    def recv_multipart(self):
+        return self._next
+
+    def close(self):
+        pass
+
+
+class ZMQBlockNotifier:
+    """
+    Waits for hashblock notifications. Pass either a bitcoind endpoint
+    (requires pyzmq) or an already subscribed socket such as
+    LocalBlockPublisher.subscriber().
+    """
+
+    name = "zmq"
+
+    def __init__(self, endpoint=None, socket=None):
+        if socket is None:
+            import zmq
+
+            socket = zmq.Context.instance().socket(zmq.SUB)
+            socket.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+            socket.connect(endpoint)
+        self.socket = socket
+        self.last_sequence = None
+
+    def wait(self, timeout):
+        """
+        Returns the hash of the next announced block, or None on timeout.
+        """
+        if not self.socket.poll(int(timeout * 1000)):
+            return None
+        topic, body, sequence = self.socket.recv_multipart()[:3]
+        sequence = struct.unpack("<I", sequence)[0]
+        if self.last_sequence is not None and sequence != (self.last_sequence + 1) & 0xffffffff:
+            # A dropped message is harmless: every sync catches up to the tip.
+            print(f"ZMQ notifications {self.last_sequence + 1}..{sequence - 1} were missed.")
+        self.last_sequence = sequence
+        return body.hex()
+
+    def close(self):
+        self.socket.close()
+
+
+class LongPollNotifier:
+    """
+    Uses the waitfornewblock RPC, which returns as soon as the tip changes
+    or the timeout expires. Needs no extra node configuration.
+    """
+
+    name = "longpoll"
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.last_hash = rpc.call("getbestblockhash")
+
+    def wait(self, timeout):
+        tip = self.rpc.call("waitfornewblock", [int(timeout * 1000)])
+        if tip is None:
+            # The RPC failed; do not spin against a broken node.
+            sleep(min(timeout, 1.0))
+            return None
+        if tip["hash"] == self.last_hash:
+            return None
+        self.last_hash = tip["hash"]
+        return tip["hash"]
+
+    def close(self):
+        pass
+
+
+class PollingNotifier:
+    """
+    Fallback that polls getbestblockhash. The interval starts at
+    `min_interval`, doubles while nothing changes up to `max_interval`, and
+    drops back to `min_interval` whenever a new block shows up, since blocks
+    often arrive in quick succession.
+    """
+
+    name = "poll"
+
+    def __init__(self, rpc, min_interval=2.0, max_interval=60.0):
+        self.rpc = rpc
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.last_hash = rpc.call("getbestblockhash")
+
+    def wait(self, timeout):
+        sleep(min(self.interval, timeout))
+        best_hash = self.rpc.call("getbestblockhash")
+        if best_hash is None or best_hash == self.last_hash:
+            self.interval = min(self.interval * 2, self.max_interval)
+            return None
+        self.last_hash = best_hash
+        self.interval = self.min_interval
+        return best_hash
+
+    def close(self):
+        pass
+
+
+def choose_notifier(rpc, mode="auto", zmq_endpoint=None, max_interval=60.0):
+    """
+    Builds the notifier for `mode`. "auto" prefers ZMQ when an endpoint is
+    configured and pyzmq is installed, then waitfornewblock long-polling,
+    then adaptive polling.
+    """
+    zmq_endpoint = zmq_endpoint or ZMQ_HASHBLOCK_ENDPOINT
+    if mode == "zmq" or (mode == "auto" and zmq_endpoint):
+        try:
+            return ZMQBlockNotifier(zmq_endpoint)
+        except ImportError:
+            if mode == "zmq":
+                raise
+            print("pyzmq is not installed; falling back to long-polling.")
+    if mode in ("auto", "longpoll"):
+        # A 1 ms call tells us whether the node supports long-polling
+        # (a timeout of 0 would wait forever).
+        if rpc.call("waitfornewblock", [1]) is not None:
+            return LongPollNotifier(rpc)
+        if mode == "longpoll":
+            raise RuntimeError("The node does not support waitfornewblock.")
+        print("waitfornewblock is unavailable; falling back to adaptive polling.")
+    return PollingNotifier(rpc, max_interval=max_interval)
+
+
+def follow(db_path, notifier=None, mode="auto", zmq_endpoint=None, profile="ingest",
+           wait_timeout=30.0, resync_interval=600.0, max_interval=60.0, max_cycles=None,
+           start_height=None, stream=False):
+    """
+    Keeps the database at the chain tip. Ingestion starts as soon as the
+    notifier announces a block; a full sync also runs every `resync_interval`
+    seconds in case a notification was lost. `max_cycles` bounds the number
+    of notifier waits (for tests); `stream` is passed on to sync_to_tip.
+    Returns the number of blocks committed.
+    """
+    conn = connect(db_path, profile)
+    # Tip following relies on the unique indexes to skip blocks it already
+    # has; an interrupted bulk load may have left them dropped.
+    create_indexes(conn)
+    rpc = BitcoinRPC()
+    notifier = notifier or choose_notifier(rpc, mode, zmq_endpoint, max_interval)
+    print(f"Following the chain tip using {notifier.name} notifications.")
+    cycles = 0
+    try:
+        # One writer for the whole session keeps the UTXO cache warm. The
+        # catch-up sync is the long phase, so it is inside the try to release
+        # the notifier and connections when it is interrupted.
+        writer = sync_writer(conn, rpc)
+        committed = sync_to_tip(conn, rpc, start_height=start_height, stream=stream, writer=writer)
+        last_sync = monotonic()
+        while max_cycles is None or cycles < max_cycles:
+            cycles += 1
+            block_hash = notifier.wait(wait_timeout)
+            if block_hash is not None:
+                print(f"New block announced: {block_hash}")
+            elif monotonic() - last_sync < resync_interval:
+                continue
+            committed += sync_to_tip(conn, rpc, stream=stream, writer=writer)
+            last_sync = monotonic()
+    finally:
+        notifier.close()
+        rpc.close()
+        # Lets SQLite refresh statistics that the new rows made stale.
+        conn.execute("PRAGMA optimize")
+        conn.close()
+    return committed
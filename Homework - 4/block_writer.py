@@ -0,0 +1,453 @@
+import json
+import sqlite3
+from collections import namedtuple
+from decimal import Decimal
+from itertools import chain
+from time import perf_counter
+
+import metrics
+import profiling
+from address_index import AddressIndex
+from db_connection import STORAGE_TABLES, database_file, hash_storage
+from fees import TransactionFees
+from reorg import rollback_to
+from rollups import Rollups
+from utxo import UtxoSet
+
+# getblock verbosity=2 fields in the column order of the block table. Table
+# names are filled in from db_connection.STORAGE_TABLES for the database's
+# hash storage mode.
+BLOCK_INSERT_SQL = """
+    INSERT OR IGNORE INTO {block} (
+        hash, confirmations, height, version, versionhex, merkleroot,
+        time, mediantime, nonce, bits, difficulty, chainwork, ntx,
+        previousblockhash, nextblockhash, strippedsize, size, weight
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+TRANSACTION_INSERT_SQL = """
+    INSERT OR IGNORE INTO {transactions} (
+        txid, block_hash, version, locktime, size, weight
+    )
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+TX_INPUT_INSERT_SQL = """
+    INSERT OR IGNORE INTO {tx_input} (
+        txid, input_index, prev_txid, prev_vout, script_sig, sequence
+    )
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+TX_OUTPUT_INSERT_SQL = """
+    INSERT OR IGNORE INTO {tx_output} (
+        txid, output_index, value_sat, script_pubkey
+    )
+    VALUES (?, ?, ?, ?)
+"""
+
+# Positions of the hash columns in each row, converted to 32-byte BLOBs when
+# the database uses schema_blob.sql.
+HASH_COLUMNS = {
+    "block": (0, 5, 13, 14),
+    "transactions": (0, 1),
+    "tx_input": (0, 2),
+    "tx_output": (0,),
+}
+
+SYNC_STATE_SQL = """
+    CREATE TABLE IF NOT EXISTS sync_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        height INTEGER NOT NULL,
+        hash VARCHAR(255) NOT NULL
+    )
+"""
+
+COIN = 100_000_000
+
+# Block replies are parsed with parse_float=Decimal so output amounts reach
+# btc_to_sats exactly; the remaining decimal fields (difficulty) are REAL
+# columns and are bound as floats.
+sqlite3.register_adapter(Decimal, float)
+
+# One block turned into table rows. The row fields may be lazy iterables
+# (in-process decoding) or lists (decoded in a worker process).
+DecodedBlock = namedtuple(
+    "DecodedBlock",
+    ["height", "hash", "block_row", "transaction_rows", "input_rows", "output_rows"]
+)
+
+
+def btc_to_sats(value):
+    """
+    Converts a vout amount in BTC to integer satoshis. Decimal amounts (from
+    parse_float=Decimal) convert exactly. Floats are rounded to the nearest
+    satoshi, which is exact for every amount up to the 21M BTC supply.
+    """
+    return int(round(value * COIN))
+
+
+def iter_input_rows(transactions):
+    """
+    Yields one tx_input row per vin entry. Coinbase inputs have no previous
+    output, so prev_txid/prev_vout are NULL and script_sig holds the
+    coinbase data.
+    """
+    for tx in transactions:
+        txid = tx["txid"]
+        for index, vin in enumerate(tx["vin"]):
+            if "coinbase" in vin:
+                yield (txid, index, None, None, vin["coinbase"], vin.get("sequence"))
+            else:
+                yield (txid, index, vin["txid"], vin["vout"], vin["scriptSig"]["hex"], vin.get("sequence"))
+
+
+def iter_output_rows(transactions):
+    """
+    Yields one tx_output row per vout entry, with the amount in satoshis.
+    """
+    for tx in transactions:
+        txid = tx["txid"]
+        for vout in tx["vout"]:
+            yield (txid, vout["n"], btc_to_sats(vout["value"]), vout["scriptPubKey"]["hex"])
+
+
+def block_row(block_data):
+    """
+    Returns the block table row for a getblock result (with or without "tx").
+    """
+    return (
+        block_data["hash"],
+        block_data["confirmations"],
+        block_data["height"],
+        block_data["version"],
+        block_data["versionHex"],
+        block_data["merkleroot"],
+        block_data["time"],
+        block_data["mediantime"],
+        block_data["nonce"],
+        block_data["bits"],
+        block_data["difficulty"],
+        block_data["chainwork"],
+        block_data["nTx"],
+        block_data.get("previousblockhash"),
+        block_data.get("nextblockhash"),
+        block_data["strippedsize"],
+        block_data["size"],
+        block_data["weight"]
+    )
+
+
+def transaction_row(tx, block_hash):
+    return (tx["txid"], block_hash, tx["version"], tx["locktime"], tx["size"], tx["weight"])
+
+
+def decode_block(block_data):
+    """
+    Turns a getblock verbosity=2 result into the rows stored in blockchain.db.
+    All per-transaction rows are produced lazily while the writer consumes
+    them, so even blocks with multi-thousand-output transactions never build
+    a per-block row list.
+    """
+    block_hash = block_data["hash"]
+    transactions = block_data.get("tx", [])
+    transaction_rows = (transaction_row(tx, block_hash) for tx in transactions)
+    return DecodedBlock(
+        block_data["height"], block_hash, block_row(block_data), transaction_rows,
+        iter_input_rows(transactions), iter_output_rows(transactions)
+    )
+
+
+def materialize(decoded):
+    """
+    Turns the lazy row iterables of a DecodedBlock into lists, which is
+    needed before it can be sent to another process.
+    """
+    return decoded._replace(
+        transaction_rows=list(decoded.transaction_rows),
+        input_rows=list(decoded.input_rows),
+        output_rows=list(decoded.output_rows)
+    )
+
+
+def decode_block_json(data):
+    """
+    Parses a raw getblock JSON-RPC response body and decodes it with
+    decode_block. Kept at module level so a process pool can run it.
+    """
+    reply = json.loads(data, parse_float=Decimal)
+    if reply.get("error") or reply.get("result") is None:
+        return None
+    return materialize(decode_block(reply["result"]))
+
+
+def hashes_to_blobs(rows, columns):
+    """
+    Yields `rows` with the hex hashes at `columns` replaced by their bytes.
+    """
+    for row in rows:
+        row = list(row)
+        for i in columns:
+            if row[i] is not None:
+                row[i] = bytes.fromhex(row[i])
+        yield row
+
+
+def load_sync_state(conn):
+    """
+    Returns (height, hash) of the last fully committed block, or None if this
+    database has never been synced.
+    """
+    conn.execute(SYNC_STATE_SQL)
+    return conn.execute("SELECT height, hash FROM sync_state WHERE id = 1").fetchone()
+
+
+def save_sync_state(cursor, height, block_hash):
+    """
+    Records `height` as fully committed. Must run in the same transaction as
+    the block's rows so the checkpoint and the data can never disagree.
+    """
+    cursor.execute("""
+        INSERT INTO sync_state (id, height, hash) VALUES (1, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET height = excluded.height, hash = excluded.hash
+    """, (height, block_hash))
+
+
+def default_extensions(conn, rpc=None):
+    """
+    The derived tables every ingester keeps up to date. `rpc` (a BitcoinRPC)
+    lets the fee computation fetch input amounts the UTXO set lacks.
+    """
+    utxos = UtxoSet(conn)
+    extensions = [utxos, AddressIndex(conn, utxos), Rollups(conn), TransactionFees(conn, utxos, rpc)]
+    if not database_file(conn):
+        # The header store lives next to the database file; in-memory and
+        # temporary databases have none.
+        return extensions
+    try:
+        from header_store import HeaderStoreWriter
+    except ImportError:
+        print("numpy is not installed; the columnar header store is not updated.")
+    else:
+        extensions.append(HeaderStoreWriter(conn))
+    return extensions
+
+
+class BlockWriter:
+    """
+    Buffers decoded blocks and writes them table by table with executemany,
+    inside one explicit transaction per `blocks_per_commit` blocks.
+    With track_sync_state the sync checkpoint is advanced in that same
+    transaction. Prints one summary line per commit instead of one per row.
+
+    `extensions` maintain derived tables in the same transactions (default:
+    default_extensions(conn); pass [] for none). Each one provides
+    add_rows(height, input_rows, output_rows) for every queued block,
+    flush(cursor, height) before each commit, discard() after a failed
+    commit, rollback(cursor, fork_height) inside rollback_to and report()
+    for a one-line summary. Extensions whose pending state grows with the
+    block also provide spill(cursor, height), which write_streamed calls
+    after every transaction so that state is written out instead of held.
+    """
+
+    def __init__(self, conn, blocks_per_commit=1, track_sync_state=False, extensions=None):
+        self.conn = conn
+        self.extensions = default_extensions(conn) if extensions is None else list(extensions)
+        self.blocks_per_commit = blocks_per_commit
+        self.track_sync_state = track_sync_state
+        self.pending = []
+        self.last_committed_height = None
+        self.hash_storage = hash_storage(conn)
+        self.tables = STORAGE_TABLES[self.hash_storage]
+        self.block_sql = BLOCK_INSERT_SQL.format(**self.tables)
+        self.transaction_sql = TRANSACTION_INSERT_SQL.format(**self.tables)
+        self.input_sql = TX_INPUT_INSERT_SQL.format(**self.tables)
+        self.output_sql = TX_OUTPUT_INSERT_SQL.format(**self.tables)
+        if track_sync_state:
+            conn.execute(SYNC_STATE_SQL)
+
+    def add_block(self, block_data):
+        """
+        Queues a getblock verbosity=2 result for writing.
+        """
+        self.add_decoded(decode_block(block_data))
+
+    def add_decoded(self, decoded):
+        """
+        Queues an already decoded block and commits once enough are buffered.
+        """
+        profiling.block_started(decoded.height)
+        if self.extensions:
+            # The rows are read twice: by the extensions now, and by flush.
+            # Without extensions they are decoded lazily inside "insert".
+            with profiling.span("decode", height=decoded.height):
+                decoded = materialize(decoded)
+            for extension in self.extensions:
+                with profiling.span(f"add_rows {type(extension).__name__}"):
+                    extension.add_rows(decoded.height, decoded.input_rows, decoded.output_rows)
+        self.pending.append(decoded)
+        metrics.WRITER_PENDING.set(len(self.pending))
+        if len(self.pending) >= self.blocks_per_commit:
+            self.flush()
+
+    def abort(self):
+        """
+        Rolls back the open transaction and the extensions' pending state.
+        """
+        self.conn.rollback()
+        for extension in self.extensions:
+            extension.discard()
+
+    def rows(self, table, rows):
+        """
+        Adapts decoded rows (hex hashes) to the database's hash storage mode.
+        """
+        if self.hash_storage == "blob":
+            return hashes_to_blobs(rows, HASH_COLUMNS[table])
+        return rows
+
+    def record_commit(self, elapsed, block_count, row_counts, height, block_time):
+        """
+        Updates the ingest metrics after a commit; see metrics.py.
+        """
+        metrics.COMMIT_SECONDS.observe(elapsed)
+        metrics.BLOCKS_WRITTEN.inc(block_count)
+        for table, count in row_counts:
+            metrics.ROWS_WRITTEN.inc(count, table)
+        metrics.WRITER_PENDING.set(len(self.pending))
+        metrics.record_committed(height, block_time)
+        profiling.block_committed(height)
+
+    def flush(self):
+        """
+        Writes every buffered block in one transaction and commits it.
+        """
+        if not self.pending:
+            return
+        blocks, self.pending = self.pending, []
+        started = perf_counter()
+        cursor = self.conn.cursor()
+        if not self.conn.in_transaction:
+            cursor.execute("BEGIN")
+        try:
+            row_counts = []
+            with profiling.span("insert", first=blocks[0].height, last=blocks[-1].height):
+                cursor.executemany(self.block_sql, self.rows("block", (b.block_row for b in blocks)))
+                row_counts.append(("block", cursor.rowcount))
+                cursor.executemany(self.transaction_sql, self.rows(
+                    "transactions", chain.from_iterable(b.transaction_rows for b in blocks)))
+                row_counts.append(("transactions", cursor.rowcount))
+                cursor.executemany(self.input_sql, self.rows(
+                    "tx_input", chain.from_iterable(b.input_rows for b in blocks)))
+                row_counts.append(("tx_input", cursor.rowcount))
+                cursor.executemany(self.output_sql, self.rows(
+                    "tx_output", chain.from_iterable(b.output_rows for b in blocks)))
+                row_counts.append(("tx_output", cursor.rowcount))
+            for extension in self.extensions:
+                with profiling.span(f"flush {type(extension).__name__}"):
+                    extension.flush(cursor, blocks[-1].height)
+            if self.track_sync_state:
+                save_sync_state(cursor, blocks[-1].height, blocks[-1].hash)
+            with profiling.span("commit", blocks=len(blocks)):
+                self.conn.commit()
+        except BaseException:
+            self.abort()
+            raise
+        self.last_committed_height = blocks[-1].height
+
+        elapsed = perf_counter() - started
+        self.record_commit(elapsed, len(blocks), row_counts, blocks[-1].height, blocks[-1].block_row[6])
+        tx_count = sum(b.block_row[12] for b in blocks)
+        if len(blocks) == 1:
+            print(f"Block {blocks[0].height} {blocks[0].hash}: {tx_count} transactions written in {elapsed:.3f}s")
+        else:
+            print(f"Blocks {blocks[0].height}..{blocks[-1].height}: {tx_count} transactions written "
+                  f"in {elapsed:.3f}s ({len(blocks) / max(elapsed, 1e-9):.1f} blocks/s)")
+
+    def write_streamed(self, streamed, validate=None):
+        """
+        Writes a json_stream.StreamedBlock while it is being received: each
+        transaction's rows are inserted as soon as it is decoded, so memory
+        holds one transaction instead of the whole block. Extensions with a
+        spill method write their state after each transaction too; the others
+        (rollups, header store) only keep a few numbers per block, and the
+        UTXO cache stays within its configured size. The block row is written
+        last, once the header is complete. `validate(header)` may raise to
+        reject the block, which rolls back everything it wrote.
+        Streamed blocks are committed on their own, after any buffered blocks.
+        Returns the block height, or None if the node returned an error.
+        """
+        self.flush()
+        started = perf_counter()
+        cursor = self.conn.cursor()
+        if not self.conn.in_transaction:
+            cursor.execute("BEGIN")
+        try:
+            block_hash = None
+            input_count = output_count = 0
+            spills = [extension.spill for extension in self.extensions if hasattr(extension, "spill")]
+            # Receiving, decoding and inserting are interleaved here, so they share one span.
+            with profiling.span("stream insert"):
+                for tx in streamed.transactions():
+                    block_hash = block_hash or streamed.header["hash"]
+                    input_rows, output_rows = list(iter_input_rows((tx,))), list(iter_output_rows((tx,)))
+                    cursor.executemany(self.transaction_sql,
+                                       self.rows("transactions", [transaction_row(tx, block_hash)]))
+                    cursor.executemany(self.input_sql, self.rows("tx_input", input_rows))
+                    cursor.executemany(self.output_sql, self.rows("tx_output", output_rows))
+                    input_count += len(input_rows)
+                    output_count += len(output_rows)
+                    for extension in self.extensions:
+                        extension.add_rows(streamed.header.get("height"), input_rows, output_rows)
+                    for spill in spills:
+                        spill(cursor, streamed.header.get("height"))
+            if streamed.error or not streamed.header:
+                self.abort()
+                print(f"Streamed getblock failed: {streamed.error}")
+                return None
+            header = streamed.header
+            if validate:
+                validate(header)
+            cursor.executemany(self.block_sql, self.rows("block", [block_row(header)]))
+            for extension in self.extensions:
+                with profiling.span(f"flush {type(extension).__name__}"):
+                    extension.flush(cursor, header["height"])
+            if self.track_sync_state:
+                save_sync_state(cursor, header["height"], header["hash"])
+            with profiling.span("commit", blocks=1):
+                self.conn.commit()
+        except BaseException:
+            self.abort()
+            raise
+        self.last_committed_height = header["height"]
+        elapsed = perf_counter() - started
+        self.record_commit(elapsed, 1, [("block", 1), ("transactions", streamed.tx_count),
+                                        ("tx_input", input_count), ("tx_output", output_count)],
+                           header["height"], header["time"])
+        print(f"Block {header['height']} {header['hash']}: {streamed.tx_count} transactions streamed "
+              f"in {elapsed:.3f}s")
+        return header["height"]
+
+    def rollback_to(self, fork_height, fork_hash):
+        """
+        Flushes pending blocks, then removes everything above `fork_height`
+        and moves the sync checkpoint back in one transaction.
+        Returns the number of blocks removed.
+        """
+        self.flush()
+        cursor = self.conn.cursor()
+        if not self.conn.in_transaction:
+            cursor.execute("BEGIN")
+        try:
+            for extension in self.extensions:
+                extension.rollback(cursor, fork_height)
+            removed = rollback_to(cursor, fork_height, self.tables)
+            if self.track_sync_state:
+                save_sync_state(cursor, fork_height, fork_hash)
+            self.conn.commit()
+        except BaseException:
+            self.abort()
+            raise
+        self.last_committed_height = fork_height
+        return removed
@@ -0,0 +1,99 @@
+import sqlite3
+
+# Named PRAGMA sets for blockchain.db. Every profile uses WAL so the ingester
+# and the query tools can run at the same time without blocking each other.
+PROFILES = {
+    # Historical backfills: durability is traded for speed. A crash can lose
+    # the last commits (or, on an OS crash, corrupt the file), so only use it
+    # for loads that can simply be re-run from their checkpoint.
+    "bulk-ingest": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -1048576,        # 1 GiB (negative values are KiB)
+        "temp_store": "MEMORY",
+        "mmap_size": 1 << 30,
+        "wal_autocheckpoint": 10000,   # pages; fewer, larger checkpoints
+    },
+    # Tip following: committed blocks survive a crash of the ingester.
+    "ingest": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -262144,         # 256 MiB
+        "temp_store": "MEMORY",
+        "mmap_size": 1 << 28,
+        "busy_timeout": 5000,
+    },
+    # Read-only query tools (text-to-SQL, tests): many concurrent readers
+    # served from the shared mmap instead of private page caches.
+    "serve": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,          # 64 MiB
+        "temp_store": "MEMORY",
+        "mmap_size": 1 << 30,
+        "busy_timeout": 5000,
+        "query_only": "ON",
+    },
+}
+
+
+# The tables that hold the data in each hash storage mode. "hex" is
+# schema.sql (hashes as hex text); "blob" is schema_blob.sql (hashes as raw
+# 32-byte BLOBs behind hex-presenting views). In both modes the names
+# block, transactions, tx_input, tx_output, utxo, address_activity and tx_fee
+# can be queried.
+STORAGE_TABLES = {
+    "hex": {"block": "block", "transactions": "transactions", "tx_input": "tx_input",
+            "tx_output": "tx_output_sat", "utxo": "utxo",
+            "address_activity": "address_activity", "tx_fee": "tx_fee"},
+    "blob": {"block": "block_bin", "transactions": "transactions_bin", "tx_input": "tx_input_bin",
+             "tx_output": "tx_output_bin", "utxo": "utxo_bin",
+             "address_activity": "address_activity_bin", "tx_fee": "tx_fee_bin"},
+}
+
+
+def hash_storage(conn):
+    """
+    Returns "blob" if the database uses schema_blob.sql, otherwise "hex".
+    """
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'block_bin'").fetchone()
+    return "blob" if row else "hex"
+
+
+def database_file(conn):
+    """
+    Returns the file name of the main database, or "" for an in-memory or
+    temporary database.
+    """
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def hash_hex(value):
+    """
+    SQL function hash_hex(blob): a stored hash as lowercase hex (NULL stays NULL).
+    """
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def hash_blob(value):
+    """
+    SQL function hash_blob(text): a hex hash as the 32-byte BLOB stored in the
+    *_bin tables (NULL stays NULL), e.g. WHERE txid = hash_blob('4a5e...').
+    """
+    return bytes.fromhex(value) if isinstance(value, str) else value
+
+
+def connect(db_path, profile="serve"):
+    """
+    Opens `db_path`, applies the PRAGMAs of the named profile and registers
+    the hash_hex/hash_blob conversion functions.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown SQLite profile {profile!r}; choose one of {', '.join(PROFILES)}")
+    conn = sqlite3.connect(db_path)
+    conn.create_function("hash_hex", 1, hash_hex, deterministic=True)
+    conn.create_function("hash_blob", 1, hash_blob, deterministic=True)
+    # journal_mode must be switched before query_only forbids writes.
+    for pragma, value in PROFILES[profile].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
@@ -0,0 +1,107 @@
+import argparse
+import sqlite3
+
+from db_connection import connect
+
+# SQL like the text-to-SQL model writes for the questions in test_queries.py,
+# plus the lookups the ingester itself relies on. Used when no other queries
+# are given.
+SAMPLE_QUERIES = [
+    "SELECT COUNT(*) FROM block",
+    "SELECT hash FROM block ORDER BY height DESC LIMIT 1",
+    "SELECT hash FROM block WHERE height = 500000",
+    "SELECT time FROM block WHERE height = 600000",
+    "SELECT hash, difficulty FROM block ORDER BY difficulty DESC LIMIT 1",
+    "SELECT hash, ntx FROM block ORDER BY ntx DESC LIMIT 5",
+    "SELECT COUNT(*) FROM transactions",
+    "SELECT txid FROM transactions WHERE block_hash = (SELECT hash FROM block WHERE height = 407048)",
+    "SELECT t.txid, SUM(o.value) AS total FROM transactions t "
+    "JOIN block b ON t.block_hash = b.hash JOIN tx_output o ON o.txid = t.txid "
+    "WHERE b.height = 407048 GROUP BY t.txid ORDER BY total DESC LIMIT 1",
+    "SELECT SUM(value) FROM tx_output",
+    "SELECT i.txid FROM tx_input i JOIN tx_output o ON o.txid = i.prev_txid AND o.output_index = i.prev_vout "
+    "WHERE o.txid = '0e3e2357e806b6cdb1f70b54c3a3a17b6714ee1f0e68bebb44a74b1efd512098'",
+    "SELECT height, txid, delta_sat FROM address_activity "
+    "WHERE address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa' ORDER BY height DESC LIMIT 20",
+    "SELECT height, tx_count FROM block_stats ORDER BY tx_count DESC LIMIT 5",
+    "SELECT SUM(output_sat) FROM daily_stats",
+    "SELECT txid, feerate FROM tx_fee WHERE height = 800000 ORDER BY feerate DESC LIMIT 10",
+]
+
+
+def read_queries(path):
+    """
+    Reads the SQL statements (separated by semicolons) from a file.
+    """
+    queries, current = [], ""
+    with open(path) as f:
+        for line in f:
+            current += line
+            if sqlite3.complete_statement(current):
+                queries.append(current.strip().rstrip(";"))
+                current = ""
+    if current.strip():
+        queries.append(current.strip())
+    return queries
+
+
+def explain(conn, sql):
+    """
+    Returns (plan lines, full scans) for `sql`. A full scan is a SCAN step
+    that reads a whole table without an index; SCAN ... USING INDEX steps
+    walk an index in order (e.g. for ORDER BY ... LIMIT) and are not counted.
+    """
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    scans = [step for step in plan if step.startswith("SCAN ") and " USING " not in step]
+    return plan, scans
+
+
+def report(conn, queries):
+    """
+    Prints the query plan of every query and returns the queries that still
+    fall back to full table scans, as (sql, scan steps) pairs.
+    """
+    flagged = []
+    for sql in queries:
+        try:
+            plan, scans = explain(conn, sql)
+        except sqlite3.Error as e:
+            print(f"ERROR  {sql}\n       {e}\n")
+            continue
+        print(f"{'SCAN ' if scans else 'OK   '}  {sql}")
+        for step in plan:
+            print(f"       {step}")
+        print()
+        if scans:
+            flagged.append((sql, scans))
+    print(f"{len(flagged)} of {len(queries)} queries read a whole table.")
+    return flagged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show which queries fall back to full table scans")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--sql", help="file with the SQL statements to check (default: built-in samples)")
+    parser.add_argument("--ask", action="append", default=[],
+                        help="natural language question to turn into SQL with query_modal_db (repeatable)")
+    args = parser.parse_args(argv)
+
+    if args.sql:
+        queries = read_queries(args.sql)
+    elif args.ask:
+        # Needs OPENAI_API_KEY, like query_modal_db.py itself.
+        from query_modal_db import extract_schema, generate_sql_query
+
+        schema = extract_schema(args.db)
+        queries = [generate_sql_query(question, schema) for question in args.ask]
+    else:
+        queries = SAMPLE_QUERIES
+    conn = connect(args.db, "serve")
+    try:
+        report(conn, queries)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
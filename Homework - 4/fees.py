@@ -0,0 +1,154 @@
+import argparse
+
+from db_connection import STORAGE_TABLES, connect, hash_storage
+
+# Fee, virtual size and feerate (sat/vB) of every non-coinbase transaction.
+TX_FEE_SQL = """
+    CREATE TABLE IF NOT EXISTS {tx_fee} (
+        txid {hash_type} PRIMARY KEY,
+        height INTEGER NOT NULL,
+        fee_sat INTEGER NOT NULL,
+        vsize INTEGER NOT NULL,
+        feerate REAL NOT NULL
+    )
+"""
+
+TX_FEE_VIEW_SQL = """
+    CREATE VIEW IF NOT EXISTS tx_fee AS
+    SELECT lower(hex(txid)) AS txid, height, fee_sat, vsize, feerate
+    FROM tx_fee_bin
+"""
+
+
+class TransactionFees:
+    """
+    BlockWriter extension that fills tx_fee. Input amounts come from the
+    UtxoSet, which reports every output it removes, from its cache or from
+    the utxo table, so no index on tx_output is needed and bulk loads with
+    deferred indexes get their fees too. The UtxoSet must come first in the
+    writer's extensions. Spends of outputs the set does not have (from
+    before the first ingested block) are resolved with batched
+    getrawtransaction calls to `rpc`, which needs txindex=1. Transactions
+    whose inputs cannot all be resolved get no row and are counted as
+    unresolved.
+    """
+
+    def __init__(self, conn, utxos, rpc=None):
+        self.rpc = rpc
+        self.blob_hashes = hash_storage(conn) == "blob"
+        self.tables = STORAGE_TABLES[hash_storage(conn)]
+        self.table = self.tables["tx_fee"]
+        hash_type = "BLOB" if self.blob_hashes else "VARCHAR(255)"
+        conn.execute(TX_FEE_SQL.format(tx_fee=self.table, hash_type=hash_type))
+        if self.blob_hashes:
+            conn.execute(TX_FEE_VIEW_SQL)
+        conn.commit()
+        self.rpc_lookups = self.unresolved = 0
+        self.discard()
+        utxos.spend_listeners.append(self.spend)
+        utxos.missing_listeners.append(self.spend_unknown)
+
+    def discard(self):
+        # txid -> [height, input_sat, output_sat, prevouts missing from the UTXO set]
+        self.pending = {}
+
+    def key(self, txid):
+        return bytes.fromhex(txid) if self.blob_hashes else txid
+
+    def entry(self, height, txid):
+        # The UtxoSet reports spends before this extension sees the rows.
+        return self.pending.setdefault(txid, [height, 0, 0, []])
+
+    def add_rows(self, height, input_rows, output_rows):
+        for txid, _, value_sat, _ in output_rows:
+            self.entry(height, txid)[2] += value_sat
+        for row in input_rows:
+            if row[2] is None:
+                # Coinbase: no fee of its own.
+                self.pending.pop(row[0], None)
+
+    def spend(self, height, txid, value_sat, script_pubkey):
+        self.entry(height, txid)[1] += value_sat
+
+    def spend_unknown(self, height, txid, prev_txid, prev_vout):
+        self.entry(height, txid)[3].append((prev_txid, prev_vout))
+
+    def lookup_rpc(self, prevouts):
+        """
+        Amounts of `prevouts` from the node, one getrawtransaction per
+        distinct txid.
+        """
+        if self.rpc is None or not prevouts:
+            return {}
+        # block_writer imports this module, so the converter is imported here.
+        from block_writer import btc_to_sats
+        txids = sorted({txid for txid, _ in prevouts})
+        replies = self.rpc.call_batch([("getrawtransaction", [txid, True]) for txid in txids])
+        found = {}
+        for txid, (tx, _) in zip(txids, replies):
+            for vout in (tx or {}).get("vout", []):
+                found[(txid, vout["n"])] = btc_to_sats(vout["value"])
+        self.rpc_lookups += sum(1 for prevout in prevouts if prevout in found)
+        return found
+
+    def flush(self, cursor, height):
+        """
+        Resolves the unknown prevouts and writes the fee rows inside the
+        writer's transaction, after the UtxoSet's flush has reported the
+        spends it looked up; vsize comes from the transaction's weight.
+        """
+        found = self.lookup_rpc({prevout for entry in self.pending.values() for prevout in entry[3]})
+        rows = []
+        for txid, (tx_height, input_sat, output_sat, unknown) in self.pending.items():
+            if any(prevout not in found for prevout in unknown):
+                self.unresolved += 1
+                continue
+            fee_sat = input_sat + sum(found[prevout] for prevout in unknown) - output_sat
+            rows.append((tx_height, fee_sat, fee_sat, self.key(txid)))
+        cursor.executemany(f"""
+            INSERT OR REPLACE INTO {self.table} (txid, height, fee_sat, vsize, feerate)
+            SELECT txid, ?, ?, (weight + 3) / 4, ? * 1.0 / ((weight + 3) / 4)
+            FROM {self.tables['transactions']} WHERE txid = ?
+        """, rows)
+        self.discard()
+
+    def spill(self, cursor, height):
+        """
+        Writes the fees of the transactions of a partly received streamed
+        block. Must follow the UtxoSet's spill, which reports the spends.
+        """
+        self.flush(cursor, height)
+
+    def rollback(self, cursor, fork_height):
+        self.discard()
+        cursor.execute(f"DELETE FROM {self.table} WHERE height > ?", (fork_height,))
+
+    def report(self):
+        return (f"Fees: {self.rpc_lookups} input amounts from RPC, "
+                f"{self.unresolved} transactions without a fee")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Feerate summary of recent blocks")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--blocks", type=int, default=10, help="number of most recent blocks")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.db, "serve")
+    try:
+        tip = conn.execute("SELECT MAX(height) FROM tx_fee").fetchone()[0]
+        if tip is None:
+            print("No fee data stored yet.")
+            return
+        for height, count, fee_sat, vsize, low, high in conn.execute("""
+            SELECT height, COUNT(*), SUM(fee_sat), SUM(vsize), MIN(feerate), MAX(feerate)
+            FROM tx_fee WHERE height > ? GROUP BY height ORDER BY height DESC
+        """, (tip - args.blocks,)):
+            print(f"{height:>8}  {count:>5} txs  {fee_sat / 1e8:.8f} BTC  "
+                  f"{fee_sat / vsize:.1f} sat/vB average ({low:.1f}-{high:.1f})")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
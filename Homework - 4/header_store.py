@@ -0,0 +1,322 @@
+import argparse
+import json
+import os
+from time import perf_counter
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from db_connection import STORAGE_TABLES, connect, database_file, hash_storage
+
+# Fixed-width columns of the store, one memory-mapped .npy file each, indexed
+# by height. Heights that were never ingested have height = -1.
+# chainwork is 256 bits wide; NumPy has no 128-bit integers, so it is kept
+# as four uint64 limbs, least significant first.
+COLUMNS = {
+    "height": (np.int64, ()),
+    "time": (np.int64, ()),
+    "mediantime": (np.int64, ()),
+    "bits": (np.uint32, ()),
+    "difficulty": (np.float64, ()),
+    "ntx": (np.uint32, ()),
+    "size": (np.uint32, ()),
+    "weight": (np.uint32, ()),
+    "chainwork": (np.uint64, (4,)),
+}
+
+BLOCK_COLUMNS = "height, time, mediantime, bits, difficulty, ntx, size, weight, chainwork"
+
+# Blocks per day at the 10 minute target spacing; the default window of the
+# rolling statistics.
+BLOCKS_PER_DAY = 144
+
+MIN_CAPACITY = 4096
+MAX_TARGET_DIFFICULTY_1 = 0xFFFF * 256.0 ** (0x1D - 3)
+
+
+def default_path(db_path):
+    return db_path + ".headers"
+
+
+def chainwork_limbs(chainwork_hex):
+    value = int(chainwork_hex, 16)
+    return [(value >> (64 * i)) & 0xFFFFFFFFFFFFFFFF for i in range(4)]
+
+
+class HeaderStore:
+    """
+    Columnar copy of the block headers under `path`: one .npy file per
+    column, memory-mapped, plus meta.json with the number of rows in use
+    (max height + 1). The files grow by doubling, so appends are amortized
+    O(1) and the columns stay contiguous.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        self.count = 0
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.count = json.load(f)["count"]
+        self.columns = {}
+        for name, (dtype, shape) in COLUMNS.items():
+            file_path = os.path.join(path, f"{name}.npy")
+            if os.path.exists(file_path):
+                self.columns[name] = open_memmap(file_path, mode="r+")
+        if len(self.columns) != len(COLUMNS):
+            self.count = 0
+            self.allocate(MIN_CAPACITY)
+
+    @property
+    def capacity(self):
+        return len(self.columns["height"])
+
+    def allocate(self, capacity):
+        """
+        Creates (or grows) every column file to `capacity` rows, keeping the
+        rows in use.
+        """
+        for name, (dtype, shape) in COLUMNS.items():
+            file_path = os.path.join(self.path, f"{name}.npy")
+            column = open_memmap(file_path + ".tmp", mode="w+", dtype=dtype, shape=(capacity,) + shape)
+            column[:] = -1 if name == "height" else 0
+            old = self.columns.get(name)
+            if old is not None:
+                column[:self.count] = old[:self.count]
+                del old
+            column.flush()
+            os.replace(file_path + ".tmp", file_path)
+            self.columns[name] = column
+
+    def __getitem__(self, name):
+        """
+        The rows in use of a column, as a memory-mapped array.
+        """
+        return self.columns[name][:self.count]
+
+    def write(self, rows):
+        """
+        Stores block table rows (in BLOCK_COLUMNS order) at their heights.
+        """
+        if not rows:
+            return
+        heights = np.array([row[0] for row in rows], dtype=np.int64)
+        end = int(heights.max()) + 1
+        if end > self.capacity:
+            self.allocate(max(MIN_CAPACITY, 1 << (end - 1).bit_length()))
+        values = list(zip(*rows))
+        for i, name in enumerate(["height", "time", "mediantime"]):
+            self.columns[name][heights] = values[i]
+        self.columns["bits"][heights] = [int(bits, 16) for bits in values[3]]
+        for i, name in enumerate(["difficulty", "ntx", "size", "weight"], start=4):
+            self.columns[name][heights] = values[i]
+        self.columns["chainwork"][heights] = np.array([chainwork_limbs(c) for c in values[8]], dtype=np.uint64)
+        self.count = max(self.count, end)
+
+    def contiguous_start(self):
+        """
+        The lowest height from which every row up to the tip is stored. A
+        partial import (--start-height, or a store synced from such a
+        database) leaves holes below it, and statistics across a hole would
+        treat the missing blocks as one long interval.
+        """
+        missing = np.flatnonzero(self["height"] < 0)
+        return int(missing[-1]) + 1 if len(missing) else 0
+
+    def truncate(self, count):
+        """
+        Forgets every row at or above height `count`.
+        """
+        if count < self.count:
+            self.columns["height"][count:self.count] = -1
+            self.count = count
+
+    def flush(self):
+        """
+        Writes the columns back to their files, then the row count.
+        """
+        for column in self.columns.values():
+            column.flush()
+        meta_path = os.path.join(self.path, "meta.json")
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"count": self.count}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def sync(self, conn, chunk_size=50_000):
+        """
+        Makes the store match the block table: drops rows above the stored
+        tip and copies the blocks the store does not have yet. Returns the
+        number of rows copied.
+        """
+        block_table = STORAGE_TABLES[hash_storage(conn)]["block"]
+        tip = conn.execute(f"SELECT MAX(height) FROM {block_table}").fetchone()[0]
+        self.truncate(0 if tip is None else tip + 1)
+        copied = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT {BLOCK_COLUMNS} FROM {block_table} WHERE height >= ? ORDER BY height LIMIT ?",
+                (self.count, chunk_size)
+            ).fetchall()
+            if not rows:
+                break
+            self.write(rows)
+            copied += len(rows)
+        self.flush()
+        return copied
+
+
+class HeaderStoreWriter:
+    """
+    BlockWriter extension that copies each committed block's header into
+    the HeaderStore next to the database. The rows are written from the
+    block table just before the commit; if the commit fails they are
+    truncated again, and a store that still ended up out of step (e.g. after
+    a crash) is resynchronized from the block table when it is opened.
+    """
+
+    def __init__(self, conn, path=None):
+        db_path = database_file(conn)
+        if not path and not db_path:
+            raise ValueError("An in-memory or temporary database needs an explicit header store path.")
+        self.store = HeaderStore(path or default_path(db_path))
+        self.block_table = STORAGE_TABLES[hash_storage(conn)]["block"]
+        copied = self.store.sync(conn)
+        if copied:
+            print(f"Header store: copied {copied} headers from the block table.")
+        self.restore_count = None
+        self.discard()
+
+    def discard(self):
+        if self.restore_count is not None:
+            self.store.truncate(self.restore_count)
+            self.store.flush()
+            self.restore_count = None
+        self.first = self.last = None
+
+    def add_rows(self, height, input_rows, output_rows):
+        self.restore_count = None
+        self.first = height if self.first is None else min(self.first, height)
+        self.last = height if self.last is None else max(self.last, height)
+
+    def flush(self, cursor, height):
+        if self.first is None:
+            return
+        rows = cursor.execute(
+            f"SELECT {BLOCK_COLUMNS} FROM {self.block_table} WHERE height BETWEEN ? AND ?",
+            (self.first, self.last)
+        ).fetchall()
+        self.restore_count = self.store.count
+        self.store.write(rows)
+        self.store.flush()
+        self.first = self.last = None
+
+    def rollback(self, cursor, fork_height):
+        self.first = self.last = None
+        self.store.truncate(fork_height + 1)
+        self.store.flush()
+
+    def report(self):
+        return f"Header store: {self.store.count} heights"
+
+
+def difficulty_from_bits(bits):
+    """
+    Difficulty encoded by compact `bits` values (array of uint32).
+    """
+    bits = np.asarray(bits, dtype=np.uint32)
+    exponent = (bits >> 24).astype(np.float64)
+    mantissa = (bits & 0xFFFFFF).astype(np.float64)
+    return MAX_TARGET_DIFFICULTY_1 / (mantissa * np.power(256.0, exponent - 3))
+
+
+def block_work(bits):
+    """
+    Expected hashes per block, 2**256 / (target + 1), as float64.
+    """
+    bits = np.asarray(bits, dtype=np.uint32)
+    exponent = (bits >> 24).astype(np.float64)
+    mantissa = (bits & 0xFFFFFF).astype(np.float64)
+    return 2.0 ** 256 / (mantissa * np.power(256.0, exponent - 3) + 1)
+
+
+def cumulative_work(bits, start_work=0.0):
+    """
+    Chainwork after every block, as float64, starting from `start_work`
+    (the chainwork before the first block given).
+    """
+    return start_work + np.cumsum(block_work(bits))
+
+
+def chainwork_to_float(limbs):
+    """
+    The stored uint64 limbs of chainwork as float64 values.
+    """
+    limbs = np.asarray(limbs, dtype=np.uint64).astype(np.float64)
+    return limbs @ (2.0 ** (64 * np.arange(4)))
+
+
+def interval_stats(times):
+    """
+    Summary of the seconds between consecutive blocks.
+    """
+    intervals = np.diff(np.asarray(times, dtype=np.int64))
+    if not len(intervals):
+        return None
+    return {
+        "blocks": len(intervals),
+        "mean": float(intervals.mean()),
+        "median": float(np.median(intervals)),
+        "std": float(intervals.std()),
+        "p90": float(np.percentile(intervals, 90)),
+        "min": int(intervals.min()),
+        "max": int(intervals.max()),
+    }
+
+
+def rolling_hashrate(times, bits, window=BLOCKS_PER_DAY):
+    """
+    Estimated hashes per second over the `window` blocks ending at each
+    height (like getnetworkhashps): the work of those blocks divided by the
+    time they took. The first `window` entries are NaN.
+    """
+    work = np.concatenate(([0.0], np.cumsum(block_work(bits))))
+    times = np.asarray(times, dtype=np.float64)
+    rates = np.full(len(times), np.nan)
+    if len(times) > window:
+        spans = times[window:] - times[:-window]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates[window:] = np.where(spans > 0, (work[window + 1:] - work[1:-window]) / spans, np.nan)
+    return rates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Block interval and hashrate statistics from the header store")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--window", type=int, default=BLOCKS_PER_DAY, help="blocks per statistics window")
+    parser.add_argument("--sync", action="store_true", help="copy missing headers from the database first")
+    args = parser.parse_args(argv)
+
+    store = HeaderStore(default_path(args.db))
+    if args.sync:
+        conn = connect(args.db, "serve")
+        try:
+            print(f"Copied {store.sync(conn)} headers.")
+        finally:
+            conn.close()
+    start = store.contiguous_start()
+    times, bits = store["time"][start:], store["bits"][start:]
+    started = perf_counter()
+    stats = interval_stats(times[-args.window - 1:])
+    hashrate = rolling_hashrate(times, bits, args.window)
+    elapsed = perf_counter() - started
+    print(f"{len(times)} contiguous headers from height {start}, tip height {store.count - 1}")
+    if stats:
+        print(f"Last {stats['blocks']} intervals: mean {stats['mean']:.0f}s, median {stats['median']:.0f}s, "
+              f"p90 {stats['p90']:.0f}s, max {stats['max']}s")
+        print(f"Hashrate over the last {args.window} blocks: {hashrate[-1] / 1e18:.2f} EH/s")
+    print(f"Computed in {elapsed * 1e6:.0f} µs.")
+
+
+if __name__ == "__main__":
+    main()
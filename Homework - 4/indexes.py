@@ -0,0 +1,164 @@
+import argparse
+import sqlite3
+from contextlib import contextmanager
+from time import perf_counter
+
+from db_connection import STORAGE_TABLES, connect, hash_storage
+
+# The secondary indexes of blockchain.db, as (name suffix, table, columns,
+# unique). Index names follow schema.sql: idx_<storage table>_<suffix>.
+# The unique ones also make re-ingesting a block a no-op (INSERT OR IGNORE),
+# so tip following must never run without them; bulk loads drop the set
+# (except BULK_LOAD_KEPT), insert without index maintenance, and rebuild it
+# once at the end.
+MANAGED_INDEXES = [
+    ("hash", "block", "hash", True),
+    ("height", "block", "height", False),
+    ("block_hash", "transactions", "block_hash", False),
+    ("txid", "tx_input", "txid, input_index", True),
+    ("prev", "tx_input", "prev_txid, prev_vout", False),
+    ("txid", "tx_output", "txid, output_index", True),
+    ("height", "utxo", "height", False),
+    ("script", "utxo", "script_pubkey", False),
+    ("address", "address_activity", "address, height", False),
+    ("height", "address_activity", "height", False),
+    ("height", "tx_fee", "height", False),
+]
+
+# (name suffix, table) of the indexes a bulk load keeps: the rollups and the
+# header store read the blocks of each commit back by height, which would be
+# a full scan of the block table per commit without it. It is small.
+BULK_LOAD_KEPT = {("height", "block")}
+
+# ANALYZE samples at most this many rows per index, which keeps it to
+# seconds on a full-chain database while giving the planner good estimates.
+ANALYSIS_LIMIT = 1000
+
+
+def managed_indexes(conn):
+    """
+    Returns (name, table, columns, unique) for every managed index, with the
+    table names of the database's hash storage mode.
+    """
+    tables = STORAGE_TABLES[hash_storage(conn)]
+    return [
+        (f"idx_{tables[table]}_{suffix}", tables[table], columns, unique)
+        for suffix, table, columns, unique in MANAGED_INDEXES
+    ]
+
+
+def missing_indexes(conn):
+    """
+    The managed indexes that do not exist, skipping tables that have not
+    been created yet (the derived tables are created by their first writer).
+    """
+    names = {row[0]: row[1] for row in conn.execute("SELECT name, type FROM sqlite_master")}
+    return [index for index in managed_indexes(conn) if index[0] not in names and names.get(index[1]) == "table"]
+
+
+def drop_indexes(conn):
+    """
+    Drops every managed index except BULK_LOAD_KEPT. Returns the names
+    dropped.
+    """
+    tables = STORAGE_TABLES[hash_storage(conn)]
+    kept = {f"idx_{tables[table]}_{suffix}" for suffix, table in BULK_LOAD_KEPT}
+    dropped = []
+    missing = {index[0] for index in missing_indexes(conn)}
+    for name, _, _, _ in managed_indexes(conn):
+        if name not in missing and name not in kept:
+            conn.execute(f"DROP INDEX {name}")
+            dropped.append(name)
+    conn.commit()
+    if dropped:
+        print(f"Dropped {len(dropped)} indexes for the bulk load.")
+    return dropped
+
+
+def create_indexes(conn, analyze_after=True):
+    """
+    Creates the managed indexes that are missing. If a unique index cannot
+    be built because part of a bulk load was re-run while it was absent, the
+    duplicate rows are removed (keeping the oldest) and the build is retried.
+    Returns the names created.
+    """
+    created = []
+    for name, table, columns, unique in missing_indexes(conn):
+        started = perf_counter()
+        create_sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table}({columns})"
+        try:
+            conn.execute(create_sql)
+        except sqlite3.IntegrityError:
+            removed = conn.execute(f"""
+                DELETE FROM {table} WHERE rowid NOT IN (
+                    SELECT MIN(rowid) FROM {table} GROUP BY {columns}
+                )
+            """).rowcount
+            print(f"Removed {removed} duplicate rows from {table}.")
+            conn.execute(create_sql)
+        conn.commit()
+        created.append(name)
+        print(f"Built index {name} in {perf_counter() - started:.1f}s.")
+    if created and analyze_after:
+        analyze(conn)
+    return created
+
+
+def analyze(conn):
+    """
+    Refreshes the planner statistics (sqlite_stat1).
+    """
+    started = perf_counter()
+    conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE")
+    conn.commit()
+    print(f"ANALYZE finished in {perf_counter() - started:.1f}s.")
+
+
+@contextmanager
+def deferred_indexes(conn, enabled=True):
+    """
+    Drops the managed indexes for the duration of a bulk load and rebuilds
+    them (followed by ANALYZE) when it ends, also after an error or Ctrl-C,
+    so the database is never left for the tip follower without them.
+    """
+    if not enabled:
+        yield
+        return
+    drop_indexes(conn)
+    try:
+        yield
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        print("Rebuilding indexes...")
+        create_indexes(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the secondary indexes of blockchain.db")
+    parser.add_argument("--db", default="blockchain.db")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--rebuild", action="store_true", help="create missing indexes, then ANALYZE")
+    action.add_argument("--drop", action="store_true", help="drop the managed indexes before a bulk load")
+    action.add_argument("--analyze", action="store_true", help="only refresh planner statistics")
+    args = parser.parse_args(argv)
+
+    conn = connect(args.db, "ingest")
+    try:
+        if args.rebuild:
+            create_indexes(conn)
+        elif args.drop:
+            drop_indexes(conn)
+        elif args.analyze:
+            analyze(conn)
+        missing = {index[0] for index in missing_indexes(conn)}
+        for name, table, columns, unique in managed_indexes(conn):
+            state = "missing" if name in missing else "present"
+            print(f"{name:32} {table}({columns}){' UNIQUE' if unique else ''}: {state}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import json
+import re
+from decimal import Decimal
+
+# Incremental reader for getblock verbosity=2 replies. A block of a few MB
+# serializes to tens of MB of JSON and many more of Python objects, so
+# instead of json.loads on the whole body this scans the byte stream, keeps
+# only the JSON of the current transaction in memory and decodes the
+# transactions one at a time.
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+_STRUCTURAL = re.compile(rb'["{}\[\]]')
+_WHITESPACE = b" \t\r\n"
+_SCALAR_END = b",}] \t\r\n"
+
+
+class JSONByteStream:
+    """
+    A cursor over JSON text arriving as an iterable of byte chunks. Only the
+    bytes of the value being read are buffered; everything before the
+    cursor is dropped when more data is pulled in.
+    """
+
+    def __init__(self, chunks, parse_float=Decimal):
+        self.chunks = iter(chunks)
+        self.parse_float = parse_float
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Drops the consumed bytes, appends the next chunk and returns how many
+        bytes the buffer shifted by (so callers can adjust their offsets).
+        Raises ValueError at the end of the stream.
+        """
+        if self.eof:
+            raise ValueError("Unexpected end of JSON stream")
+        shift = self.pos
+        del self.buf[:shift]
+        self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += chunk
+                return shift
+        self.eof = True
+        return shift
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next byte as a one-byte bytes object.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return bytes(self.buf[self.pos:self.pos + 1])
+            self._fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, found {found!r}")
+        self.pos += 1
+
+    def _value_end(self):
+        """
+        Returns the buffer offset just past the JSON value at the cursor,
+        reading more chunks as needed.
+        """
+        start = self.pos
+        first = self.buf[start:start + 1]
+        if first not in (b"{", b"[", b'"'):
+            # Numbers, true, false, null: run until a delimiter.
+            end = start
+            while True:
+                while end < len(self.buf) and self.buf[end] not in _SCALAR_END:
+                    end += 1
+                if end < len(self.buf):
+                    return end
+                try:
+                    end -= self._fill()
+                except ValueError:
+                    return end
+
+        depth, in_string, i = 0, False, start
+        while True:
+            if in_string:
+                quote = self.buf.find(b'"', i)
+                if quote >= 0:
+                    backslashes = 0
+                    while self.buf[quote - 1 - backslashes] == 0x5c:
+                        backslashes += 1
+                    i = quote + 1
+                    if backslashes % 2 == 0:
+                        in_string = False
+                        if depth == 0:
+                            return i
+                    continue
+            else:
+                match = _STRUCTURAL.search(self.buf, i)
+                if match:
+                    char, i = match.group(), match.end()
+                    if char == b'"':
+                        in_string = True
+                    elif char in (b"{", b"["):
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            return i
+                    continue
+            i = len(self.buf) - self._fill()
+
+    def read_value(self):
+        """
+        Decodes and returns the JSON value at the cursor.
+        """
+        self.peek()
+        end = self._value_end()
+        value = json.loads(bytes(self.buf[self.pos:end]), parse_float=self.parse_float)
+        self.pos = end
+        return value
+
+    def iter_keys(self):
+        """
+        Iterates over the keys of the object at the cursor. After each key
+        the cursor sits on its value, which the caller must consume (with
+        read_value, or by descending into it) before asking for the next key.
+        """
+        self.expect(b"{")
+        if self.peek() == b"}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(b":")
+            yield key
+            separator = self.peek()
+            self.pos += 1
+            if separator == b"}":
+                return
+            if separator != b",":
+                raise ValueError(f"Expected ',' or '}}' in JSON stream, found {separator!r}")
+
+    def iter_array(self):
+        """
+        Yields the decoded elements of the array at the cursor one by one.
+        """
+        self.expect(b"[")
+        if self.peek() == b"]":
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == b"]":
+                return
+            if separator != b",":
+                raise ValueError(f"Expected ',' or ']' in JSON stream, found {separator!r}")
+
+
+class StreamedBlock:
+    """
+    A getblock verbosity=2 reply that is decoded while it is read.
+    transactions() yields the entries of "tx" one at a time; every other
+    field of the result ends up in `header`, which is complete once the
+    iteration has finished. bitcoind sends the header fields before "tx", so
+    they are normally available as soon as the first transaction arrives.
+    A JSON-RPC error is stored in `error` and no transactions are yielded.
+    """
+
+    def __init__(self, chunks, parse_float=Decimal, on_close=None):
+        self.stream = JSONByteStream(chunks, parse_float)
+        self.on_close = on_close
+        self.header = {}
+        self.error = None
+        self.tx_count = 0
+
+    def transactions(self):
+        try:
+            for key in self.stream.iter_keys():
+                if key == "result" and self.stream.peek() == b"{":
+                    for field in self.stream.iter_keys():
+                        if field == "tx":
+                            for tx in self.stream.iter_array():
+                                self.tx_count += 1
+                                yield tx
+                        else:
+                            self.header[field] = self.stream.read_value()
+                elif key == "error":
+                    self.error = self.stream.read_value()
+                else:
+                    self.stream.read_value()
+        finally:
+            if self.on_close:
+                self.on_close()
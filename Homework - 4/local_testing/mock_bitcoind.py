@@ -0,0 +1,862 @@
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The ingestion modules live one directory up.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from address_index import script_to_address
+from raw_block import bits_to_difficulty, double_sha256, hash_to_hex, parse_transaction, read_varint
+
+# Stand-in for bitcoind's JSON-RPC interface, serving either a deterministic
+# synthetic chain or blocks recorded from a real node. Every block is kept in
+# its serialized form and the verbose replies are derived from those bytes,
+# so getblock at verbosity 0, 1 and 2, getblockheader and the REST endpoint
+# always describe the same chain. Latency, errors and reorgs can be injected
+# to exercise and benchmark the ingestion code reproducibly.
+
+SUBSIDY_HALVING_INTERVAL = 210_000
+INITIAL_SUBSIDY_SAT = 50 * 100_000_000
+TARGET_SPACING = 600
+GENESIS_TIME = 1231006505
+# Difficulty 1, as on mainnet's first blocks. Proof of work is not checked.
+DEFAULT_BITS = 0x1D00FFFF
+BLOCK_VERSION = 0x20000000
+WITNESS_COMMITMENT_PREFIX = bytes.fromhex("6a24aa21a9ed")
+
+# Replies of getblock/getblockheader kept already encoded, keyed by block,
+# verbosity and tip (confirmations and nextblockhash depend on the tip).
+REPLY_CACHE_SIZE = 256
+
+OUTPUT_SCRIPTS = [
+    ("pubkeyhash", "76a914", 20, "88ac"),
+    ("scripthash", "a914", 20, "87"),
+    ("witness_v0_keyhash", "0014", 20, ""),
+    ("witness_v0_scripthash", "0020", 32, ""),
+    ("witness_v1_taproot", "5120", 32, ""),
+]
+
+
+def varint(n):
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b"\xfd" + struct.pack("<H", n)
+    if n <= 0xffffffff:
+        return b"\xfe" + struct.pack("<I", n)
+    return b"\xff" + struct.pack("<Q", n)
+
+
+def push(data):
+    return varint(len(data)) + data
+
+
+def script_number(n):
+    """
+    Minimal CScriptNum encoding of a non-negative integer, as BIP34 uses for
+    the height in the coinbase.
+    """
+    encoded = bytearray()
+    while n:
+        encoded.append(n & 0xff)
+        n >>= 8
+    if encoded and encoded[-1] & 0x80:
+        encoded.append(0)
+    return bytes(encoded)
+
+
+def script_type(script_hex):
+    """
+    The scriptPubKey "type" bitcoind reports, for the scripts generated here.
+    """
+    for kind, prefix, size, suffix in OUTPUT_SCRIPTS:
+        if len(script_hex) == len(prefix) + 2 * size + len(suffix) and script_hex.startswith(prefix) \
+                and script_hex.endswith(suffix):
+            return kind
+    return "nulldata" if script_hex.startswith("6a") else "nonstandard"
+
+
+def merkle_root(hashes):
+    level = list(hashes)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [double_sha256(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def serialize_transaction(inputs, outputs, witnesses=None, version=2, locktime=0):
+    """
+    Returns (serialized transaction, txid, wtxid) as bytes; hashes in
+    internal byte order. `inputs` are (prev txid, vout, scriptSig, sequence)
+    and `outputs` (value_sat, scriptPubKey).
+    """
+    body = varint(len(inputs))
+    for prev_txid, vout, script_sig, sequence in inputs:
+        body += prev_txid + struct.pack("<I", vout) + push(script_sig) + struct.pack("<I", sequence)
+    body += varint(len(outputs))
+    for value, script in outputs:
+        body += struct.pack("<Q", value) + push(script)
+    head, tail = struct.pack("<i", version), struct.pack("<I", locktime)
+    txid = double_sha256(head, body, tail)
+    if not witnesses:
+        return head + body + tail, txid, txid
+    witness = b"".join(varint(len(stack)) + b"".join(push(item) for item in stack) for stack in witnesses)
+    data = head + b"\x00\x01" + body + witness + tail
+    return data, txid, double_sha256(data)
+
+
+def block_subsidy(height):
+    halvings = height // SUBSIDY_HALVING_INTERVAL
+    return INITIAL_SUBSIDY_SAT >> halvings if halvings < 64 else 0
+
+
+def block_work(bits):
+    exponent, mantissa = bits >> 24, bits & 0x00ffffff
+    target = mantissa << (8 * (exponent - 3)) if exponent > 3 else mantissa >> (8 * (3 - exponent))
+    return (1 << 256) // (target + 1)
+
+
+class OutputPool:
+    """
+    The unspent outputs the synthetic transactions can spend, with O(1)
+    removal of a random or a given outpoint.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, outpoint, value):
+        self.entries[outpoint] = (value, len(self.keys))
+        self.keys.append(outpoint)
+
+    def remove(self, outpoint):
+        """
+        Removes an outpoint and returns its value, or None if it is unknown.
+        """
+        entry = self.entries.pop(outpoint, None)
+        if entry is None:
+            return None
+        value, position = entry
+        last = self.keys.pop()
+        if last != outpoint:
+            self.keys[position] = last
+            self.entries[last] = (self.entries[last][0], position)
+        return value
+
+    def pick(self, rng):
+        outpoint = self.keys[rng.randrange(len(self.keys))]
+        return outpoint, self.remove(outpoint)
+
+
+class BlockFactory:
+    """
+    Builds synthetic blocks: a segwit coinbase paying subsidy plus fees
+    (with a valid witness commitment) followed by transactions that spend
+    random earlier outputs, including ones created earlier in the same
+    block, into standard output scripts of every type. Each block depends
+    only on the seed, its branch, its height and the outputs available, so
+    a chain regenerates identically.
+    """
+
+    def __init__(self, seed=0, txs_per_block=10, outputs_per_tx=2, max_inputs=2, block_bytes=None,
+                 bits=DEFAULT_BITS):
+        self.seed = seed
+        self.txs_per_block = max(txs_per_block, 1)
+        self.outputs_per_tx = max(outputs_per_tx, 1)
+        self.max_inputs = max(max_inputs, 1)
+        self.block_bytes = block_bytes
+        self.bits = bits
+
+    def output_script(self, rng):
+        _, prefix, size, suffix = OUTPUT_SCRIPTS[rng.randrange(len(OUTPUT_SCRIPTS))]
+        return bytes.fromhex(prefix) + rng.randbytes(size) + bytes.fromhex(suffix)
+
+    def transaction(self, rng, pool):
+        spent = [pool.pick(rng) for _ in range(min(rng.randint(1, self.max_inputs), len(pool)))]
+        total = sum(value for _, value in spent)
+        estimated_vsize = 11 + 68 * len(spent) + 31 * self.outputs_per_tx
+        fee = min(rng.randint(1, 50) * estimated_vsize, total // 2)
+        available = total - fee
+        count = self.outputs_per_tx if available >= self.outputs_per_tx else 1
+        cuts = sorted(rng.randrange(available + 1) for _ in range(count - 1))
+        values = [b - a for a, b in zip([0] + cuts, cuts + [available])]
+        inputs = [(txid, vout, b"", 0xfffffffd) for (txid, vout), _ in spent]
+        witnesses = [[rng.randbytes(72), b"\x02" + rng.randbytes(32)] for _ in spent]
+        outputs = [(value, self.output_script(rng)) for value in values]
+        data, txid, wtxid = serialize_transaction(inputs, outputs, witnesses)
+        return data, txid, wtxid, fee, spent, values
+
+    def build(self, height, prev_hash, block_time, pool, branch=0):
+        """
+        Returns (serialized block, block info) for a block at `height` on
+        top of `prev_hash` (hex), spending from and adding to `pool`.
+        """
+        rng = random.Random(f"{self.seed}:{branch}:{height}")
+        txs, txids, wtxids, fees, spent = [], [], [], {}, []
+        created = []
+        size = 0
+        while len(pool) and (size < self.block_bytes if self.block_bytes else len(txs) + 1 < self.txs_per_block):
+            data, txid, wtxid, fee, tx_spent, values = self.transaction(rng, pool)
+            txs.append(data)
+            txids.append(txid)
+            wtxids.append(wtxid)
+            fees[hash_to_hex(txid)] = fee
+            spent.extend(tx_spent)
+            for n, value in enumerate(values):
+                pool.add((txid, n), value)
+                created.append((txid, n))
+            size += len(data)
+
+        reserved = bytes(32)
+        commitment = double_sha256(merkle_root([bytes(32)] + wtxids), reserved)
+        script_sig = push(script_number(height)) + push(rng.randbytes(4)) + b"/mock/"
+        reward = block_subsidy(height) + sum(fees.values())
+        coinbase, coinbase_txid, _ = serialize_transaction(
+            [(bytes(32), 0xffffffff, script_sig, 0xffffffff)],
+            [(reward, self.output_script(rng)), (0, WITNESS_COMMITMENT_PREFIX + commitment)],
+            [[reserved]]
+        )
+        txids.insert(0, coinbase_txid)
+        header = struct.pack("<i32s32sIII", BLOCK_VERSION, bytes.fromhex(prev_hash)[::-1] if prev_hash else bytes(32),
+                             merkle_root(txids), block_time, self.bits, rng.getrandbits(32))
+        data = header + varint(len(txs) + 1) + coinbase + b"".join(txs)
+        # Coinbase outputs become spendable from the next block on.
+        pool.add((coinbase_txid, 0), reward)
+        created.append((coinbase_txid, 0))
+        return data, {"txids": txids, "fees": fees, "spent": spent, "created": created}
+
+
+def replay_block(data, pool):
+    """
+    Applies a serialized block to `pool` transaction by transaction and
+    returns the block info MockChain keeps for it. Spent outputs the pool
+    does not know (e.g. from before a recording starts) are skipped.
+    """
+    mv = memoryview(data)
+    count, pos = read_varint(mv, 80)
+    txids, spent, created = [], [], []
+    for _ in range(count):
+        tx, pos, _ = parse_transaction(mv, pos)
+        txid = bytes.fromhex(tx["txid"])[::-1]
+        txids.append(txid)
+        for txin in tx["vin"]:
+            if "txid" in txin:
+                outpoint = (bytes.fromhex(txin["txid"])[::-1], txin["vout"])
+                value = pool.remove(outpoint)
+                if value is not None:
+                    spent.append((outpoint, value))
+        for txout in tx["vout"]:
+            pool.add((txid, txout["n"]), int(txout["value"].scaleb(8)))
+            created.append((txid, txout["n"]))
+    return {"txids": txids, "fees": {}, "spent": spent, "created": created}
+
+
+class MockChain:
+    """
+    The active chain (blocks from `base_height` up) plus blocks orphaned by
+    reorgs, with everything getblock and getblockheader report. New blocks
+    are always synthetic; the chain itself is synthetic() or load()-ed from
+    a recorded fixture.
+    """
+
+    def __init__(self, factory=None, network="main"):
+        self.factory = factory or BlockFactory()
+        self.network = network
+        self.blocks = []
+        self.by_hash = {}
+        self.tx_index = {}
+        self.pool = OutputPool()
+        self.base_height = 0
+        self.branch = 0
+
+    @classmethod
+    def synthetic(cls, length, network="main", **factory_options):
+        chain = cls(BlockFactory(**factory_options), network)
+        chain.mine(length)
+        return chain
+
+    @classmethod
+    def load(cls, path, **factory_options):
+        """
+        Loads a fixture written by save() or record_fixture().
+        """
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            fixture = json.load(f)
+        chain = cls(BlockFactory(**factory_options), fixture.get("network", "main"))
+        chain.base_height = fixture["blocks"][0]["height"] if fixture["blocks"] else 0
+        for block in fixture["blocks"]:
+            data = bytes.fromhex(block["hex"])
+            info = replay_block(data, chain.pool)
+            info["fees"] = block.get("fees", {})
+            chain.append(data, info, mediantime=block.get("mediantime"), chainwork=block.get("chainwork"))
+        return chain
+
+    def save(self, path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt") as f:
+            json.dump({
+                "network": self.network,
+                "blocks": [{"height": b["height"], "hex": b["data"].hex(), "mediantime": b["mediantime"],
+                            "chainwork": f"{b['chainwork']:064x}", "fees": b["fees"]} for b in self.blocks]
+            }, f)
+
+    @property
+    def tip(self):
+        return self.blocks[-1] if self.blocks else None
+
+    @property
+    def height(self):
+        return self.base_height + len(self.blocks) - 1
+
+    def at(self, height):
+        index = height - self.base_height
+        return self.blocks[index] if 0 <= index < len(self.blocks) else None
+
+    def append(self, data, info, mediantime=None, chainwork=None):
+        version, prev, _, block_time, bits, _ = struct.unpack_from("<i32s32sIII", data)
+        height = self.base_height + len(self.blocks)
+        times = sorted([b["time"] for b in self.blocks[-10:]] + [block_time])
+        work = block_work(bits)
+        block = {
+            "hash": hash_to_hex(double_sha256(data[:80])),
+            "height": height,
+            "data": data,
+            "time": block_time,
+            "bits": bits,
+            "mediantime": mediantime or times[len(times) // 2],
+            "chainwork": int(chainwork, 16) if chainwork else (self.tip["chainwork"] if self.tip else 0) + work,
+            "txids": [hash_to_hex(txid) for txid in info["txids"]],
+            "fees": info["fees"],
+            "spent": info["spent"],
+            "created": info["created"],
+        }
+        self.blocks.append(block)
+        self.by_hash[block["hash"]] = block
+        for index, txid in enumerate(block["txids"]):
+            self.tx_index[txid] = (block["hash"], index)
+        return block
+
+    def next_block(self, pool=None):
+        """
+        Builds the block that would be mined next. It spends from `pool`,
+        or, without one, from a copy of the chain's outputs so the chain is
+        left unchanged.
+        """
+        if pool is None:
+            pool = OutputPool()
+            pool.keys, pool.entries = list(self.pool.keys), dict(self.pool.entries)
+        tip = self.tip
+        height = self.height + 1
+        block_time = (tip["time"] if tip else GENESIS_TIME - TARGET_SPACING) + TARGET_SPACING
+        block_time += random.Random(f"{self.factory.seed}:time:{height}").randint(-300, 300)
+        return self.factory.build(height, tip["hash"] if tip else None, block_time, pool, self.branch)
+
+    def mine(self, count=1):
+        """
+        Appends `count` synthetic blocks and returns the new tip.
+        """
+        for _ in range(count):
+            self.append(*self.next_block(self.pool))
+        return self.tip
+
+    def reorg(self, depth, length=None):
+        """
+        Replaces the top `depth` blocks with a competing synthetic branch of
+        `length` blocks (default depth + 1, so the branch has more work).
+        The orphaned blocks stay queryable by hash. Returns the fork height.
+        """
+        depth = min(depth, len(self.blocks) - 1)
+        fork_height = self.height - depth
+        for block in reversed(self.blocks[len(self.blocks) - depth:]):
+            created = set(block["created"])
+            for outpoint in created:
+                self.pool.remove(outpoint)
+            for outpoint, value in block["spent"]:
+                if outpoint not in created:
+                    self.pool.add(outpoint, value)
+            for txid in block["txids"]:
+                self.tx_index.pop(txid, None)
+            block["orphaned"] = True
+        del self.blocks[len(self.blocks) - depth:]
+        self.branch += 1
+        self.mine(depth + 1 if length is None else length)
+        return fork_height
+
+    def header(self, block):
+        """
+        getblockheader (verbose) result for a block.
+        """
+        version, _, merkle, _, _, nonce = struct.unpack_from("<i32s32sIII", block["data"])
+        active = not block.get("orphaned")
+        next_block = self.at(block["height"] + 1) if active else None
+        header = {
+            "hash": block["hash"],
+            "confirmations": self.height - block["height"] + 1 if active else -1,
+            "height": block["height"],
+            "version": version,
+            "versionHex": f"{version & 0xffffffff:08x}",
+            "merkleroot": hash_to_hex(merkle),
+            "time": block["time"],
+            "mediantime": block["mediantime"],
+            "nonce": nonce,
+            "bits": f"{block['bits']:08x}",
+            "difficulty": bits_to_difficulty(block["bits"]),
+            "chainwork": f"{block['chainwork']:064x}",
+            "nTx": len(block["txids"]),
+        }
+        prev_hash = hash_to_hex(block["data"][4:36])
+        if prev_hash != "00" * 32:
+            header["previousblockhash"] = prev_hash
+        if next_block is not None:
+            header["nextblockhash"] = next_block["hash"]
+        return header
+
+    def transaction(self, tx, block, tx_hex=None):
+        """
+        Adds what bitcoind reports beyond the raw_block decoding: output
+        types and addresses, the fee and, optionally, the hex.
+        """
+        for txout in tx["vout"]:
+            script = txout["scriptPubKey"]
+            txout["value"] = float(txout["value"])
+            script["type"] = script_type(script["hex"])
+            address = script_to_address(script["hex"], self.network)
+            if address:
+                script["address"] = address
+        fee = block["fees"].get(tx["txid"])
+        if fee is not None:
+            tx["fee"] = fee / 100_000_000
+        if tx_hex is not None:
+            tx["hex"] = tx_hex
+        return tx
+
+    def verbose_block(self, block, verbosity):
+        """
+        getblock result at verbosity 1 (txids) or 2 (decoded transactions).
+        """
+        data = block["data"]
+        result = self.header(block)
+        base_size = 80 + len(varint(len(block["txids"])))
+        txs = []
+        mv = memoryview(data)
+        pos = 80 + len(varint(len(block["txids"])))
+        for _ in block["txids"]:
+            start = pos
+            tx, pos, tx_base_size = parse_transaction(mv, pos)
+            base_size += tx_base_size
+            if verbosity >= 2:
+                txs.append(self.transaction(tx, block, data[start:pos].hex()))
+        result["strippedsize"] = base_size
+        result["size"] = len(data)
+        result["weight"] = base_size * 3 + len(data)
+        result["tx"] = txs if verbosity >= 2 else list(block["txids"])
+        return result
+
+
+class RPCError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class MockBitcoindHandler(BaseHTTPRequestHandler):
+    """
+    Single and batched JSON-RPC over keep-alive HTTP/1.1, plus the REST
+    block endpoint, answered the way bitcoind answers them.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        status = server.before_request(self.headers.get("Authorization"))
+        if status is not None:
+            self.send_body(status, b"Work queue depth exceeded" if status == 503 else b"", "text/plain")
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_body(500, b'{"result":null,"error":{"code":-32700,"message":"Parse error"},"id":null}')
+            return
+        if isinstance(request, list):
+            replies = [server.reply(item)[1] for item in request]
+            self.send_body(200, ("[" + ",".join(replies) + "]").encode())
+        else:
+            status, reply = server.reply(request)
+            self.send_body(status, reply.encode())
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/rest/block/") and self.path.endswith(".bin"):
+            status = server.before_request(None, authenticate=False)
+            if status is not None:
+                self.send_body(status, b"", "text/plain")
+                return
+            data = server.raw_block(self.path[len("/rest/block/"):-len(".bin")])
+            if data is None:
+                self.send_body(404, b"Block not found", "text/plain")
+            else:
+                self.send_body(200, data, "application/octet-stream")
+            return
+        self.send_body(404, b"", "text/plain")
+
+
+class MockBitcoind(ThreadingHTTPServer):
+    """
+    In-process bitcoind stand-in serving `chain` on 127.0.0.1:`port` (0 =
+    any free port). Implements getbestblockhash, getblockcount,
+    getblockhash, getblock (verbosity 0/1/2), getblockheader, getrawmempool,
+    getrawtransaction (as with txindex=1), waitfornewblock and
+    /rest/block/<hash>.bin.
+
+    Fault injection:
+      latency + uniform(0, jitter) seconds  delay before every HTTP request
+      error_rate                            fraction of requests answered
+                                            with HTTP 503, like a full
+                                            rpcworkqueue
+      fail_next(method, count)              the next `count` calls of a
+                                            method return an RPC error
+      mine(), reorg(), start_mining()       change the chain while clients
+                                            are connected
+    Setting rpc_user makes requests without matching basic auth get 401.
+    """
+    daemon_threads = True
+
+    def __init__(self, chain, port=0, host="127.0.0.1", latency=0.0, jitter=0.0, error_rate=0.0, seed=0,
+                 rpc_user=None, rpc_password=None):
+        super().__init__((host, port), MockBitcoindHandler)
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.auth = None
+        if rpc_user is not None:
+            self.auth = "Basic " + base64.b64encode(f"{rpc_user}:{rpc_password or ''}".encode()).decode()
+        self.failures = {}
+        self.calls = {}
+        self.changed = threading.Condition()
+        self.replies = OrderedDict()
+        self.mempool = None
+        self.miner = None
+        self.stop_mining = threading.Event()
+
+    # Chain changes; all of them wake waitfornewblock.
+
+    def mine(self, count=1):
+        with self.changed:
+            tip = self.chain.mine(count)
+            self.mempool = None
+            self.changed.notify_all()
+        return tip
+
+    def reorg(self, depth, length=None):
+        with self.changed:
+            fork_height = self.chain.reorg(depth, length)
+            self.mempool = None
+            self.changed.notify_all()
+        print(f"Mock bitcoind: reorg at height {fork_height}, new tip {self.chain.height}")
+        return fork_height
+
+    def start_mining(self, interval, reorg_every=None, reorg_depth=1):
+        """
+        Mines a block every `interval` seconds from a background thread and,
+        with `reorg_every`, replaces the top `reorg_depth` blocks instead on
+        every reorg_every-th round.
+        """
+        def run():
+            rounds = 0
+            while not self.stop_mining.wait(interval):
+                rounds += 1
+                if reorg_every and rounds % reorg_every == 0:
+                    self.reorg(reorg_depth)
+                else:
+                    self.mine()
+        self.miner = threading.Thread(target=run, daemon=True)
+        self.miner.start()
+
+    def fail_next(self, method, count=1, code=-1, message="Injected failure"):
+        with self.changed:
+            self.failures[method] = [count, code, message]
+
+    # Request handling.
+
+    def before_request(self, authorization, authenticate=True):
+        """
+        Applies the injected latency and errors; returns an HTTP status to
+        answer with instead of the request, or None.
+        """
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        if authenticate and self.auth is not None and authorization != self.auth:
+            return 401
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return 503
+        return None
+
+    def reply(self, request):
+        """
+        Returns (HTTP status, encoded JSON-RPC reply) for one request.
+        """
+        request_id = json.dumps(request.get("id"))
+        method, params = request.get("method"), request.get("params") or []
+        try:
+            result = self.call(method, params)
+        except RPCError as e:
+            error = json.dumps({"code": e.code, "message": e.message})
+            status = 404 if e.code == -32601 else 500
+            return status, f'{{"result":null,"error":{error},"id":{request_id}}}'
+        return 200, f'{{"result":{result},"error":null,"id":{request_id}}}'
+
+    def call(self, method, params):
+        """
+        Runs one RPC and returns its result encoded as JSON text.
+        """
+        handler = getattr(self, f"rpc_{method}", None)
+        if handler is None:
+            raise RPCError(-32601, "Method not found")
+        with self.changed:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            failure = self.failures.get(method)
+            if failure:
+                failure[0] -= 1
+                if failure[0] <= 0:
+                    del self.failures[method]
+                raise RPCError(failure[1], failure[2])
+        if method == "waitfornewblock":
+            return handler(*params)
+        with self.changed:
+            return handler(*params)
+
+    def cached(self, key, build):
+        """
+        Encoded reply for `key`, built once per chain tip.
+        """
+        key = key + (self.chain.tip["hash"],)
+        reply = self.replies.get(key)
+        if reply is None:
+            reply = self.replies[key] = json.dumps(build())
+            if len(self.replies) > REPLY_CACHE_SIZE:
+                self.replies.popitem(last=False)
+        else:
+            self.replies.move_to_end(key)
+        return reply
+
+    def find(self, block_hash):
+        block = self.chain.by_hash.get(block_hash)
+        if block is None:
+            raise RPCError(-5, "Block not found")
+        return block
+
+    def raw_block(self, block_hash):
+        with self.changed:
+            block = self.chain.by_hash.get(block_hash)
+            return None if block is None else block["data"]
+
+    def rpc_getbestblockhash(self):
+        return json.dumps(self.chain.tip["hash"])
+
+    def rpc_getblockcount(self):
+        return json.dumps(self.chain.height)
+
+    def rpc_getblockhash(self, height):
+        block = self.chain.at(height)
+        if block is None:
+            raise RPCError(-8, "Block height out of range")
+        return json.dumps(block["hash"])
+
+    def rpc_getblock(self, block_hash, verbosity=1):
+        block = self.find(block_hash)
+        if verbosity == 0:
+            return json.dumps(block["data"].hex())
+        return self.cached((block_hash, min(int(verbosity), 2)),
+                           lambda: self.chain.verbose_block(block, min(int(verbosity), 2)))
+
+    def rpc_getblockheader(self, block_hash, verbose=True):
+        block = self.find(block_hash)
+        if not verbose:
+            return json.dumps(block["data"][:80].hex())
+        return self.cached((block_hash, "header"), lambda: self.chain.header(block))
+
+    def rpc_getrawtransaction(self, txid, verbose=False, block_hash=None):
+        location = self.chain.tx_index.get(txid)
+        if location is None:
+            raise RPCError(-5, "No such mempool or blockchain transaction. Use gettransaction for wallet transactions.")
+        block = self.chain.by_hash[location[0]]
+        mv = memoryview(block["data"])
+        _, pos = read_varint(mv, 80)
+        for _ in range(location[1] + 1):
+            start = pos
+            tx, pos, _ = parse_transaction(mv, pos)
+        tx_hex = block["data"][start:pos].hex()
+        if not verbose:
+            return json.dumps(tx_hex)
+        tx = self.chain.transaction(tx, block, tx_hex)
+        tx.update({"blockhash": block["hash"], "confirmations": self.chain.height - block["height"] + 1,
+                   "time": block["time"], "blocktime": block["time"]})
+        return json.dumps(tx)
+
+    def rpc_getrawmempool(self, verbose=False, mempool_sequence=False):
+        """
+        The mempool is the set of transactions of the block that will be
+        mined next, so every txid listed here confirms in the next block.
+        """
+        if self.mempool is None:
+            data, info = self.chain.next_block()
+            mv = memoryview(data)
+            count, pos = read_varint(mv, 80)
+            entries = {}
+            for index in range(count):
+                tx, pos, _ = parse_transaction(mv, pos)
+                if index:
+                    entries[tx["txid"]] = {
+                        "vsize": tx["vsize"], "weight": tx["weight"], "time": self.chain.tip["time"],
+                        "height": self.chain.height, "fees": {"base": info["fees"][tx["txid"]] / 100_000_000},
+                    }
+            self.mempool = entries
+        if verbose:
+            return json.dumps(self.mempool)
+        return json.dumps(list(self.mempool))
+
+    def rpc_waitfornewblock(self, timeout=0):
+        """
+        Waits until the tip changes or `timeout` milliseconds pass (0 =
+        forever) and returns the tip.
+        """
+        deadline = time.monotonic() + timeout / 1000 if timeout else None
+        with self.changed:
+            tip = self.chain.tip["hash"]
+            while self.chain.tip["hash"] == tip:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining if remaining is not None else 1.0)
+            return json.dumps({"hash": self.chain.tip["hash"], "height": self.chain.height})
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.stop_mining.set()
+        if self.miner is not None:
+            self.miner.join()
+        self.shutdown()
+        self.server_close()
+
+    def environment(self):
+        """
+        The variables that point update_db.BitcoinRPC at this server.
+        """
+        host, port = self.server_address[:2]
+        return {"RPC_HOST": host, "RPC_PORT": str(port), "RPC_USERNAME": "mock", "RPC_PASSWORD": "mock"}
+
+
+def record_fixture(rpc, start_height, end_height, path, network="main"):
+    """
+    Saves blocks [start_height, end_height] of a real node (via an
+    update_db.BitcoinRPC) as a fixture for MockChain.load. Returns the
+    number of blocks saved.
+    """
+    blocks = []
+    for chunk_start in range(start_height, end_height + 1, 100):
+        chunk_end = min(chunk_start + 99, end_height)
+        hashes = rpc.get_block_hashes(chunk_start, chunk_end)
+        headers = rpc.get_block_headers(hashes)
+        raw = rpc.call_batch([("getblock", [block_hash, 0]) for block_hash in hashes])
+        for height, header, (block_hex, error) in zip(range(chunk_start, chunk_end + 1), headers, raw):
+            if header is None or error:
+                raise RuntimeError(f"Cannot record block {height}: {error}")
+            blocks.append({"height": height, "hex": block_hex, "mediantime": header["mediantime"],
+                           "chainwork": header["chainwork"]})
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt") as f:
+        json.dump({"network": network, "blocks": blocks}, f)
+    return len(blocks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for bitcoind's JSON-RPC interface")
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--fixture", help="serve blocks recorded with --record instead of a synthetic chain")
+    parser.add_argument("--blocks", type=int, default=200, help="length of the synthetic chain")
+    parser.add_argument("--txs-per-block", type=int, default=10, help="transactions per block, coinbase included")
+    parser.add_argument("--block-bytes", type=int, help="fill blocks up to this size instead of --txs-per-block")
+    parser.add_argument("--outputs-per-tx", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--network", default="main", choices=["main", "test", "testnet4", "signet", "regtest"])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--mine-interval", type=float, help="mine a block every this many seconds")
+    parser.add_argument("--reorg-every", type=int, help="with --mine-interval, reorg instead every N rounds")
+    parser.add_argument("--reorg-depth", type=int, default=1)
+    parser.add_argument("--record", metavar="PATH",
+                        help="record --from..--to from the node in RPC_HOST/RPC_PORT to a fixture and exit")
+    parser.add_argument("--from", dest="from_height", type=int, default=0)
+    parser.add_argument("--to", dest="to_height", type=int)
+    args = parser.parse_args(argv)
+
+    if args.record:
+        from update_db import BitcoinRPC
+        rpc = BitcoinRPC()
+        end = args.to_height if args.to_height is not None else rpc.call("getblockcount")
+        count = record_fixture(rpc, args.from_height, end, args.record, args.network)
+        print(f"Recorded {count} blocks to {args.record}.")
+        return
+
+    factory_options = {"seed": args.seed, "txs_per_block": args.txs_per_block,
+                       "outputs_per_tx": args.outputs_per_tx, "block_bytes": args.block_bytes}
+    started = time.perf_counter()
+    if args.fixture:
+        chain = MockChain.load(args.fixture, **factory_options)
+    else:
+        chain = MockChain.synthetic(args.blocks, network=args.network, **factory_options)
+    print(f"Chain ready in {time.perf_counter() - started:.1f}s: heights {chain.base_height}..{chain.height}, "
+          f"tip {chain.tip['hash']}")
+    server = MockBitcoind(chain, port=args.port, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, seed=args.seed)
+    if args.mine_interval:
+        server.start_mining(args.mine_interval, args.reorg_every, args.reorg_depth)
+    print("Serving on " + " ".join(f"{name}={value}" for name, value in server.environment().items()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_mining.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
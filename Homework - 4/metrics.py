@@ -0,0 +1,247 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+# Ingestion metrics, kept in process memory. Updating one is a dict lookup
+# and an addition under a lock, so instrumented code pays well under a
+# microsecond per event; the exporters only read them.
+
+# Latency buckets in seconds, from a cached getblockhash to a large getblock.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+    """
+    One named metric with a value per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def label_text(self, values, extra=""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{self.label_text(labels)} {value}" for labels, value in self.samples()]
+
+    def snapshot(self):
+        return {",".join(labels) or "total": value for labels, value in self.samples()}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            return [(labels, ([*counts], total, count)) for labels, (counts, total, count) in self.values.items()]
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, count) in self.samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket_labels = self.label_text(labels, 'le="' + str(bound) + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self.label_text(labels)} {total}")
+            lines.append(f"{self.name}_count{self.label_text(labels)} {count}")
+        return lines
+
+    def snapshot(self):
+        return {
+            ",".join(labels) or "total": {"count": count, "sum": total, "mean": total / count if count else 0.0}
+            for labels, (counts, total, count) in self.samples()
+        }
+
+
+REGISTRY = []
+
+RPC_SECONDS = Histogram("bitcoin_rpc_duration_seconds", "Bitcoin Core RPC round trip time", ("method",))
+RPC_ERRORS = Counter("bitcoin_rpc_errors_total", "Failed Bitcoin Core RPC calls", ("method",))
+BLOCKS_WRITTEN = Counter("ingest_blocks_total", "Blocks committed to the database")
+ROWS_WRITTEN = Counter("ingest_rows_total", "Rows inserted into the block tables", ("table",))
+COMMIT_SECONDS = Histogram("writer_commit_duration_seconds", "Time to write and commit one group of blocks")
+WRITER_PENDING = Gauge("writer_pending_blocks", "Decoded blocks buffered in the writer, not yet committed")
+QUEUE_DEPTH = Gauge("pipeline_queue_depth", "Items waiting between backfill pipeline stages", ("queue",))
+STAGE_BUSY = Counter("pipeline_stage_busy_seconds_total", "Time backfill pipeline stages spent working", ("stage",))
+COMMITTED_HEIGHT = Gauge("ingest_committed_height", "Height of the last committed block")
+NODE_HEIGHT = Gauge("node_tip_height", "Height of the node's chain tip when last asked")
+TIP_LAG_BLOCKS = Gauge("tip_lag_blocks", "Blocks the database is behind the node's tip")
+TIP_LAG_SECONDS = Gauge("tip_lag_seconds", "Block time difference between the node's tip and the last committed block")
+UTXO_CACHE_HITS = Counter("utxo_cache_hits_total", "Spends whose output was in the UTXO cache")
+UTXO_CACHE_MISSES = Counter("utxo_cache_misses_total", "Spends whose output was read from the utxo table")
+UTXO_CACHE_EVICTIONS = Counter("utxo_cache_evictions_total", "Unspent outputs evicted from the UTXO cache")
+UTXO_CACHE_ENTRIES = Gauge("utxo_cache_entries", "Outputs held in the UTXO cache")
+
+# Set by the exporters: lag in seconds needs an extra header lookup per sync
+# round, which is only done when somebody is reading the metrics.
+exporting = False
+
+_tip = {"committed": None, "committed_time": None, "node": None, "node_time": None}
+
+
+def _update_lag():
+    if _tip["committed"] is None or _tip["node"] is None:
+        return
+    TIP_LAG_BLOCKS.set(max(_tip["node"] - _tip["committed"], 0))
+    if _tip["committed_time"] is not None and _tip["node_time"] is not None:
+        lag = _tip["node_time"] - _tip["committed_time"] if _tip["node"] > _tip["committed"] else 0
+        TIP_LAG_SECONDS.set(max(lag, 0))
+
+
+def record_committed(height, block_time=None):
+    """
+    Called by the writer after each commit.
+    """
+    _tip["committed"], _tip["committed_time"] = height, block_time
+    COMMITTED_HEIGHT.set(height)
+    _update_lag()
+
+
+def record_node_tip(height, block_time=None):
+    """
+    Called when the ingester learns the node's tip height (and block time).
+    """
+    _tip["node"], _tip["node_time"] = height, block_time
+    NODE_HEIGHT.set(height)
+    _update_lag()
+
+
+def render_prometheus():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot(previous=None):
+    """
+    Every metric as a JSON-friendly dict. Given the previous snapshot, the
+    block and row counters are also turned into per-second rates.
+    """
+    data = {"time": time(), "metrics": {metric.name: metric.snapshot() for metric in REGISTRY}}
+    if previous:
+        elapsed = data["time"] - previous["time"]
+        rates = {}
+        for name in ("ingest_blocks_total", "ingest_rows_total"):
+            for key, value in data["metrics"][name].items():
+                before = previous["metrics"].get(name, {}).get(key, 0)
+                rates[f"{name}:{key}"] = (value - before) / elapsed if elapsed > 0 else 0.0
+        data["rates_per_second"] = rates
+    return data
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = render_prometheus().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    Serves /metrics (Prometheus) and /metrics.json from a daemon thread.
+    Returns the server; call shutdown() on it to stop.
+    """
+    global exporting
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    exporting = True
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class SnapshotWriter:
+    """
+    Writes a JSON snapshot to `path` every `interval` seconds from a daemon
+    thread, replacing the file atomically.
+    """
+
+    def __init__(self, path, interval=10.0):
+        global exporting
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.previous = None
+        self.write()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        exporting = True
+
+    def write(self):
+        self.previous = snapshot(self.previous)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.previous, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
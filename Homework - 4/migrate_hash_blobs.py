@@ -0,0 +1,184 @@
+import argparse
+import os
+import sqlite3
+from time import time
+
+from db_connection import connect, hash_storage
+
+# Converts a schema.sql database to the compact hash storage of
+# schema_blob.sql. Each table is copied into its *_bin counterpart in rowid
+# order, one chunk per transaction, with the hex hashes turned into 32-byte
+# BLOBs by the hash_blob() SQL function. The progress of every table is saved
+# in the same transaction as its chunk, so an interrupted run resumes where it
+# stopped. Finally the hex tables are dropped and replaced by the views of
+# schema_blob.sql in one transaction. Stop update_db.py while it runs.
+
+SCHEMA_BLOB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_blob.sql")
+
+# (source table, destination table, source columns, destination columns)
+COPIES = [
+    ("block", "block_bin",
+     "id, hash_blob(hash), confirmations, height, version, versionhex, hash_blob(merkleroot), time, "
+     "mediantime, nonce, bits, difficulty, chainwork, ntx, hash_blob(previousblockhash), "
+     "hash_blob(nextblockhash), strippedsize, size, weight",
+     "id, hash, confirmations, height, version, versionhex, merkleroot, time, mediantime, nonce, bits, "
+     "difficulty, chainwork, ntx, previousblockhash, nextblockhash, strippedsize, size, weight"),
+    ("transactions", "transactions_bin",
+     "hash_blob(txid), hash_blob(block_hash), version, locktime, size, weight",
+     "txid, block_hash, version, locktime, size, weight"),
+    ("tx_input", "tx_input_bin",
+     "id, hash_blob(txid), input_index, hash_blob(prev_txid), prev_vout, script_sig, sequence",
+     "id, txid, input_index, prev_txid, prev_vout, script_sig, sequence"),
+    ("tx_output_sat", "tx_output_bin",
+     "id, hash_blob(txid), output_index, value_sat, script_pubkey",
+     "id, txid, output_index, value_sat, script_pubkey"),
+    ("address_activity", "address_activity_bin",
+     "address, height, hash_blob(txid), delta_sat",
+     "address, height, txid, delta_sat"),
+    ("tx_fee", "tx_fee_bin",
+     "hash_blob(txid), height, fee_sat, vsize, feerate",
+     "txid, height, fee_sat, vsize, feerate"),
+]
+
+PROGRESS_SQL = """
+    CREATE TABLE IF NOT EXISTS hash_blob_migration (
+        source TEXT PRIMARY KEY,
+        last_rowid INTEGER NOT NULL
+    )
+"""
+
+
+def schema_statements(path=SCHEMA_BLOB_PATH):
+    """
+    Splits schema_blob.sql into its individual statements.
+    """
+    statements, current = [], ""
+    with open(path) as f:
+        for line in f:
+            if not current and (not line.strip() or line.lstrip().startswith("--")):
+                continue
+            current += line
+            if sqlite3.complete_statement(current):
+                statements.append(current.strip())
+                current = ""
+    return statements
+
+
+def copy_table(conn, source, destination, source_columns, destination_columns, chunk_size):
+    """
+    Copies `source` into `destination` chunk by chunk, resuming after the
+    last rowid recorded in hash_blob_migration. Returns the rows copied.
+    """
+    row = conn.execute("SELECT last_rowid FROM hash_blob_migration WHERE source = ?", (source,)).fetchone()
+    last_rowid = row[0] if row else 0
+    total = conn.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+    copied = 0
+    while True:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            end = cursor.execute(
+                f"SELECT MAX(rowid) FROM (SELECT rowid FROM {source} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last_rowid, chunk_size)
+            ).fetchone()[0]
+            if end is None:
+                conn.rollback()
+                break
+            cursor.execute(
+                f"INSERT OR IGNORE INTO {destination} ({destination_columns}) "
+                f"SELECT {source_columns} FROM {source} WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+                (last_rowid, end)
+            )
+            copied += cursor.rowcount
+            cursor.execute(
+                "INSERT INTO hash_blob_migration (source, last_rowid) VALUES (?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET last_rowid = excluded.last_rowid",
+                (source, end)
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        last_rowid = end
+        print(f"{source}: copied up to rowid {end} ({total} rows in total).")
+    return copied
+
+
+def migrate(db_path, chunk_size=100_000, vacuum=False, profile="bulk-ingest"):
+    """
+    Converts `db_path` to BLOB hash storage. With `vacuum` the file is
+    rebuilt afterwards so the freed pages are returned to the filesystem.
+    Returns the number of rows copied by this run.
+    """
+    conn = connect(db_path, profile)
+    started = time()
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(db_path)
+        if hash_storage(conn) == "blob" and conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'hash_blob_migration'").fetchone() is None:
+            print("Hashes are already stored as BLOBs; nothing to migrate.")
+            return 0
+        kinds = dict(conn.execute("SELECT name, type FROM sqlite_master"))
+        if kinds.get("tx_output") == "table":
+            raise RuntimeError("Run migrate_satoshis.py first: tx_output still stores REAL amounts.")
+
+        statements = schema_statements()
+        conn.execute(PROGRESS_SQL)
+        for statement in statements:
+            if statement.startswith(("CREATE TABLE", "CREATE UNIQUE INDEX", "CREATE INDEX")):
+                conn.execute(statement)
+        conn.commit()
+
+        copied = 0
+        for source, destination, source_columns, destination_columns in COPIES:
+            if kinds.get(source) == "table":
+                copied += copy_table(conn, source, destination, source_columns, destination_columns, chunk_size)
+
+        # Swap the hex tables for the views atomically.
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("DROP VIEW IF EXISTS tx_output")
+            for source, _, _, _ in reversed(COPIES):
+                cursor.execute(f"DROP TABLE IF EXISTS {source}")
+            # The UTXO set has no rowid to resume from, so it is converted
+            # here in one step; it is far smaller than the history tables.
+            if kinds.get("utxo") == "table":
+                cursor.execute("""
+                    INSERT OR IGNORE INTO utxo_bin (txid, vout, value_sat, script_pubkey, height)
+                    SELECT hash_blob(txid), vout, value_sat, script_pubkey, height FROM utxo
+                """)
+                cursor.execute("DROP TABLE utxo")
+            if kinds.get("utxo_undo") == "table":
+                cursor.execute("UPDATE utxo_undo SET txid = hash_blob(txid) WHERE typeof(txid) = 'text'")
+            for statement in statements:
+                if statement.startswith("CREATE VIEW"):
+                    cursor.execute(statement)
+            cursor.execute("DROP TABLE hash_blob_migration")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"Converted {copied} rows to BLOB hashes in {time() - started:.1f}s.")
+
+        if vacuum:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            print(f"Vacuumed: {size / 1e6:.1f} MB -> {os.path.getsize(db_path) / 1e6:.1f} MB.")
+        return copied
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Store block hashes and txids as 32-byte BLOBs")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="rows copied per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="shrink the file once the conversion is done")
+    args = parser.parse_args(argv)
+    migrate(args.db, chunk_size=args.chunk_size, vacuum=args.vacuum)
+
+
+if __name__ == "__main__":
+    main()
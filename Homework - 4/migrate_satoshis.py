@@ -0,0 +1,105 @@
+import argparse
+from time import time
+
+from db_connection import connect
+
+# Rewrites a database created before tx_output stored integer satoshis: the
+# REAL tx_output table is copied into tx_output_sat in id order, one chunk per
+# transaction, and finally replaced by the compatibility view from schema.sql.
+# Stop update_db.py while it runs. An interrupted run continues where it left
+# off, since every chunk resumes after the highest id already copied.
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS tx_output_sat (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        txid VARCHAR(255) NOT NULL,
+        output_index INTEGER NOT NULL,
+        value_sat INTEGER NOT NULL,
+        script_pubkey TEXT,
+        FOREIGN KEY (txid) REFERENCES transactions(txid)
+    )
+"""
+
+CREATE_INDEX_SQL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_output_sat_txid ON tx_output_sat(txid, output_index)
+"""
+
+CREATE_VIEW_SQL = """
+    CREATE VIEW tx_output AS
+    SELECT id, txid, output_index, value_sat / 100000000.0 AS value, value_sat, script_pubkey
+    FROM tx_output_sat
+"""
+
+# ROUND picks the nearest satoshi, which is exact for every stored REAL
+# amount up to the 21M BTC supply.
+COPY_CHUNK_SQL = """
+    INSERT INTO tx_output_sat (id, txid, output_index, value_sat, script_pubkey)
+    SELECT id, txid, output_index, CAST(ROUND(value * 100000000) AS INTEGER), script_pubkey
+    FROM tx_output
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def object_type(conn, name):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def migrate(db_path, chunk_size=100_000, profile="bulk-ingest"):
+    """
+    Converts tx_output in `db_path` to satoshi storage. Returns the number of
+    rows copied by this run.
+    """
+    conn = connect(db_path, profile)
+    try:
+        if object_type(conn, "tx_output") != "table":
+            print("tx_output already stores satoshis; nothing to migrate.")
+            return 0
+        conn.execute(CREATE_TABLE_SQL)
+        conn.execute(CREATE_INDEX_SQL)
+        conn.commit()
+
+        total = conn.execute("SELECT COUNT(*) FROM tx_output").fetchone()[0]
+        copied = 0
+        started = time()
+        while True:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM tx_output_sat").fetchone()[0]
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            cursor.execute(COPY_CHUNK_SQL, (last_id, chunk_size))
+            rows = cursor.rowcount
+            conn.commit()
+            if rows <= 0:
+                break
+            copied += rows
+            done = conn.execute("SELECT COUNT(*) FROM tx_output_sat").fetchone()[0]
+            print(f"Copied {done}/{total} outputs ({copied / max(time() - started, 1e-9):.0f} rows/s).")
+
+        # Swap the old table for the view atomically.
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("DROP TABLE tx_output")
+            cursor.execute(CREATE_VIEW_SQL)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"tx_output now reads from tx_output_sat; migrated in {time() - started:.1f}s.")
+        return copied
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Store tx_output amounts as integer satoshis")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="rows copied per transaction")
+    args = parser.parse_args(argv)
+    migrate(args.db, chunk_size=args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
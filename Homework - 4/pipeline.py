@@ -0,0 +1,312 @@
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
+
+import metrics
+import profiling
+from block_writer import decode_block_json
+from raw_block import decode_raw_block
+from update_db import RPC_BATCH_SIZE
+
+# Blocks fetched but not yet written. This bounds memory (shared memory
+# segments plus decoded rows waiting in the reorder buffer) and is what
+# pushes back on the fetchers when the writer is the slowest stage.
+PIPELINE_WINDOW = int(os.getenv("PIPELINE_WINDOW", "64"))
+
+# Marks the end of a queue's input.
+DONE = None
+
+
+def iter_block_hashes(rpc, start_height, end_height):
+    """
+    Yields (height, block_hash) for the range, fetching RPC_BATCH_SIZE hashes
+    per round trip with batched getblockhash calls.
+    """
+    for chunk_start in range(start_height, end_height + 1, RPC_BATCH_SIZE):
+        chunk_end = min(chunk_start + RPC_BATCH_SIZE - 1, end_height)
+        hashes = rpc.get_block_hashes(chunk_start, chunk_end)
+        yield from zip(range(chunk_start, chunk_end + 1), hashes)
+
+
+def decode_shared(name, size, raw, header):
+    """
+    Runs in a decoder process: attaches the shared memory segment holding
+    one fetched block, decodes it and returns (DecodedBlock or None, start
+    time, busy seconds, process id). Only the segment name crosses the
+    process boundary; raw blocks are parsed straight from the mapping.
+    """
+    started = perf_counter()
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        if raw:
+            view = segment.buf[:size]
+            try:
+                decoded = decode_raw_block(view, header)
+            finally:
+                view.release()
+        else:
+            # json.loads needs bytes, so the body is copied once here.
+            decoded = decode_block_json(bytes(segment.buf[:size]))
+    finally:
+        segment.close()
+    return decoded, started, perf_counter() - started, os.getpid()
+
+
+class StageStats:
+    """
+    Busy time of one pipeline stage, summed over its `workers`.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.busy += seconds
+            self.items += 1
+        metrics.STAGE_BUSY.inc(seconds, self.name)
+
+    def utilization(self, elapsed):
+        return self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0
+
+
+class BlockPipeline:
+    """
+    Staged ingest of a height range:
+
+        feeder -> [tasks] -> fetcher threads -> [fetched] -> dispatcher
+               -> decoder processes -> [decoded] -> writer (calling thread)
+
+    Fetchers copy each block into a shared memory segment and pass its name
+    on; the decoder processes read the block from there, so the block bytes
+    are never pickled. The tasks and fetched queues are bounded, and the
+    feeder only hands out a height while fewer than `window` blocks are
+    between fetch and write, so a slow writer stalls the fetchers instead of
+    filling memory. The writer puts the blocks back in height order.
+    """
+
+    def __init__(self, rpc, writer, fetchers=8, decoders=None, raw=False, window=PIPELINE_WINDOW):
+        self.rpc = rpc
+        self.writer = writer
+        self.fetchers = fetchers
+        self.decoders = decoders or os.cpu_count() or 1
+        self.raw = raw
+        self.window = max(window, 1)
+        self.stats = {
+            "fetch": StageStats("fetch", self.fetchers),
+            "decode": StageStats("decode", self.decoders),
+            "write": StageStats("write", 1),
+        }
+        self.queue_depth = {"tasks": 0, "fetched": 0, "decoded": 0}
+        self.depth_samples = 0
+
+    def guard(self, stage, *args):
+        """
+        Runs one stage thread. An exception it raises stops the pipeline and
+        is kept for run() to re-raise, instead of leaving the writer waiting
+        for blocks that will never arrive.
+        """
+        try:
+            stage(*args)
+        except BaseException as e:
+            with self.lock:
+                if self.failure is None:
+                    self.failure = e
+            self.stopping.set()
+
+    def put(self, target, item):
+        """
+        Blocking put that gives up once the pipeline is stopping.
+        """
+        while not self.stopping.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed(self, start_height, end_height):
+        for height, block_hash in iter_block_hashes(self.rpc, start_height, end_height):
+            while not self.in_flight.acquire(timeout=0.1):
+                if self.stopping.is_set():
+                    return
+            if not self.put(self.tasks, (height, block_hash)):
+                return
+            if block_hash is None:
+                # Past the node's tip: nothing after this can be written.
+                break
+        for _ in range(self.fetchers):
+            self.put(self.tasks, DONE)
+
+    def fetch(self):
+        while True:
+            try:
+                task = self.tasks.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            if task is DONE:
+                break
+            height, block_hash = task
+            started = perf_counter()
+            item = (height, None, 0, None)
+            if block_hash is not None:
+                header = None
+                with profiling.span("fetch", height=height):
+                    if self.raw:
+                        data = self.rpc.get_raw_block(block_hash)
+                        header = self.rpc.call("getblockheader", [block_hash, True])
+                    else:
+                        data = self.rpc.call_raw("getblock", [block_hash, 2])
+                    if data is not None and (header is not None or not self.raw):
+                        segment = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+                        segment.buf[:len(data)] = data
+                        item = (height, segment, len(data), header)
+            self.stats["fetch"].add(perf_counter() - started)
+            if not self.put(self.fetched, item):
+                if item[1] is not None:
+                    release(item[1])
+                return
+        with self.lock:
+            self.fetchers_running -= 1
+            last = self.fetchers_running == 0
+        if last:
+            self.put(self.fetched, DONE)
+
+    def dispatch(self, pool):
+        while True:
+            try:
+                item = self.fetched.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            if item is DONE:
+                return
+            height, segment, size, header = item
+            if segment is None:
+                self.decoded.put((height, None))
+                continue
+            try:
+                future = pool.submit(decode_shared, segment.name, size, self.raw, header)
+            except RuntimeError as e:
+                # The pool is broken or shutting down.
+                print(f"Cannot decode block at height {height}: {e}")
+                release(segment)
+                self.decoded.put((height, None))
+                continue
+            future.add_done_callback(
+                lambda f, height=height, segment=segment: self.finish_decode(height, segment, f))
+
+    def finish_decode(self, height, segment, future):
+        release(segment)
+        decoded = None
+        if not future.cancelled() and future.exception() is None:
+            decoded, started, busy, pid = future.result()
+            self.stats["decode"].add(busy)
+            profiling.record_span("decode", started, busy, pid=pid, height=height)
+        elif not future.cancelled():
+            print(f"Decoding block at height {height} failed: {future.exception()}")
+        self.decoded.put((height, decoded))
+
+    def sample_depths(self):
+        self.depth_samples += 1
+        for name in self.queue_depth:
+            depth = getattr(self, name).qsize()
+            self.queue_depth[name] += depth
+            metrics.QUEUE_DEPTH.set(depth, name)
+
+    def run(self, start_height, end_height):
+        """
+        Ingests [start_height, end_height] and returns the last height handed
+        to the writer (start_height - 1 if none). Stops at the first block
+        that cannot be fetched or decoded, and re-raises the exception of a
+        stage thread that failed.
+        """
+        self.tasks = queue.Queue(maxsize=self.fetchers * 2)
+        self.fetched = queue.Queue(maxsize=self.decoders * 2)
+        # Bounded by in_flight: at most `window` blocks are anywhere in the pipeline.
+        self.decoded = queue.Queue()
+        self.in_flight = threading.BoundedSemaphore(self.window)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.fetchers_running = self.fetchers
+        self.failure = None
+
+        pool = ProcessPoolExecutor(max_workers=self.decoders)
+        stages = [(self.feed, start_height, end_height)]
+        stages += [(self.fetch,)] * self.fetchers
+        stages.append((self.dispatch, pool))
+        threads = [threading.Thread(target=self.guard, args=stage, daemon=True) for stage in stages]
+        for thread in threads:
+            thread.start()
+
+        started = perf_counter()
+        reorder, next_height = {}, start_height
+        try:
+            while next_height <= end_height:
+                while next_height not in reorder:
+                    try:
+                        height, decoded = self.decoded.get(timeout=0.1)
+                    except queue.Empty:
+                        if self.failure is not None:
+                            raise self.failure
+                        continue
+                    reorder[height] = decoded
+                self.sample_depths()
+                decoded = reorder.pop(next_height)
+                if decoded is None:
+                    print(f"Failed to fetch or decode block at height {next_height}; stopping.")
+                    break
+                write_started = perf_counter()
+                with profiling.span("write", height=next_height):
+                    self.writer.add_decoded(decoded)
+                self.stats["write"].add(perf_counter() - write_started)
+                self.in_flight.release()
+                next_height += 1
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+            pool.shutdown(wait=True, cancel_futures=True)
+            # Segments of fetched blocks that never reached a decoder.
+            while True:
+                try:
+                    item = self.fetched.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not DONE and item[1] is not None:
+                    release(item[1])
+        self.elapsed = perf_counter() - started
+        return next_height - 1
+
+    def report(self):
+        """
+        Per-stage utilization (busy time / available worker time) and the
+        average queue depths seen by the writer. The stage closest to 100%
+        is the bottleneck.
+        """
+        lines = []
+        for stats in self.stats.values():
+            lines.append(f"  {stats.name:6} {stats.utilization(self.elapsed):6.1%} busy "
+                         f"({stats.workers} workers, {stats.items} blocks, {stats.busy:.1f}s)")
+        samples = max(self.depth_samples, 1)
+        depths = ", ".join(f"{name} {total / samples:.1f}" for name, total in self.queue_depth.items())
+        lines.append(f"  average queue depth: {depths}")
+        bottleneck = max(self.stats.values(), key=lambda s: s.utilization(self.elapsed))
+        lines.append(f"  bottleneck: {bottleneck.name}")
+        return "Pipeline utilization:\n" + "\n".join(lines)
+
+
+def release(segment):
+    segment.close()
+    segment.unlink()
@@ -0,0 +1,276 @@
+import atexit
+import cProfile
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from time import perf_counter
+
+# Opt-in profiling, configured from the environment so a production run can
+# be profiled without editing code (update_db.py also has --trace and
+# --profile-blocks):
+#   PROFILE_TRACE=trace.json      record stage spans as a Chrome trace
+#                                 (chrome://tracing, Perfetto, speedscope)
+#   PROFILE_BLOCKS=800000:800100  cProfile and stack-sample that block range
+#   PROFILE_OUTPUT=profile        prefix of the .prof and .collapsed files
+#   PROFILE_SAMPLE_INTERVAL=0.005 seconds between stack samples
+# With nothing set, span() returns a shared no-op context manager and the
+# block hooks return after one comparison.
+
+# Spans kept in memory; later ones are counted but dropped.
+MAX_TRACE_EVENTS = int(os.getenv("PROFILE_MAX_EVENTS", "2000000"))
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+NO_SPAN = nullcontext()
+
+
+class Tracer:
+    """
+    Collects complete ("X") trace events: one per span, with its start
+    and duration in microseconds on the perf_counter clock, which is shared
+    by every process on the host, so spans reported by worker processes line
+    up with the parent's.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.dropped = 0
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.written = False
+
+    def record(self, name, started, duration, pid=None, tid=None, args=None):
+        if len(self.events) >= MAX_TRACE_EVENTS:
+            self.dropped += 1
+            return
+        if tid is None:
+            tid = threading.get_ident()
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+        event = {"name": name, "ph": "X", "ts": started * 1e6, "dur": duration * 1e6,
+                 "pid": pid or os.getpid(), "tid": tid}
+        if args:
+            event["args"] = args
+        # list.append is atomic, so threads need no lock here.
+        self.events.append(event)
+
+    def record_async(self, name, started, duration, args):
+        if len(self.events) >= MAX_TRACE_EVENTS:
+            self.dropped += 1
+            return
+        with self.lock:
+            self.next_id += 1
+            span_id = self.next_id
+        begin = {"name": name, "cat": "async", "ph": "b", "id": span_id, "ts": started * 1e6,
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if args:
+            begin["args"] = args
+        self.events.append(begin)
+        self.events.append({**begin, "ph": "e", "ts": (started + duration) * 1e6, "args": {}})
+
+    def write(self, path=None):
+        """
+        Writes the trace-event JSON and returns the number of spans.
+        """
+        path = path or self.path
+        pid = os.getpid()
+        metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in self.thread_names.items()]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+        self.written = True
+        dropped = f" ({self.dropped} dropped)" if self.dropped else ""
+        print(f"Wrote {len(self.events)} trace spans{dropped} to {path}")
+        return len(self.events)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "started")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.started, perf_counter() - self.started, args=self.args)
+
+
+tracer = None
+
+
+def span(name, **args):
+    """
+    Context manager timing one stage, e.g. `with span("commit", blocks=10):`.
+    A no-op unless tracing is enabled.
+    """
+    if tracer is None:
+        return NO_SPAN
+    return Span(tracer, name, args)
+
+
+def record_span(name, started, duration, pid=None, **args):
+    """
+    Adds a span that was timed by the caller; with `pid`, one measured in
+    another process (e.g. a decoder), shown as that process's track.
+    """
+    if tracer is not None:
+        tracer.record(name, started, duration, pid=pid, tid=pid, args=args)
+
+
+def record_async_span(name, started, duration, **args):
+    """
+    Adds a span of a coroutine. Coroutines on one thread overlap without
+    nesting, so these go on their own async tracks instead of the thread's.
+    """
+    if tracer is not None:
+        tracer.record_async(name, started, duration, args)
+
+
+def enable_tracing(path):
+    """
+    Starts recording spans; they are written to `path` at exit.
+    """
+    global tracer
+    tracer = Tracer(path)
+    atexit.register(lambda t=tracer: t.written or t.write())
+    return tracer
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread except its own every
+    `interval` seconds and counts them in the collapsed format read by
+    flamegraph.pl and speedscope: "thread;outer;...;inner count".
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class BlockRangeProfiler:
+    """
+    Runs cProfile (on the thread that hands blocks to the writer) and a
+    StackSampler (on every thread) from the moment the first block of
+    [first, last] reaches the writer until the last one is committed.
+    Writes <output>.prof for pstats/snakeviz and <output>.collapsed for
+    flame graphs.
+    """
+
+    def __init__(self, first, last, output="profile", interval=SAMPLE_INTERVAL):
+        self.first = first
+        self.last = last
+        self.output = output
+        self.interval = interval
+        self.profile = None
+        self.sampler = None
+        self.done = False
+
+    def block_started(self, height):
+        if self.profile is None and not self.done and self.first <= height <= self.last:
+            print(f"Profiling blocks {height}..{self.last}...")
+            self.started = perf_counter()
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def block_committed(self, height):
+        if self.profile is not None and height >= self.last:
+            self.stop()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.sampler.stop()
+        self.profile.dump_stats(self.output + ".prof")
+        self.sampler.write(self.output + ".collapsed")
+        print(f"Profiled blocks {self.first}..{self.last} in {perf_counter() - self.started:.1f}s: "
+              f"{self.output}.prof, {self.output}.collapsed ({sum(self.sampler.stacks.values())} samples)")
+        self.profile = None
+        self.done = True
+
+
+block_profiler = None
+
+
+def profile_blocks(first, last, output="profile", interval=SAMPLE_INTERVAL):
+    """
+    Profiles the given block range the next time it is ingested. Output is
+    also written at exit if the range was never finished.
+    """
+    global block_profiler
+    block_profiler = BlockRangeProfiler(first, last, output, interval)
+    atexit.register(block_profiler.stop)
+    return block_profiler
+
+
+def block_started(height):
+    """
+    Called when a block reaches the writer.
+    """
+    if block_profiler is not None:
+        block_profiler.block_started(height)
+
+
+def block_committed(height):
+    """
+    Called after the writer commits blocks up to `height`.
+    """
+    if block_profiler is not None:
+        block_profiler.block_committed(height)
+
+
+def parse_block_range(text):
+    """
+    "FIRST:LAST" (or a single height) -> (first, last).
+    """
+    first, _, last = text.partition(":")
+    return int(first), int(last or first)
+
+
+if os.getenv("PROFILE_TRACE"):
+    enable_tracing(os.getenv("PROFILE_TRACE"))
+if os.getenv("PROFILE_BLOCKS"):
+    profile_blocks(*parse_block_range(os.getenv("PROFILE_BLOCKS")), os.getenv("PROFILE_OUTPUT", "profile"))
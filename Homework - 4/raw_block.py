@@ -0,0 +1,205 @@
+import hashlib
+import struct
+from decimal import Decimal
+
+from block_writer import decode_block, materialize
+
+# Pure-Python decoder for serialized blocks (getblock verbosity=0 or the REST
+# .bin endpoint). It walks a memoryview of the block so scripts and hashes are
+# read from slices of the original buffer instead of copies, and it returns
+# dicts shaped like getblock verbosity=2 so block_writer.decode_block turns
+# them into exactly the rows the JSON path produces.
+
+_U32 = struct.Struct("<I")
+_I32 = struct.Struct("<i")
+_U64 = struct.Struct("<Q")
+_HEADER = struct.Struct("<i32s32sIII")
+
+NULL_HASH = b"\x00" * 32
+
+# Fields getblock reports that cannot be derived from the block bytes alone.
+HEADER_ONLY_FIELDS = ("height", "confirmations", "mediantime", "difficulty", "chainwork", "nextblockhash")
+
+
+def double_sha256(*parts):
+    """
+    SHA256(SHA256(parts...)), feeding each buffer without joining them.
+    """
+    inner = hashlib.sha256()
+    for part in parts:
+        inner.update(part)
+    return hashlib.sha256(inner.digest()).digest()
+
+
+def hash_to_hex(digest):
+    """
+    Bitcoin displays hashes byte-reversed.
+    """
+    return digest[::-1].hex()
+
+
+def read_varint(mv, pos):
+    """
+    Reads a CompactSize integer at `pos` and returns (value, new_pos).
+    """
+    first = mv[pos]
+    if first < 0xfd:
+        return first, pos + 1
+    if first == 0xfd:
+        return mv[pos + 1] | (mv[pos + 2] << 8), pos + 3
+    if first == 0xfe:
+        return _U32.unpack_from(mv, pos + 1)[0], pos + 5
+    return _U64.unpack_from(mv, pos + 1)[0], pos + 9
+
+
+def bits_to_difficulty(bits):
+    """
+    Difficulty relative to the minimum target, as getblock reports it.
+    """
+    exponent, mantissa = bits >> 24, bits & 0x00ffffff
+    difficulty = 0x0000ffff / mantissa
+    shift = exponent
+    while shift < 29:
+        difficulty *= 256.0
+        shift += 1
+    while shift > 29:
+        difficulty /= 256.0
+        shift -= 1
+    return difficulty
+
+
+def parse_transaction(mv, pos):
+    """
+    Decodes the transaction starting at `pos` and returns
+    (tx, new_pos, size without witness data).
+    """
+    start = pos
+    version = _I32.unpack_from(mv, pos)[0]
+    pos += 4
+    segwit = mv[pos] == 0 and mv[pos + 1] != 0
+    if segwit:
+        pos += 2  # marker and flag
+    body_start = pos
+
+    vin = []
+    count, pos = read_varint(mv, pos)
+    for _ in range(count):
+        prev_hash = mv[pos:pos + 32]
+        prev_index = _U32.unpack_from(mv, pos + 32)[0]
+        script_len, pos = read_varint(mv, pos + 36)
+        script = mv[pos:pos + script_len]
+        pos += script_len
+        sequence = _U32.unpack_from(mv, pos)[0]
+        pos += 4
+        if prev_index == 0xffffffff and prev_hash == NULL_HASH:
+            vin.append({"coinbase": script.hex(), "sequence": sequence})
+        else:
+            vin.append({
+                "txid": hash_to_hex(prev_hash),
+                "vout": prev_index,
+                "scriptSig": {"hex": script.hex()},
+                "sequence": sequence
+            })
+
+    vout = []
+    count, pos = read_varint(mv, pos)
+    for n in range(count):
+        value = _U64.unpack_from(mv, pos)[0]
+        script_len, pos = read_varint(mv, pos + 8)
+        vout.append({
+            "value": Decimal(value).scaleb(-8),
+            "n": n,
+            "scriptPubKey": {"hex": mv[pos:pos + script_len].hex()}
+        })
+        pos += script_len
+    body_end = pos
+
+    if segwit:
+        for txin in vin:
+            items, pos = read_varint(mv, pos)
+            witness = []
+            for _ in range(items):
+                item_len, pos = read_varint(mv, pos)
+                witness.append(mv[pos:pos + item_len].hex())
+                pos += item_len
+            if witness:
+                txin["txinwitness"] = witness
+
+    locktime = _U32.unpack_from(mv, pos)[0]
+    pos += 4
+
+    # The txid commits to the serialization without marker, flag and witness.
+    total_size = pos - start
+    if segwit:
+        txid = double_sha256(mv[start:start + 4], mv[body_start:body_end], mv[pos - 4:pos])
+        base_size = 4 + (body_end - body_start) + 4
+    else:
+        txid = double_sha256(mv[start:pos])
+        base_size = total_size
+    weight = base_size * 3 + total_size
+    tx = {
+        "txid": hash_to_hex(txid),
+        "hash": hash_to_hex(double_sha256(mv[start:pos])) if segwit else hash_to_hex(txid),
+        "version": version,
+        "size": total_size,
+        "vsize": (weight + 3) // 4,
+        "weight": weight,
+        "locktime": locktime,
+        "vin": vin,
+        "vout": vout
+    }
+    return tx, pos, base_size
+
+
+def parse_block(data, header=None):
+    """
+    Decodes a serialized block. `header` is the optional getblockheader
+    (verbose) result for the same block; it supplies the fields listed in
+    HEADER_ONLY_FIELDS. Without it, difficulty is computed from bits and the
+    remaining chain-context fields are None.
+    """
+    mv = memoryview(data)
+    version, prev_hash, merkle_root, time, bits, nonce = _HEADER.unpack_from(mv, 0)
+    count, pos = read_varint(mv, 80)
+    stripped_size = pos
+    transactions = []
+    for _ in range(count):
+        tx, pos, base_size = parse_transaction(mv, pos)
+        stripped_size += base_size
+        transactions.append(tx)
+    size = pos
+
+    block = {
+        "hash": hash_to_hex(double_sha256(mv[0:80])),
+        "version": version,
+        "versionHex": f"{version & 0xffffffff:08x}",
+        "merkleroot": hash_to_hex(merkle_root),
+        "time": time,
+        "nonce": nonce,
+        "bits": f"{bits:08x}",
+        "nTx": count,
+        "previousblockhash": hash_to_hex(prev_hash) if prev_hash != NULL_HASH else None,
+        "strippedsize": stripped_size,
+        "size": size,
+        "weight": stripped_size * 3 + size,
+        "tx": transactions,
+        "height": None,
+        "confirmations": None,
+        "mediantime": None,
+        "difficulty": bits_to_difficulty(bits),
+        "chainwork": None,
+        "nextblockhash": None
+    }
+    if header:
+        for field in HEADER_ONLY_FIELDS:
+            if field in header:
+                block[field] = header[field]
+    return block
+
+
+def decode_raw_block(data, header=None):
+    """
+    Raw-mode counterpart of block_writer.decode_block_json: parses the block
+    bytes and returns a picklable DecodedBlock for the writer.
+    """
+    return materialize(decode_block(parse_block(data, header)))
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+from db_connection import STORAGE_TABLES
+
+# How many recent blocks are remembered for fork detection. Reorgs deeper
+# than this are not expected on mainnet and need a manual rescan.
+REORG_WINDOW = 100
+
+
+class ReorgDetected(Exception):
+    """
+    Raised while ingesting when a block does not build on the block we
+    stored at the previous height.
+    """
+
+    def __init__(self, height):
+        super().__init__(f"block at height {height} does not extend the stored chain")
+        self.height = height
+
+
+class HeaderWindow:
+    """
+    In-memory window of the most recent committed (height -> hash) pairs.
+    Incoming blocks are checked against it, and it is what the fork point
+    search compares with the node's active chain.
+    """
+
+    def __init__(self, size=REORG_WINDOW):
+        self.size = size
+        self.hashes = OrderedDict()
+
+    @classmethod
+    def load(cls, conn, size=REORG_WINDOW):
+        """
+        Fills the window from the highest blocks stored in the database.
+        """
+        window = cls(size)
+        rows = conn.execute(
+            "SELECT height, hash FROM block ORDER BY height DESC LIMIT ?", (size,)
+        ).fetchall()
+        for height, block_hash in reversed(rows):
+            window.add(height, block_hash)
+        return window
+
+    def add(self, height, block_hash):
+        self.hashes[height] = block_hash
+        while len(self.hashes) > self.size:
+            self.hashes.popitem(last=False)
+
+    def get(self, height):
+        return self.hashes.get(height)
+
+    def connects(self, height, previous_hash):
+        """
+        True if a block at `height` whose parent is `previous_hash` extends the
+        stored chain. Unknown parents (e.g. the first block ever) are accepted.
+        """
+        parent = self.hashes.get(height - 1)
+        return parent is None or parent == previous_hash
+
+    def find_fork_point(self, rpc):
+        """
+        Returns the highest height whose stored hash is still on the node's
+        active chain, or None if the fork is deeper than the window.
+        Uses one batched getblockhash round trip for the whole window.
+        """
+        if not self.hashes:
+            return None
+        heights = list(self.hashes)
+        active = rpc.get_block_hashes(heights[0], heights[-1])
+        for height, active_hash in reversed(list(zip(heights, active))):
+            if active_hash == self.hashes[height]:
+                return height
+        return None
+
+    def truncate(self, height):
+        """
+        Forgets every entry above `height`.
+        """
+        for stale in [h for h in self.hashes if h > height]:
+            del self.hashes[stale]
+
+
+def rollback_to(cursor, fork_height, tables=STORAGE_TABLES["hex"]):
+    """
+    Deletes every block above `fork_height` together with its transactions,
+    inputs and outputs. Runs in the caller's transaction; all lookups go
+    through the height, block_hash and txid indexes of the storage `tables`
+    (db_connection.STORAGE_TABLES). Returns the number of blocks removed.
+    """
+    orphaned_txids = f"""
+        SELECT t.txid FROM {tables["block"]} b
+        JOIN {tables["transactions"]} t ON t.block_hash = b.hash
+        WHERE b.height > ?
+    """
+    cursor.execute(f"DELETE FROM {tables['tx_input']} WHERE txid IN ({orphaned_txids})", (fork_height,))
+    cursor.execute(f"DELETE FROM {tables['tx_output']} WHERE txid IN ({orphaned_txids})", (fork_height,))
+    cursor.execute(f"""
+        DELETE FROM {tables["transactions"]}
+        WHERE block_hash IN (SELECT hash FROM {tables["block"]} WHERE height > ?)
+    """, (fork_height,))
+    cursor.execute(f"DELETE FROM {tables['block']} WHERE height > ?", (fork_height,))
+    return cursor.rowcount
@@ -0,0 +1,224 @@
+import argparse
+from time import perf_counter
+
+from db_connection import STORAGE_TABLES, connect, hash_storage
+
+# The block subsidy halves every HALVING_INTERVAL blocks (150 on regtest).
+HALVING_INTERVAL = 210_000
+INITIAL_SUBSIDY_SAT = 50 * 100_000_000
+
+# Blocks per difficulty adjustment period.
+EPOCH_LENGTH = 2016
+
+# Totals of every block. fee_sat is what the coinbase claims on top of the
+# subsidy, which equals the fees paid unless the miner claimed less.
+BLOCK_STATS_SQL = """
+    CREATE TABLE IF NOT EXISTS block_stats (
+        height INTEGER PRIMARY KEY,
+        time INTEGER NOT NULL,
+        tx_count INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        weight INTEGER NOT NULL,
+        input_count INTEGER NOT NULL,
+        output_count INTEGER NOT NULL,
+        output_sat INTEGER NOT NULL,
+        fee_sat INTEGER NOT NULL
+    )
+"""
+
+BLOCK_STATS_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_block_stats_tx_count ON block_stats(tx_count)"
+
+# The same totals summed per UTC day and per difficulty epoch (height / 2016).
+PERIOD_STATS_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        {key} PRIMARY KEY,
+        blocks INTEGER NOT NULL,
+        tx_count INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        weight INTEGER NOT NULL,
+        input_count INTEGER NOT NULL,
+        output_count INTEGER NOT NULL,
+        output_sat INTEGER NOT NULL,
+        fee_sat INTEGER NOT NULL
+    )
+"""
+
+# (table, key column and type, key expression over block_stats)
+PERIODS = [
+    ("daily_stats", "day TEXT", "date(time, 'unixepoch')"),
+    ("epoch_stats", "epoch INTEGER", f"height / {EPOCH_LENGTH}"),
+]
+
+SUMMED_COLUMNS = ["tx_count", "size", "weight", "input_count", "output_count", "output_sat", "fee_sat"]
+
+
+def block_subsidy(height):
+    return INITIAL_SUBSIDY_SAT >> (height // HALVING_INTERVAL)
+
+
+def create_tables(conn):
+    conn.execute(BLOCK_STATS_SQL)
+    conn.execute(BLOCK_STATS_INDEX_SQL)
+    for table, key, _ in PERIODS:
+        conn.execute(PERIOD_STATS_SQL.format(table=table, key=key))
+    conn.commit()
+
+
+def apply_periods(cursor, first_height, last_height, sign):
+    """
+    Adds (sign=1) or subtracts (sign=-1) the block_stats rows between the
+    two heights to the daily and epoch totals. Periods left without blocks
+    are deleted.
+    """
+    for table, key, expression in PERIODS:
+        key_column = key.split()[0]
+        sums = ", ".join(f"? * SUM({column})" for column in SUMMED_COLUMNS)
+        updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in ["blocks"] + SUMMED_COLUMNS)
+        cursor.execute(f"""
+            INSERT INTO {table} ({key_column}, blocks, {", ".join(SUMMED_COLUMNS)})
+            SELECT {expression}, ? * COUNT(*), {sums}
+            FROM block_stats WHERE height BETWEEN ? AND ? GROUP BY 1
+            ON CONFLICT({key_column}) DO UPDATE SET {updates}
+        """, [sign] * (len(SUMMED_COLUMNS) + 1) + [first_height, last_height])
+        if sign < 0:
+            cursor.execute(f"DELETE FROM {table} WHERE blocks = 0")
+
+
+class Rollups:
+    """
+    BlockWriter extension that keeps block_stats, daily_stats and
+    epoch_stats in the same transaction as the blocks. Per-block input and
+    output totals are collected from the rows; size, weight, time and
+    transaction count are read from the block rows written just before
+    flush. Re-ingested heights replace their old totals, and rollback
+    subtracts the removed blocks from their day and epoch.
+    """
+
+    def __init__(self, conn):
+        self.block_table = STORAGE_TABLES[hash_storage(conn)]["block"]
+        create_tables(conn)
+        if conn.execute("SELECT 1 FROM block_stats LIMIT 1").fetchone() is None and \
+                conn.execute(f"SELECT 1 FROM {self.block_table} LIMIT 1").fetchone() is not None:
+            print("The rollup tables are empty; run rollups.py --rebuild to fill them for the stored blocks.")
+        self.discard()
+
+    def discard(self):
+        # height -> [input_count, output_count, output_sat, coinbase_sat]
+        self.pending = {}
+
+    def add_rows(self, height, input_rows, output_rows):
+        totals = self.pending.setdefault(height, [0, 0, 0, 0])
+        coinbase = set()
+        for row in input_rows:
+            if row[2] is None:
+                coinbase.add(row[0])
+            else:
+                totals[0] += 1
+        for txid, _, value_sat, _ in output_rows:
+            totals[1] += 1
+            totals[2] += value_sat
+            if txid in coinbase:
+                totals[3] += value_sat
+
+    def flush(self, cursor, height):
+        if not self.pending:
+            return
+        first, last = min(self.pending), max(self.pending)
+        apply_periods(cursor, first, last, -1)
+        cursor.executemany(f"""
+            INSERT OR REPLACE INTO block_stats (height, time, tx_count, size, weight,
+                                                input_count, output_count, output_sat, fee_sat)
+            SELECT height, time, ntx, size, weight, ?, ?, ?, ? FROM {self.block_table} WHERE height = ?
+        """, (
+            (inputs, outputs, output_sat, max(coinbase_sat - block_subsidy(h), 0), h)
+            for h, (inputs, outputs, output_sat, coinbase_sat) in self.pending.items()
+        ))
+        apply_periods(cursor, first, last, 1)
+        self.discard()
+
+    def rollback(self, cursor, fork_height):
+        self.discard()
+        last = cursor.execute("SELECT MAX(height) FROM block_stats").fetchone()[0]
+        if last is not None and last > fork_height:
+            apply_periods(cursor, fork_height + 1, last, -1)
+        cursor.execute("DELETE FROM block_stats WHERE height > ?", (fork_height,))
+
+    def report(self):
+        return "Rollups: block, daily and epoch totals up to date"
+
+
+def rebuild(db_path, chunk_size=10_000, profile="bulk-ingest"):
+    """
+    Recomputes the rollup tables from the block tables, `chunk_size` heights
+    per transaction, for databases loaded before the rollups existed or
+    after they were changed by hand. Returns the number of blocks.
+    """
+    conn = connect(db_path, profile)
+    started = perf_counter()
+    try:
+        tables = STORAGE_TABLES[hash_storage(conn)]
+        create_tables(conn)
+        conn.execute("DELETE FROM block_stats")
+        for table, _, _ in PERIODS:
+            conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+        low, high = conn.execute(f"SELECT MIN(height), MAX(height) FROM {tables['block']}").fetchone()
+        if low is None:
+            print("No blocks stored; nothing to rebuild.")
+            return 0
+        for first in range(low, high + 1, chunk_size):
+            last = min(first + chunk_size - 1, high)
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute(f"""
+                    INSERT INTO block_stats (height, time, tx_count, size, weight,
+                                             input_count, output_count, output_sat, fee_sat)
+                    SELECT b.height, b.time, b.ntx, b.size, b.weight,
+                        (SELECT COUNT(*) FROM {tables['transactions']} t
+                         JOIN {tables['tx_input']} i ON i.txid = t.txid
+                         WHERE t.block_hash = b.hash AND i.prev_txid IS NOT NULL),
+                        (SELECT COUNT(*) FROM {tables['transactions']} t
+                         JOIN {tables['tx_output']} o ON o.txid = t.txid WHERE t.block_hash = b.hash),
+                        (SELECT COALESCE(SUM(o.value_sat), 0) FROM {tables['transactions']} t
+                         JOIN {tables['tx_output']} o ON o.txid = t.txid WHERE t.block_hash = b.hash),
+                        MAX((SELECT COALESCE(SUM(o.value_sat), 0) FROM {tables['transactions']} t
+                             JOIN {tables['tx_input']} i ON i.txid = t.txid AND i.prev_txid IS NULL
+                             JOIN {tables['tx_output']} o ON o.txid = t.txid WHERE t.block_hash = b.hash)
+                            - ({INITIAL_SUBSIDY_SAT} >> (b.height / {HALVING_INTERVAL})), 0)
+                    FROM {tables['block']} b WHERE b.height BETWEEN ? AND ?
+                """, (first, last))
+                apply_periods(cursor, first, last, 1)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            print(f"Rollups rebuilt up to height {last}.")
+        blocks = conn.execute("SELECT COUNT(*) FROM block_stats").fetchone()[0]
+        print(f"Rebuilt rollups for {blocks} blocks in {perf_counter() - started:.1f}s.")
+        return blocks
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-block, per-day and per-epoch totals of blockchain.db")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the rollups from the block tables")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="heights rebuilt per transaction")
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        rebuild(args.db, chunk_size=args.chunk_size)
+        return
+    conn = connect(args.db, "serve")
+    try:
+        for day, blocks, tx_count, fee_sat in conn.execute(
+                "SELECT day, blocks, tx_count, fee_sat FROM daily_stats ORDER BY day DESC LIMIT 14"):
+            print(f"{day}  {blocks:>4} blocks  {tx_count:>8} transactions  {fee_sat / 1e8:>12.8f} BTC fees")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,208 @@
-PRAGMA foreign_keys = ON;
-
--- Block Table: Stores all block-level data from the getblock RPC call.
-CREATE TABLE IF NOT EXISTS block (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    hash VARCHAR(255) NOT NULL,
-    confirmations INTEGER NOT NULL,
-    height INTEGER NOT NULL,
-    version INTEGER NOT NULL,
-    versionhex VARCHAR(255) NOT NULL,
-    merkleroot VARCHAR(255) NOT NULL,
-    time INTEGER NOT NULL,
-    mediantime INTEGER NOT NULL,
-    nonce INTEGER NOT NULL,
-    bits VARCHAR(255) NOT NULL,
-    difficulty REAL NOT NULL,
-    chainwork VARCHAR(255) NOT NULL,
-    ntx INTEGER NOT NULL,
-    previousblockhash VARCHAR(255),
-    nextblockhash VARCHAR(255),
-    strippedsize INTEGER NOT NULL,
-    size INTEGER NOT NULL,
-    weight INTEGER NOT NULL
-);
-
--- Transaction Table: Stores individual transactions associated with blocks.
-CREATE TABLE IF NOT EXISTS transactions (
-    txid VARCHAR(255) PRIMARY KEY,
-    block_hash VARCHAR(255) NOT NULL,
-    version INTEGER NOT NULL,
-    locktime INTEGER NOT NULL,
-    size INTEGER NOT NULL,
-    weight INTEGER NOT NULL,
-    FOREIGN KEY (block_hash) REFERENCES block(hash)
-);
-
--- Transaction Inputs Table: Stores inputs for each transaction.
-CREATE TABLE IF NOT EXISTS tx_input (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    txid VARCHAR(255) NOT NULL,
-    input_index INTEGER NOT NULL,
-    prev_txid VARCHAR(255),
-    prev_vout INTEGER,
-    script_sig TEXT,
-    sequence INTEGER,
-    FOREIGN KEY (txid) REFERENCES transactions(txid)  -- FIXED!
-);
-
--- Transaction Outputs Table: Stores outputs for each transaction.
-CREATE TABLE IF NOT EXISTS tx_output (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    txid VARCHAR(255) NOT NULL,
-    output_index INTEGER NOT NULL,
-    value REAL NOT NULL,
-    script_pubkey TEXT,
-    FOREIGN KEY (txid) REFERENCES transactions(txid)  -- FIXED!
-);
+PRAGMA foreign_keys = ON;
+
+-- Block Table: Stores all block-level data from the getblock RPC call.
+CREATE TABLE IF NOT EXISTS block (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash VARCHAR(255) NOT NULL,
+    confirmations INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    versionhex VARCHAR(255) NOT NULL,
+    merkleroot VARCHAR(255) NOT NULL,
+    time INTEGER NOT NULL,
+    mediantime INTEGER NOT NULL,
+    nonce INTEGER NOT NULL,
+    bits VARCHAR(255) NOT NULL,
+    difficulty REAL NOT NULL,
+    chainwork VARCHAR(255) NOT NULL,
+    ntx INTEGER NOT NULL,
+    previousblockhash VARCHAR(255),
+    nextblockhash VARCHAR(255),
+    strippedsize INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL
+);
+
+-- A block hash is stored once, so re-ingesting a block is a no-op.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_block_hash ON block(hash);
+-- Reorg rollback deletes by height range.
+CREATE INDEX IF NOT EXISTS idx_block_height ON block(height);
+
+-- Transaction Table: Stores individual transactions associated with blocks.
+CREATE TABLE IF NOT EXISTS transactions (
+    txid VARCHAR(255) PRIMARY KEY,
+    block_hash VARCHAR(255) NOT NULL,
+    version INTEGER NOT NULL,
+    locktime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    FOREIGN KEY (block_hash) REFERENCES block(hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_block_hash ON transactions(block_hash);
+
+-- Transaction Inputs Table: Stores inputs for each transaction.
+CREATE TABLE IF NOT EXISTS tx_input (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    txid VARCHAR(255) NOT NULL,
+    input_index INTEGER NOT NULL,
+    prev_txid VARCHAR(255),
+    prev_vout INTEGER,
+    script_sig TEXT,
+    sequence INTEGER,
+    FOREIGN KEY (txid) REFERENCES transactions(txid)  -- FIXED!
+);
+
+-- One row per input; also serves lookups and rollbacks by txid.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_input_txid ON tx_input(txid, input_index);
+-- Finds the input that spends an output.
+CREATE INDEX IF NOT EXISTS idx_tx_input_prev ON tx_input(prev_txid, prev_vout);
+
+-- Transaction Outputs Table: Stores outputs for each transaction.
+-- Amounts are integer satoshis, so SUM(value_sat) is exact and runs on
+-- integer math; tx_output below presents them in BTC.
+CREATE TABLE IF NOT EXISTS tx_output_sat (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    txid VARCHAR(255) NOT NULL,
+    output_index INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    FOREIGN KEY (txid) REFERENCES transactions(txid)
+);
+
+-- One row per output; also serves lookups and rollbacks by txid.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_output_sat_txid ON tx_output_sat(txid, output_index);
+
+-- Compatibility view: the original tx_output columns, with value in BTC.
+CREATE VIEW IF NOT EXISTS tx_output AS
+SELECT id, txid, output_index, value_sat / 100000000.0 AS value, value_sat, script_pubkey
+FROM tx_output_sat;
+
+-- UTXO Table: the currently unspent outputs (OP_RETURN outputs excluded),
+-- maintained by the ingester in the same transaction as each block.
+CREATE TABLE IF NOT EXISTS utxo (
+    txid VARCHAR(255) NOT NULL,
+    vout INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (txid, vout)
+) WITHOUT ROWID;
+
+-- Rollback removes the outputs created above the fork height.
+CREATE INDEX IF NOT EXISTS idx_utxo_height ON utxo(height);
+-- Balance of a script: one indexed range read.
+CREATE INDEX IF NOT EXISTS idx_utxo_script ON utxo(script_pubkey);
+
+-- Outputs spent by the most recent blocks, restored on rollback.
+CREATE TABLE IF NOT EXISTS utxo_undo (
+    height INTEGER NOT NULL,
+    txid VARCHAR(255) NOT NULL,
+    vout INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    created_height INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_utxo_undo_height ON utxo_undo(height);
+
+-- Running totals of the UTXO set (supply), updated with every commit.
+CREATE TABLE IF NOT EXISTS utxo_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    height INTEGER,
+    utxo_count INTEGER NOT NULL,
+    total_sat INTEGER NOT NULL
+);
+
+-- Address index: the net balance change of every standard address
+-- (P2PKH, P2SH, P2WPKH, P2WSH, P2TR) in every transaction that pays or
+-- spends from it. Use it instead of searching script_pubkey.
+CREATE TABLE IF NOT EXISTS address_activity (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    txid VARCHAR(255) NOT NULL,
+    delta_sat INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_address_activity_address ON address_activity(address, height);
+CREATE INDEX IF NOT EXISTS idx_address_activity_height ON address_activity(height);
+
+-- Current balance per address.
+CREATE TABLE IF NOT EXISTS address_balance (
+    address TEXT PRIMARY KEY,
+    balance_sat INTEGER NOT NULL,
+    activity_count INTEGER NOT NULL,
+    checkpoint_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Periodic balances, so the balance at a height reads a checkpoint plus a
+-- bounded range of address_activity.
+CREATE TABLE IF NOT EXISTS address_checkpoint (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    balance_sat INTEGER NOT NULL,
+    activity_count INTEGER NOT NULL,
+    PRIMARY KEY (address, height)
+) WITHOUT ROWID;
+
+-- Rollups: totals per block, per UTC day and per difficulty epoch (2016
+-- blocks), maintained with every commit. Rebuild with rollups.py --rebuild.
+-- fee_sat is the coinbase value above the block subsidy.
+CREATE TABLE IF NOT EXISTS block_stats (
+    height INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_block_stats_tx_count ON block_stats(tx_count);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT PRIMARY KEY,
+    blocks INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS epoch_stats (
+    epoch INTEGER PRIMARY KEY,
+    blocks INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+-- Fee, virtual size and feerate (sat/vB) of every non-coinbase transaction,
+-- computed at ingest from the amounts of the outputs it spends.
+CREATE TABLE IF NOT EXISTS tx_fee (
+    txid VARCHAR(255) PRIMARY KEY,
+    height INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL,
+    vsize INTEGER NOT NULL,
+    feerate REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_tx_fee_height ON tx_fee(height);
+
+-- Sync State Table: The last block fully committed by update_db.py.
+-- Updated in the same transaction as the block rows, so a restart resumes
+-- exactly after it.
+CREATE TABLE IF NOT EXISTS sync_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    height INTEGER NOT NULL,
+    hash VARCHAR(255) NOT NULL
+);
@@ -0,0 +1,238 @@
+PRAGMA foreign_keys = ON;
+
+-- Compact variant of schema.sql: every block hash and txid is stored as its
+-- raw 32 bytes (in the byte order bitcoind displays) instead of 64 hex
+-- characters, which roughly halves the tables and their indexes and makes
+-- txid joins compare 32-byte keys. The data lives in the *_bin tables; views
+-- with the schema.sql names and columns present the hashes as lowercase hex
+-- (NULL stays NULL), so existing queries keep working. Filter with
+-- hash_blob('<hex>') (registered by db_connection.connect) against the *_bin
+-- tables to use their indexes.
+
+-- Block Table: Stores all block-level data from the getblock RPC call.
+CREATE TABLE IF NOT EXISTS block_bin (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash BLOB NOT NULL,
+    confirmations INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    versionhex VARCHAR(255) NOT NULL,
+    merkleroot BLOB NOT NULL,
+    time INTEGER NOT NULL,
+    mediantime INTEGER NOT NULL,
+    nonce INTEGER NOT NULL,
+    bits VARCHAR(255) NOT NULL,
+    difficulty REAL NOT NULL,
+    chainwork VARCHAR(255) NOT NULL,
+    ntx INTEGER NOT NULL,
+    previousblockhash BLOB,
+    nextblockhash BLOB,
+    strippedsize INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_block_bin_hash ON block_bin(hash);
+CREATE INDEX IF NOT EXISTS idx_block_bin_height ON block_bin(height);
+
+CREATE VIEW IF NOT EXISTS block AS
+SELECT id, lower(hex(hash)) AS hash, confirmations, height, version, versionhex,
+       lower(hex(merkleroot)) AS merkleroot, time, mediantime, nonce, bits, difficulty,
+       chainwork, ntx, nullif(lower(hex(previousblockhash)), '') AS previousblockhash,
+       nullif(lower(hex(nextblockhash)), '') AS nextblockhash, strippedsize, size, weight
+FROM block_bin;
+
+-- Transaction Table: Stores individual transactions associated with blocks.
+CREATE TABLE IF NOT EXISTS transactions_bin (
+    txid BLOB PRIMARY KEY,
+    block_hash BLOB NOT NULL,
+    version INTEGER NOT NULL,
+    locktime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    FOREIGN KEY (block_hash) REFERENCES block_bin(hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_bin_block_hash ON transactions_bin(block_hash);
+
+CREATE VIEW IF NOT EXISTS transactions AS
+SELECT lower(hex(txid)) AS txid, lower(hex(block_hash)) AS block_hash, version, locktime, size, weight
+FROM transactions_bin;
+
+-- Transaction Inputs Table: Stores inputs for each transaction.
+CREATE TABLE IF NOT EXISTS tx_input_bin (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    txid BLOB NOT NULL,
+    input_index INTEGER NOT NULL,
+    prev_txid BLOB,
+    prev_vout INTEGER,
+    script_sig TEXT,
+    sequence INTEGER,
+    FOREIGN KEY (txid) REFERENCES transactions_bin(txid)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_input_bin_txid ON tx_input_bin(txid, input_index);
+-- Finds the input that spends an output.
+CREATE INDEX IF NOT EXISTS idx_tx_input_bin_prev ON tx_input_bin(prev_txid, prev_vout);
+
+CREATE VIEW IF NOT EXISTS tx_input AS
+SELECT id, lower(hex(txid)) AS txid, input_index, nullif(lower(hex(prev_txid)), '') AS prev_txid,
+       prev_vout, script_sig, sequence
+FROM tx_input_bin;
+
+-- Transaction Outputs Table: amounts in integer satoshis, as in schema.sql.
+CREATE TABLE IF NOT EXISTS tx_output_bin (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    txid BLOB NOT NULL,
+    output_index INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    FOREIGN KEY (txid) REFERENCES transactions_bin(txid)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_output_bin_txid ON tx_output_bin(txid, output_index);
+
+CREATE VIEW IF NOT EXISTS tx_output AS
+SELECT id, lower(hex(txid)) AS txid, output_index, value_sat / 100000000.0 AS value, value_sat,
+       script_pubkey
+FROM tx_output_bin;
+
+-- UTXO Table: the currently unspent outputs (OP_RETURN outputs excluded),
+-- maintained by the ingester in the same transaction as each block.
+CREATE TABLE IF NOT EXISTS utxo_bin (
+    txid BLOB NOT NULL,
+    vout INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (txid, vout)
+) WITHOUT ROWID;
+
+-- Rollback removes the outputs created above the fork height.
+CREATE INDEX IF NOT EXISTS idx_utxo_bin_height ON utxo_bin(height);
+-- Balance of a script: one indexed range read.
+CREATE INDEX IF NOT EXISTS idx_utxo_bin_script ON utxo_bin(script_pubkey);
+
+-- Hex view of the unspent outputs.
+CREATE VIEW IF NOT EXISTS utxo AS
+SELECT lower(hex(txid)) AS txid, vout, value_sat, script_pubkey, height
+FROM utxo_bin;
+
+-- Outputs spent by the most recent blocks, restored on rollback.
+CREATE TABLE IF NOT EXISTS utxo_undo (
+    height INTEGER NOT NULL,
+    txid BLOB NOT NULL,
+    vout INTEGER NOT NULL,
+    value_sat INTEGER NOT NULL,
+    script_pubkey TEXT,
+    created_height INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_utxo_undo_height ON utxo_undo(height);
+
+-- Running totals of the UTXO set (supply), updated with every commit.
+CREATE TABLE IF NOT EXISTS utxo_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    height INTEGER,
+    utxo_count INTEGER NOT NULL,
+    total_sat INTEGER NOT NULL
+);
+
+-- Address index: the net balance change of every standard address
+-- (P2PKH, P2SH, P2WPKH, P2WSH, P2TR) in every transaction that pays or
+-- spends from it. Use it instead of searching script_pubkey.
+CREATE TABLE IF NOT EXISTS address_activity_bin (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    txid BLOB NOT NULL,
+    delta_sat INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_address_activity_bin_address ON address_activity_bin(address, height);
+CREATE INDEX IF NOT EXISTS idx_address_activity_bin_height ON address_activity_bin(height);
+
+CREATE VIEW IF NOT EXISTS address_activity AS
+SELECT address, height, lower(hex(txid)) AS txid, delta_sat
+FROM address_activity_bin;
+
+-- Current balance per address.
+CREATE TABLE IF NOT EXISTS address_balance (
+    address TEXT PRIMARY KEY,
+    balance_sat INTEGER NOT NULL,
+    activity_count INTEGER NOT NULL,
+    checkpoint_count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Periodic balances, so the balance at a height reads a checkpoint plus a
+-- bounded range of address_activity.
+CREATE TABLE IF NOT EXISTS address_checkpoint (
+    address TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    balance_sat INTEGER NOT NULL,
+    activity_count INTEGER NOT NULL,
+    PRIMARY KEY (address, height)
+) WITHOUT ROWID;
+
+-- Rollups: totals per block, per UTC day and per difficulty epoch (2016
+-- blocks), maintained with every commit. Rebuild with rollups.py --rebuild.
+-- fee_sat is the coinbase value above the block subsidy.
+CREATE TABLE IF NOT EXISTS block_stats (
+    height INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_block_stats_tx_count ON block_stats(tx_count);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT PRIMARY KEY,
+    blocks INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS epoch_stats (
+    epoch INTEGER PRIMARY KEY,
+    blocks INTEGER NOT NULL,
+    tx_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    input_count INTEGER NOT NULL,
+    output_count INTEGER NOT NULL,
+    output_sat INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL
+);
+
+-- Fee, virtual size and feerate (sat/vB) of every non-coinbase transaction,
+-- computed at ingest from the amounts of the outputs it spends.
+CREATE TABLE IF NOT EXISTS tx_fee_bin (
+    txid BLOB PRIMARY KEY,
+    height INTEGER NOT NULL,
+    fee_sat INTEGER NOT NULL,
+    vsize INTEGER NOT NULL,
+    feerate REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_tx_fee_bin_height ON tx_fee_bin(height);
+
+CREATE VIEW IF NOT EXISTS tx_fee AS
+SELECT lower(hex(txid)) AS txid, height, fee_sat, vsize, feerate
+FROM tx_fee_bin;
+
+-- Sync State Table: The last block fully committed by update_db.py.
+CREATE TABLE IF NOT EXISTS sync_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    height INTEGER NOT NULL,
+    hash VARCHAR(255) NOT NULL
+);
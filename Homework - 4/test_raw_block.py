@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+from decimal import Decimal
+
+from blk_import import NETWORK_MAGIC, import_blocks, xor_bytes
+from block_writer import decode_block, load_sync_state, materialize
+from raw_block import bits_to_difficulty, parse_block, read_varint
+from test_update_db import make_database, remove_database
+from utxo import supply
+
+GENESIS_HEADER = (
+    "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e"
+    "67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c"
+)
+GENESIS_COINBASE_SCRIPT = (
+    "04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b"
+    "206f66207365636f6e64206261696c6f757420666f722062616e6b73"
+)
+GENESIS_PUBKEY_SCRIPT = (
+    "4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec1"
+    "12de5c384df7ba0b8d578a4c702b6bf11d5fac"
+)
+GENESIS_TX = (
+    "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d"
+    + GENESIS_COINBASE_SCRIPT + "ffffffff0100f2052a0100000043" + GENESIS_PUBKEY_SCRIPT + "00000000"
+)
+GENESIS_BLOCK = bytes.fromhex(GENESIS_HEADER + "01" + GENESIS_TX)
+
+# getblock <genesis> 2 as bitcoind prints it.
+GENESIS_JSON = """{
+  "hash": "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f",
+  "confirmations": 890000, "height": 0, "version": 1, "versionHex": "00000001",
+  "merkleroot": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+  "time": 1231006505, "mediantime": 1231006505, "nonce": 2083236893, "bits": "1d00ffff",
+  "difficulty": 1, "chainwork": "0000000000000000000000000000000000000000000000000000000100010001",
+  "nTx": 1, "nextblockhash": "00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048",
+  "strippedsize": 285, "size": 285, "weight": 1140,
+  "tx": [{
+    "txid": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+    "hash": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+    "version": 1, "size": 204, "vsize": 204, "weight": 816, "locktime": 0,
+    "vin": [{"coinbase": "%s", "sequence": 4294967295}],
+    "vout": [{"value": 50.00000000, "n": 0, "scriptPubKey": {"hex": "%s", "type": "pubkey"}}]
+  }]
+}""" % (GENESIS_COINBASE_SCRIPT, GENESIS_PUBKEY_SCRIPT)
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def segwit_transaction():
+    """
+    Builds a one-input, two-output segwit transaction and returns
+    (serialized, serialized without witness).
+    """
+    version = struct.pack("<i", 2)
+    txin = bytes(range(32)) + struct.pack("<I", 1) + b"\x00" + struct.pack("<I", 0xfffffffd)
+    outputs = (
+        struct.pack("<Q", 12345) + b"\x16" + bytes.fromhex("0014" + "ab" * 20)
+        + struct.pack("<Q", 2100000000000000) + b"\x22" + bytes.fromhex("5120" + "cd" * 32)
+    )
+    body = b"\x01" + txin + b"\x02" + outputs
+    witness = b"\x02" + b"\x47" + b"\x30" * 71 + b"\x21" + b"\x02" * 33
+    locktime = struct.pack("<I", 800000)
+    return version + b"\x00\x01" + body + witness + locktime, version + body + locktime
+
+
+def build_block(prev_hash, height, tag, block_time):
+    """
+    Serializes a block with a single BIP34 coinbase transaction on top of
+    `prev_hash` (raw bytes, internal byte order). Returns (block, block hash).
+    """
+    script = b"\x03" + height.to_bytes(3, "little") + tag
+    coinbase = (
+        struct.pack("<i", 1) + b"\x01" + b"\x00" * 32 + b"\xff" * 4 + bytes([len(script)]) + script
+        + b"\xff" * 4 + b"\x01" + struct.pack("<Q", 50 * 100_000_000) + b"\x01\x51" + b"\x00" * 4
+    )
+    header = struct.pack("<i32s32sIII", 4, prev_hash, double_sha256(coinbase), block_time, 0x1d00ffff, 0)
+    return header + b"\x01" + coinbase, double_sha256(header)
+
+
+class TestRawBlockParser(unittest.TestCase):
+
+    def test_genesis_block_hashes(self):
+        """Block hash, merkle root and txid match the real genesis block."""
+        block = parse_block(GENESIS_BLOCK)
+        self.assertEqual(block["hash"], "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")
+        self.assertEqual(block["tx"][0]["txid"], block["merkleroot"])
+        self.assertIsNone(block["previousblockhash"])
+        self.assertEqual((block["size"], block["strippedsize"], block["weight"]), (285, 285, 1140))
+
+    def test_rows_match_json_path(self):
+        """Raw decoding with header fields yields the same rows as getblock verbosity=2."""
+        expected = json.loads(GENESIS_JSON)
+        header = {key: expected[key] for key in ("height", "confirmations", "mediantime",
+                                                 "difficulty", "chainwork", "nextblockhash")}
+        raw_rows = materialize(decode_block(parse_block(GENESIS_BLOCK, header)))
+        json_rows = materialize(decode_block(expected))
+        self.assertEqual(raw_rows, json_rows)
+
+    def test_segwit_transaction(self):
+        """txid skips the witness, wtxid covers it, and sizes follow BIP141."""
+        full, stripped = segwit_transaction()
+        block = parse_block(bytes.fromhex(GENESIS_HEADER) + b"\x01" + full)
+        tx = block["tx"][0]
+        self.assertEqual(tx["txid"], double_sha256(stripped)[::-1].hex())
+        self.assertEqual(tx["hash"], double_sha256(full)[::-1].hex())
+        self.assertEqual((tx["size"], tx["weight"]), (len(full), len(stripped) * 3 + len(full)))
+        self.assertEqual(tx["vsize"], (tx["weight"] + 3) // 4)
+        self.assertEqual(tx["vin"][0]["txid"], bytes(range(32))[::-1].hex())
+        self.assertEqual(len(tx["vin"][0]["txinwitness"]), 2)
+        self.assertEqual([o["value"] for o in tx["vout"]], [Decimal("0.00012345"), Decimal("21000000")])
+        self.assertEqual(tx["locktime"], 800000)
+        self.assertEqual(block["strippedsize"], 81 + len(stripped))
+
+    def test_varint_sizes(self):
+        """All four CompactSize encodings are decoded."""
+        data = memoryview(bytes.fromhex("fc" "fdfd00" "fe00000100" "ff0000000001000000"))
+        pos, values = 0, []
+        while pos < len(data):
+            value, pos = read_varint(data, pos)
+            values.append(value)
+        self.assertEqual(values, [0xfc, 0xfd, 0x10000, 1 << 32])
+
+    def test_difficulty_from_bits(self):
+        """Difficulty matches bitcoind for genesis and block 100000."""
+        self.assertEqual(bits_to_difficulty(0x1d00ffff), 1.0)
+        self.assertAlmostEqual(bits_to_difficulty(0x1b04864c), 14484.1623612254, places=6)
+
+
+class TestBlockFileImport(unittest.TestCase):
+
+    KEY = bytes.fromhex("a1b2c3d4e5f60718")
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.datadir, "blocks"))
+        with open(os.path.join(self.datadir, "blocks", "xor.dat"), "wb") as f:
+            f.write(self.KEY)
+        self.db_path = make_database()
+
+        # Main chain genesis -> a1 -> a2 -> a3, plus a stale block b2 on a1.
+        self.blocks = {"genesis": (GENESIS_BLOCK, double_sha256(GENESIS_BLOCK[:80]))}
+        prev = self.blocks["genesis"][1]
+        for height, name in enumerate(["a1", "a2", "a3", "a4"], start=1):
+            self.blocks[name] = build_block(prev, height, name.encode(), 1231006505 + 600 * height)
+            prev = self.blocks[name][1]
+        self.blocks["b2"] = build_block(self.blocks["a1"][1], 2, b"stale", 1231007800)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+        remove_database(self.db_path)
+
+    def write_block_file(self, name, order):
+        """
+        Writes the named blocks as an obfuscated blk*.dat file with the
+        trailing zero padding Bitcoin Core preallocates.
+        """
+        data = b"".join(
+            NETWORK_MAGIC["main"] + struct.pack("<I", len(self.blocks[b][0])) + self.blocks[b][0]
+            for b in order
+        ) + b"\x00" * 256
+        with open(os.path.join(self.datadir, "blocks", name), "wb") as f:
+            f.write(xor_bytes(data, self.KEY, 0))
+
+    def stored_hashes(self):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT height, hash FROM block ORDER BY height").fetchall()
+        conn.close()
+        return rows
+
+    def test_imports_best_chain_in_height_order(self):
+        """Out-of-order and stale blocks are resolved through prev-hash links."""
+        self.write_block_file("blk00000.dat", ["a2", "genesis", "b2", "a3", "a1"])
+        self.assertEqual(import_blocks(self.datadir, self.db_path), 4)
+        expected = [(h, self.blocks[n][1][::-1].hex()) for h, n in enumerate(["genesis", "a1", "a2", "a3"])]
+        self.assertEqual(self.stored_hashes(), expected)
+
+        conn = sqlite3.connect(self.db_path)
+        genesis = conn.execute(
+            "SELECT chainwork, confirmations, nextblockhash FROM block WHERE height = 0"
+        ).fetchone()
+        self.assertEqual(genesis, ("%064x" % 0x100010001, 4, expected[1][1]))
+        self.assertEqual(load_sync_state(conn), expected[-1])
+        conn.close()
+
+    def test_import_maintains_derived_tables(self):
+        """The UTXO set and rollups are filled, so tip following can continue them."""
+        self.write_block_file("blk00000.dat", ["genesis", "a1", "a2", "a3"])
+        import_blocks(self.datadir, self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(supply(conn), (3, 4, 4 * 50 * 100_000_000))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM block_stats").fetchone()[0], 4)
+        conn.close()
+
+    def test_import_resumes_after_checkpoint(self):
+        """A second import only adds blocks that extend the checkpoint."""
+        self.write_block_file("blk00000.dat", ["genesis", "a1", "a2", "a3"])
+        import_blocks(self.datadir, self.db_path)
+        self.write_block_file("blk00001.dat", ["a4"])
+        self.assertEqual(import_blocks(self.datadir, self.db_path), 1)
+        self.assertEqual(self.stored_hashes()[-1], (4, self.blocks["a4"][1][::-1].hex()))
+
+    def test_start_height_skips_lower_blocks(self):
+        """--start-height skips blocks below it; stored heights still count from genesis."""
+        self.write_block_file("blk00000.dat", ["genesis", "a1", "a2", "a3", "a4"])
+        self.assertEqual(import_blocks(self.datadir, self.db_path, start_height=2), 3)
+        expected = [(h, self.blocks[n][1][::-1].hex()) for h, n in [(2, "a2"), (3, "a3"), (4, "a4")]]
+        self.assertEqual(self.stored_hashes(), expected)
+
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute("SELECT chainwork, confirmations FROM block WHERE height = 2").fetchone(),
+            ("%064x" % (3 * 0x100010001), 3)
+        )
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1716 @@
+import hashlib
+import json
+import os
+import pstats
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
+
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import profiling
+from address_index import AddressIndex, balance_at, script_to_address
+from async_rpc import AsyncBitcoinRPC, fetch_blocks_ordered
+from backfill import backfill
+from block_notify import LocalBlockPublisher, LongPollNotifier, PollingNotifier, ZMQBlockNotifier, follow
+from block_writer import BlockWriter, default_extensions
+from db_connection import connect
+from explain_queries import report
+from fees import TransactionFees
+from header_store import (HeaderStore, HeaderStoreWriter, block_work, chainwork_to_float, cumulative_work,
+                          difficulty_from_bits, interval_stats, rolling_hashrate,
+                          default_path as default_header_path, main as header_store_main)
+from indexes import MANAGED_INDEXES, create_indexes, missing_indexes
+from json_stream import StreamedBlock
+from local_testing.mock_bitcoind import MockBitcoind, MockChain, record_fixture
+from migrate_hash_blobs import migrate as migrate_hash_blobs
+from migrate_satoshis import migrate
+from pipeline import BlockPipeline
+from raw_block import parse_block
+from reorg import HeaderWindow, rollback_to
+from rollups import block_subsidy, rebuild as rebuild_rollups
+from update_db import BitcoinRPC, load_sync_state, record_node_tip, sync_to_tip, update_database
+from utxo import UtxoSet, balance, supply
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+SCHEMA_BLOB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_blob.sql")
+
+
+class FakeNodeHandler(BaseHTTPRequestHandler):
+    """
+    Answers single and batched JSON-RPC requests the way bitcoind does,
+    delegating each call to FakeNode.answer.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        request = json.loads(body)
+        self.server.request_count += 1
+        status = 200
+        if isinstance(request, list) and self.server.reject_batches:
+            # What bitcoind sends for a batch it cannot process.
+            reply = {"result": None, "error": {"code": -32600, "message": "Invalid Request object"}, "id": None}
+            status = 500
+        elif isinstance(request, list):
+            # Answer in reverse order to check that replies are matched by id.
+            reply = [self.server.answer(item) for item in reversed(request)]
+        else:
+            reply = self.server.answer(request)
+        data = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeNode(ThreadingHTTPServer):
+    """
+    A tiny in-process stand-in for bitcoind with a chain of fake block hashes.
+    """
+
+    def __init__(self, chain_length=100):
+        super().__init__(("127.0.0.1", 0), FakeNodeHandler)
+        self.request_count = 0
+        self.hashes = [f"{height:064x}" for height in range(chain_length)]
+        self.outputs_per_tx = 2
+        self.txs_per_block = None
+        self.spend_across_blocks = False
+        self.reject_batches = False
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def answer(self, request):
+        method, params = request["method"], request.get("params", [])
+        if method == "getblockhash":
+            height = params[0]
+            if 0 <= height < len(self.hashes):
+                return {"result": self.hashes[height], "error": None, "id": request["id"]}
+            error = {"code": -8, "message": "Block height out of range"}
+            return {"result": None, "error": error, "id": request["id"]}
+        if method == "getblock":
+            height = self.hashes.index(params[0])
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            # Lower heights answer slower so blocks arrive out of order.
+            time.sleep(0.02 * (height % 4))
+            with self.lock:
+                self.in_flight -= 1
+            block = self.block(height)
+            return {"result": block, "error": None, "id": request["id"]}
+        if method == "getblockheader" and params[0] in self.hashes:
+            header = self.block(self.hashes.index(params[0]))
+            del header["tx"]
+            return {"result": header, "error": None, "id": request["id"]}
+        if method == "getbestblockhash":
+            return {"result": self.hashes[-1], "error": None, "id": request["id"]}
+        if method == "waitfornewblock":
+            tip, deadline = self.hashes[-1], time.monotonic() + params[0] / 1000
+            while self.hashes[-1] == tip and time.monotonic() < deadline:
+                time.sleep(0.005)
+            tip = {"hash": self.hashes[-1], "height": len(self.hashes) - 1}
+            return {"result": tip, "error": None, "id": request["id"]}
+        if method == "getrawtransaction":
+            for height in range(len(self.hashes)):
+                for tx in self.block(height)["tx"]:
+                    if tx["txid"] == params[0]:
+                        return {"result": tx, "error": None, "id": request["id"]}
+            error = {"code": -5, "message": "No such mempool or blockchain transaction"}
+            return {"result": None, "error": error, "id": request["id"]}
+        if method == "getblockcount":
+            return {"result": len(self.hashes) - 1, "error": None, "id": request["id"]}
+        error = {"code": -32601, "message": "Method not found"}
+        return {"result": None, "error": error, "id": request["id"]}
+
+    def block(self, height):
+        """
+        Builds a getblock verbosity=2 style result for `height`: a coinbase
+        followed by transactions that each spend the previous one. With
+        spend_across_blocks the first of them also spends output 1 of the
+        previous block's coinbase.
+        """
+        txs = []
+        for i in range(self.txs_per_block or height % 3 + 1):
+            txid = hashlib.sha256(f"{self.hashes[height]}:{i}".encode()).hexdigest()
+            if i == 0:
+                vin = [{"coinbase": f"03{height:06x}", "sequence": 4294967295}]
+            else:
+                vin = [{"txid": txs[-1]["txid"], "vout": 0, "scriptSig": {"asm": "", "hex": ""},
+                        "sequence": 4294967293}]
+                if i == 1 and self.spend_across_blocks and height:
+                    coinbase = hashlib.sha256(f"{self.hashes[height - 1]}:0".encode()).hexdigest()
+                    vin.append({"txid": coinbase, "vout": 1, "scriptSig": {"asm": "", "hex": ""},
+                                "sequence": 4294967293})
+            vout = [
+                {"value": 0.5 + n, "n": n, "scriptPubKey": {"hex": f"0014{n:040x}"}}
+                for n in range(self.outputs_per_tx)
+            ]
+            txs.append({"txid": txid, "version": 2, "locktime": 0, "size": 200 + i, "weight": 800 + i,
+                        "vin": vin, "vout": vout})
+        return {
+            "hash": self.hashes[height], "confirmations": len(self.hashes) - height, "height": height,
+            "version": 4, "versionHex": "00000004", "merkleroot": "00" * 32, "time": 1600000000 + 600 * height,
+            "mediantime": 1600000000 + 600 * height - 3000, "nonce": height, "bits": "1d00ffff",
+            "difficulty": 1.0, "chainwork": f"{height + 1:064x}", "nTx": len(txs),
+            "previousblockhash": self.hashes[height - 1] if height else None,
+            "nextblockhash": self.hashes[height + 1] if height + 1 < len(self.hashes) else None,
+            "strippedsize": 1000, "size": 1200, "weight": 4000, "tx": txs
+        }
+
+    def reorg(self, fork_height, new_length):
+        """
+        Replaces every block above `fork_height` with a competing branch
+        that is `new_length` blocks long in total.
+        """
+        self.hashes[fork_height + 1:] = [
+            hashlib.sha256(f"branch:{h}".encode()).hexdigest() for h in range(fork_height + 1, new_length)
+        ]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def make_rpc(node, **kwargs):
+    """
+    Points a BitcoinRPC client at the fake node.
+    """
+    host, port = node.server_address
+    os.environ["RPC_HOST"] = host
+    os.environ["RPC_PORT"] = str(port)
+    os.environ["RPC_USERNAME"] = "user"
+    os.environ["RPC_PASSWORD"] = "pass"
+    return BitcoinRPC(**kwargs)
+
+
+class TestBatchRPC(unittest.TestCase):
+
+    def test_call_batch_matches_results_by_id(self):
+        """Batched replies arriving out of order are matched to their calls."""
+        with FakeNode() as node:
+            rpc = make_rpc(node)
+            results = rpc.call_batch([("getblockhash", [5]), ("getblockcount", []), ("getblockhash", [7])])
+        self.assertEqual(results, [(node.hashes[5], None), (99, None), (node.hashes[7], None)])
+
+    def test_call_batch_reports_errors_per_item(self):
+        """A failing item does not hide the results of the other items."""
+        with FakeNode() as node:
+            rpc = make_rpc(node)
+            results = rpc.call_batch([("getblockhash", [1]), ("getblockhash", [500])])
+        self.assertEqual(results[0], (node.hashes[1], None))
+        self.assertIsNone(results[1][0])
+        self.assertEqual(results[1][1]["code"], -8)
+
+    def test_call_batch_reports_rejected_batch(self):
+        """A single error object answering the whole batch becomes each item's error."""
+        with FakeNode() as node:
+            node.reject_batches = True
+            rpc = make_rpc(node)
+            results = rpc.call_batch([("getblockhash", [1]), ("getblockhash", [2])])
+        self.assertEqual([result for result, _ in results], [None, None])
+        for _, error in results:
+            self.assertIn("Invalid Request object", error)
+
+    def test_call_batch_limits_batch_size(self):
+        """Large batches are split into chunks of at most batch_size calls."""
+        with FakeNode() as node:
+            rpc = make_rpc(node)
+            results = rpc.call_batch([("getblockhash", [h]) for h in range(70)], batch_size=32)
+            self.assertEqual(node.request_count, 3)
+        self.assertEqual([r for r, _ in results], node.hashes[:70])
+
+    def test_get_block_hashes_range(self):
+        """A whole height range of hashes is fetched in one round trip."""
+        with FakeNode() as node:
+            rpc = make_rpc(node)
+            hashes = rpc.get_block_hashes(10, 20)
+            self.assertEqual(node.request_count, 1)
+        self.assertEqual(hashes, node.hashes[10:21])
+
+
+class TestPooledTransport(unittest.TestCase):
+
+    def test_sequential_calls_reuse_one_connection(self):
+        """Keep-alive lets consecutive calls share a single TCP connection."""
+        with FakeNode() as node:
+            rpc = make_rpc(node)
+            for height in range(10):
+                self.assertEqual(rpc.call("getblockhash", [height]), node.hashes[height])
+            stats = rpc.connection_stats.snapshot()
+            rpc.close()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["requests"], 10)
+        self.assertEqual(rpc.connection_stats.total_reused(), 9)
+
+    def test_threads_share_bounded_pool(self):
+        """Concurrent callers never open more connections than the pool size."""
+        with FakeNode() as node:
+            rpc = make_rpc(node, pool_size=2)
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                hashes = list(pool.map(lambda h: rpc.call("getblockhash", [h]), range(40)))
+            stats = rpc.connection_stats.snapshot()
+            rpc.close()
+        self.assertEqual(hashes, node.hashes[:40])
+        self.assertLessEqual(len(stats), 2)
+        self.assertEqual(sum(c["requests"] for c in stats.values()), 40)
+
+
+class TestAsyncRPC(unittest.TestCase):
+
+    def test_blocks_are_delivered_in_height_order(self):
+        """Pipelined getblock calls are handed over strictly by height."""
+        received = []
+        with FakeNode() as node:
+            make_rpc(node)
+            last = fetch_blocks_ordered(3, 40, lambda h, b: received.append((h, b["hash"])), concurrency=8)
+            self.assertGreater(node.max_in_flight, 1)
+            self.assertLessEqual(node.max_in_flight, 8)
+        self.assertEqual(last, 40)
+        self.assertEqual(received, [(h, node.hashes[h]) for h in range(3, 41)])
+
+    def test_fetch_stops_at_missing_block(self):
+        """The ordered stream stops at the first height the node cannot serve."""
+        received = []
+        with FakeNode(chain_length=20) as node:
+            make_rpc(node)
+            last = fetch_blocks_ordered(15, 30, lambda h, b: received.append(h), concurrency=4)
+        self.assertEqual(last, 19)
+        self.assertEqual(received, list(range(15, 20)))
+
+    def test_concurrency_is_capped_by_work_queue(self):
+        """Requested concurrency never exceeds the node's rpcworkqueue."""
+        self.assertEqual(AsyncBitcoinRPC(concurrency=1000).concurrency, 32)
+
+
+def make_database(schema_path=SCHEMA_PATH):
+    """
+    Creates an empty blockchain database from schema.sql (or another schema
+    file) and returns its path.
+    """
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    conn.close()
+    return path
+
+
+def remove_database(path):
+    """
+    Deletes a database created by make_database, including WAL side files
+    and the header store next to it.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.rmtree(default_header_path(path), ignore_errors=True)
+
+
+def dump_tables(conn):
+    """
+    Returns the contents of the four block tables, in a comparable form.
+    """
+    return {
+        table: sorted(conn.execute(f"SELECT {columns} FROM {table}").fetchall(), key=repr)
+        for table, columns in [
+            ("block", "hash, height, ntx, merkleroot, previousblockhash, nextblockhash, weight"),
+            ("transactions", "txid, block_hash, version, locktime, size, weight"),
+            ("tx_input", "txid, input_index, prev_txid, prev_vout, script_sig, sequence"),
+            ("tx_output", "txid, output_index, value, value_sat, script_pubkey"),
+        ]
+    }
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_backfill_commits_range_in_height_order(self):
+        """Every block of the range and its transactions are committed in order."""
+        with FakeNode() as node:
+            make_rpc(node)
+            last = backfill(self.db_path, 10, 49, workers=4, checkpoint_every=7)
+        self.assertEqual(last, 49)
+        conn = sqlite3.connect(self.db_path)
+        heights = [row[0] for row in conn.execute("SELECT height FROM block ORDER BY id")]
+        tx_count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        conn.close()
+        self.assertEqual(heights, list(range(10, 50)))
+        self.assertEqual(tx_count, sum(h % 3 + 1 for h in range(10, 50)))
+
+    def test_backfill_stops_at_chain_end(self):
+        """Heights beyond the node's tip end the run at the last good block."""
+        with FakeNode(chain_length=30) as node:
+            make_rpc(node)
+            last = backfill(self.db_path, 20, 40, workers=2)
+        self.assertEqual(last, 29)
+
+
+class TestBlockPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_pipeline_writes_what_sequential_sync_writes(self):
+        """Blocks decoded in worker processes from shared memory match a sequential sync, and no segment leaks."""
+        segments = set(os.listdir("/dev/shm"))
+        sequential_path = make_database()
+        try:
+            with FakeNode(chain_length=40) as node:
+                make_rpc(node)
+                self.assertEqual(backfill(self.db_path, 0, 39, workers=4, decoders=2, checkpoint_every=9), 39)
+                conn = connect(sequential_path, "ingest")
+                sync_to_tip(conn, make_rpc(node), start_height=0)
+                expected = dump_tables(conn)
+                conn.close()
+            conn = sqlite3.connect(self.db_path)
+            self.assertEqual(dump_tables(conn), expected)
+            conn.close()
+        finally:
+            remove_database(sequential_path)
+        self.assertEqual(set(os.listdir("/dev/shm")), segments)
+
+    def test_slow_writer_applies_backpressure(self):
+        """Fetching stays at most `window` blocks ahead of the writer, which is reported as the bottleneck."""
+        written, ahead = [], []
+
+        class SlowWriter:
+            def add_decoded(self, decoded):
+                ahead.append(pipeline.stats["fetch"].items - len(written))
+                written.append(decoded.height)
+                time.sleep(0.03)
+
+        with FakeNode(chain_length=40) as node:
+            pipeline = BlockPipeline(make_rpc(node), SlowWriter(), fetchers=4, decoders=2, window=5)
+            self.assertEqual(pipeline.run(0, 39), 39)
+        self.assertEqual(written, list(range(40)))
+        self.assertLessEqual(max(ahead), 5)
+        self.assertIn("bottleneck: write", pipeline.report())
+
+    def test_failed_stage_is_raised(self):
+        """A fetcher that cannot create its shared memory segment stops the run instead of hanging it."""
+        written = []
+
+        class Writer:
+            def add_decoded(self, decoded):
+                written.append(decoded.height)
+
+        with FakeNode(chain_length=10) as node, \
+                mock.patch("pipeline.shared_memory.SharedMemory", side_effect=OSError("No space left on device")):
+            pipeline = BlockPipeline(make_rpc(node), Writer(), fetchers=2, decoders=1)
+            with self.assertRaisesRegex(OSError, "No space left"):
+                pipeline.run(0, 9)
+        self.assertEqual(written, [])
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_backfill_builds_indexes_once_at_the_end(self):
+        """Bulk loads write without the managed indexes and rebuild and ANALYZE them afterwards."""
+        missing_during_load = []
+        real_flush = BlockWriter.flush
+
+        def recording_flush(writer):
+            missing_during_load.append(len(missing_indexes(writer.conn)))
+            real_flush(writer)
+
+        with FakeNode(chain_length=30) as node:
+            make_rpc(node)
+            with mock.patch.object(BlockWriter, "flush", recording_flush):
+                backfill(self.db_path, 0, 29, workers=2, checkpoint_every=10)
+        conn = connect(self.db_path)
+        # idx_block_height stays: the rollups and header store read blocks by height.
+        self.assertEqual(set(missing_during_load), {len(MANAGED_INDEXES) - 1})
+        self.assertEqual(missing_indexes(conn), [])
+        stats = {row[0] for row in conn.execute("SELECT idx FROM sqlite_stat1")}
+        conn.close()
+        self.assertIn("idx_block_height", stats)
+
+    def test_rebuild_removes_rows_duplicated_without_unique_index(self):
+        """Re-ingested blocks from a re-run bulk load are deduplicated before the unique index is built."""
+        conn = connect(self.db_path, "ingest")
+        conn.execute("DROP INDEX idx_tx_output_sat_txid")
+        conn.execute("DROP INDEX idx_block_hash")
+        with FakeNode(chain_length=3) as node:
+            writer = BlockWriter(conn)
+            writer.add_block(node.block(2))
+            writer.add_block(node.block(2))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM tx_output").fetchone()[0], 12)
+        self.assertEqual(create_indexes(conn), ["idx_block_hash", "idx_tx_output_sat_txid"])
+        counts = conn.execute("SELECT (SELECT COUNT(*) FROM block), (SELECT COUNT(*) FROM tx_output)").fetchone()
+        conn.close()
+        self.assertEqual(counts, (1, 6))
+
+    def test_explain_flags_full_scans(self):
+        """Queries that cannot use an index are reported; indexed lookups are not."""
+        conn = connect(self.db_path)
+        lookup = "SELECT hash FROM block WHERE height = 500000"
+        ranking = "SELECT hash FROM block ORDER BY difficulty DESC LIMIT 1"
+        with mock.patch("builtins.print"):
+            flagged = report(conn, [lookup, ranking])
+        conn.close()
+        self.assertEqual(flagged, [(ranking, ["SCAN block"])])
+
+
+class TestIncrementalSync(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def heights(self):
+        return [row[0] for row in self.conn.execute("SELECT height FROM block ORDER BY height")]
+
+    def test_sync_ingests_every_block_up_to_tip(self):
+        """Each cycle ingests all blocks mined since the last checkpoint."""
+        with FakeNode(chain_length=20) as node:
+            rpc = make_rpc(node)
+            self.assertEqual(sync_to_tip(self.conn, rpc, start_height=5), 15)
+            node.hashes.extend(f"{h:064x}" for h in range(20, 26))
+            self.assertEqual(sync_to_tip(self.conn, rpc), 6)
+            self.assertEqual(sync_to_tip(self.conn, rpc), 0)
+        self.assertEqual(self.heights(), list(range(5, 26)))
+        self.assertEqual(load_sync_state(self.conn), (25, node.hashes[25]))
+
+    def test_killed_sync_resumes_without_duplicates(self):
+        """A crash mid-cycle resumes after the last committed block."""
+        real_add_block = BlockWriter.add_block
+
+        def crash_at_25(writer, block_data):
+            if block_data["height"] == 25:
+                raise KeyboardInterrupt
+            real_add_block(writer, block_data)
+
+        with FakeNode(chain_length=30) as node:
+            rpc = make_rpc(node)
+            with mock.patch.object(BlockWriter, "add_block", crash_at_25):
+                with self.assertRaises(KeyboardInterrupt):
+                    sync_to_tip(self.conn, rpc, start_height=10, commit_every=5)
+            self.conn.rollback()
+            self.assertEqual(load_sync_state(self.conn)[0], 24)
+            self.assertEqual(sync_to_tip(self.conn, rpc), 5)
+        self.assertEqual(self.heights(), list(range(10, 30)))
+
+
+class TestReorg(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def test_reorg_rolls_back_and_ingests_new_branch(self):
+        """Orphaned blocks and transactions are replaced by the new branch."""
+        with FakeNode(chain_length=30) as node:
+            rpc = make_rpc(node)
+            sync_to_tip(self.conn, rpc, start_height=0)
+            node.reorg(fork_height=24, new_length=33)
+            sync_to_tip(self.conn, rpc)
+            expected_txids = {
+                tx["txid"] for h in range(33) for tx in node.block(h)["tx"]
+            }
+        stored = self.conn.execute("SELECT hash FROM block ORDER BY height").fetchall()
+        txids = {row[0] for row in self.conn.execute("SELECT txid FROM transactions")}
+        self.assertEqual([row[0] for row in stored], node.hashes)
+        self.assertEqual(txids, expected_txids)
+        output_txids = {row[0] for row in self.conn.execute("SELECT txid FROM tx_output")}
+        input_txids = {row[0] for row in self.conn.execute("SELECT txid FROM tx_input")}
+        self.assertEqual(output_txids, expected_txids)
+        self.assertEqual(input_txids, expected_txids)
+        self.assertEqual(load_sync_state(self.conn), (32, node.hashes[32]))
+
+    def test_header_window_detects_broken_link(self):
+        """A block whose parent differs from the stored hash is rejected."""
+        window = HeaderWindow(size=3)
+        for height in range(10):
+            window.add(height, f"hash{height}")
+        self.assertEqual(list(window.hashes), [7, 8, 9])
+        self.assertTrue(window.connects(10, "hash9"))
+        self.assertFalse(window.connects(10, "other"))
+
+    def test_rollback_uses_indexes(self):
+        """Rollback deletes by indexed lookups instead of table scans."""
+        plans = [
+            " ".join(row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, (0,)))
+            for sql in (
+                "DELETE FROM block WHERE height > ?",
+                "DELETE FROM transactions WHERE block_hash IN (SELECT hash FROM block WHERE height > ?)",
+                "DELETE FROM tx_output_sat WHERE txid IN (SELECT t.txid FROM block b "
+                "JOIN transactions t ON t.block_hash = b.hash WHERE b.height > ?)",
+            )
+        ]
+        for plan in plans:
+            self.assertNotIn("SCAN", plan)
+        rollback_to(self.conn.cursor(), 0)
+
+
+class TestBlockWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def test_commits_every_n_blocks(self):
+        """Blocks are committed in groups of blocks_per_commit with the checkpoint."""
+        with FakeNode(chain_length=25) as node:
+            writer = BlockWriter(self.conn, blocks_per_commit=10, track_sync_state=True)
+            for height in range(25):
+                writer.add_block(node.block(height))
+            self.assertEqual(writer.last_committed_height, 19)
+            self.assertEqual(len(writer.pending), 5)
+            self.assertEqual(load_sync_state(self.conn), (19, node.hashes[19]))
+            writer.flush()
+        self.assertEqual(load_sync_state(self.conn), (24, node.hashes[24]))
+        counts = self.conn.execute(
+            "SELECT (SELECT COUNT(*) FROM block), (SELECT COUNT(*) FROM transactions)"
+        ).fetchone()
+        self.assertEqual(counts, (25, sum(h % 3 + 1 for h in range(25))))
+
+    def test_failed_flush_leaves_no_partial_rows(self):
+        """A failing batch is rolled back as a whole."""
+        with FakeNode(chain_length=3) as node:
+            writer = BlockWriter(self.conn, blocks_per_commit=3)
+            broken = node.block(2)
+            broken["tx"][0] = {"txid": None}
+            writer.add_block(node.block(0))
+            writer.add_block(node.block(1))
+            with self.assertRaises(KeyError):
+                writer.add_block(broken)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM block").fetchone()[0], 0)
+
+    def test_inputs_and_outputs_are_written(self):
+        """vin/vout entries land in tx_input and tx_output, coinbase included."""
+        with FakeNode(chain_length=3) as node:
+            node.outputs_per_tx = 3000
+            writer = BlockWriter(self.conn)
+            writer.add_block(node.block(2))
+            block = node.block(2)
+        coinbase_txid = block["tx"][0]["txid"]
+        inputs = self.conn.execute(
+            "SELECT txid, prev_txid, prev_vout, script_sig FROM tx_input ORDER BY id"
+        ).fetchall()
+        self.assertEqual(inputs[0], (coinbase_txid, None, None, "03000002"))
+        self.assertEqual(inputs[1][1:3], (coinbase_txid, 0))
+        outputs = self.conn.execute(
+            "SELECT COUNT(*), SUM(value) FROM tx_output WHERE txid = ?", (coinbase_txid,)
+        ).fetchone()
+        self.assertEqual(outputs, (3000, sum(0.5 + n for n in range(3000))))
+        exact = self.conn.execute("SELECT SUM(value_sat) FROM tx_output_sat").fetchone()[0]
+        self.assertEqual(exact, 3 * sum(50_000_000 + n * 100_000_000 for n in range(3000)))
+        total = self.conn.execute("SELECT COUNT(*) FROM tx_output").fetchone()[0]
+        self.assertEqual(total, 3 * 3000)
+
+    def test_reingesting_a_block_adds_no_duplicate_rows(self):
+        """Writing the same block twice leaves one row per input and output."""
+        with FakeNode(chain_length=3) as node:
+            writer = BlockWriter(self.conn)
+            writer.add_block(node.block(2))
+            writer.add_block(node.block(2))
+        counts = self.conn.execute(
+            "SELECT (SELECT COUNT(*) FROM tx_input), (SELECT COUNT(*) FROM tx_output)"
+        ).fetchone()
+        self.assertEqual(counts, (3, 6))
+
+
+class TestSatoshiStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_decimal_amounts_are_stored_exactly(self):
+        """Amounts decoded as Decimal become exact satoshis and sum exactly."""
+        with FakeNode(chain_length=1) as node:
+            block = node.block(0)
+        block["tx"][0]["vout"] = [
+            {"value": Decimal("0.1"), "n": n, "scriptPubKey": {"hex": ""}} for n in range(10)
+        ] + [{"value": Decimal("20999999.99999999"), "n": 10, "scriptPubKey": {"hex": ""}}]
+        conn = sqlite3.connect(self.db_path)
+        BlockWriter(conn).add_block(block)
+        self.assertEqual(conn.execute("SELECT SUM(value_sat) FROM tx_output").fetchone()[0],
+                         100_000_000 + 2_099_999_999_999_999)
+        self.assertEqual(conn.execute("SELECT value FROM tx_output WHERE output_index = 0").fetchone()[0], 0.1)
+        conn.close()
+
+    def test_migration_converts_real_table_in_chunks(self):
+        """An old REAL tx_output table is copied chunk by chunk and replaced by the view."""
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript("""
+            DROP VIEW tx_output;
+            DROP TABLE tx_output_sat;
+            CREATE TABLE tx_output (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                txid VARCHAR(255) NOT NULL,
+                output_index INTEGER NOT NULL,
+                value REAL NOT NULL,
+                script_pubkey TEXT
+            );
+        """)
+        values = [0.1, 0.29, 1e-08, 20999999.99999999, 50.0] * 5
+        conn.executemany("INSERT INTO tx_output (txid, output_index, value, script_pubkey) VALUES (?, ?, ?, ?)",
+                         [(f"{i:064x}", 0, value, "51") for i, value in enumerate(values)])
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(migrate(self.db_path, chunk_size=7), len(values))
+        self.assertEqual(migrate(self.db_path), 0)
+        conn = sqlite3.connect(self.db_path)
+        stored = conn.execute("SELECT value_sat, value FROM tx_output ORDER BY id").fetchall()
+        kind = conn.execute("SELECT type FROM sqlite_master WHERE name = 'tx_output'").fetchone()[0]
+        conn.close()
+        self.assertEqual(kind, "view")
+        self.assertEqual([row[0] for row in stored],
+                         [10_000_000, 29_000_000, 1, 2_099_999_999_999_999, 5_000_000_000] * 5)
+        self.assertEqual([row[1] for row in stored], values)
+
+
+class TestBlobHashStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.hex_path = make_database()
+        self.blob_path = make_database(SCHEMA_BLOB_PATH)
+
+    def tearDown(self):
+        remove_database(self.hex_path)
+        remove_database(self.blob_path)
+
+    def sync_both(self, node):
+        for path in (self.hex_path, self.blob_path):
+            conn = connect(path, "ingest")
+            rpc = make_rpc(node)
+            sync_to_tip(conn, rpc, start_height=0)
+            conn.close()
+
+    def test_blob_database_presents_the_same_rows(self):
+        """Hashes stored as 32-byte BLOBs read back through the views exactly as hex storage."""
+        with FakeNode(chain_length=20) as node:
+            self.sync_both(node)
+            node.reorg(fork_height=14, new_length=22)
+            self.sync_both(node)
+        hex_conn, blob_conn = sqlite3.connect(self.hex_path), connect(self.blob_path)
+        self.assertEqual(dump_tables(blob_conn), dump_tables(hex_conn))
+        self.assertEqual(
+            blob_conn.execute("SELECT DISTINCT typeof(txid), length(txid) FROM transactions_bin").fetchall(),
+            [("blob", 32)]
+        )
+        self.assertIsNone(blob_conn.execute("SELECT previousblockhash FROM block WHERE height = 0").fetchone()[0])
+        txid = node.block(21)["tx"][0]["txid"]
+        found = blob_conn.execute(
+            "SELECT hash_hex(block_hash) FROM transactions_bin WHERE txid = hash_blob(?)", (txid,)
+        ).fetchone()
+        self.assertEqual(found, (node.hashes[21],))
+        hex_conn.close()
+        blob_conn.close()
+
+    def test_migration_converts_hex_database(self):
+        """A hex database is converted in chunks and ends up much smaller."""
+        with FakeNode(chain_length=40) as node:
+            node.txs_per_block = 50
+            node.outputs_per_tx = 1
+            conn = connect(self.hex_path, "ingest")
+            sync_to_tip(conn, make_rpc(node), start_height=0)
+            expected = dump_tables(conn)
+            utxos = conn.execute("SELECT * FROM utxo ORDER BY txid, vout").fetchall()
+            activity = conn.execute("SELECT * FROM address_activity ORDER BY rowid").fetchall()
+            fees = conn.execute("SELECT * FROM tx_fee ORDER BY txid").fetchall()
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+        hex_size = os.path.getsize(self.hex_path)
+
+        self.assertEqual(migrate_hash_blobs(self.hex_path, chunk_size=700, vacuum=True),
+                         sum(len(rows) for rows in expected.values()) + len(activity) + len(fees))
+        self.assertEqual(migrate_hash_blobs(self.hex_path), 0)
+        conn = connect(self.hex_path)
+        self.assertEqual(dump_tables(conn), expected)
+        self.assertEqual(conn.execute("SELECT * FROM utxo ORDER BY txid, vout").fetchall(), utxos)
+        self.assertEqual(conn.execute("SELECT * FROM address_activity").fetchall(), activity)
+        self.assertEqual(conn.execute("SELECT * FROM tx_fee ORDER BY txid").fetchall(), fees)
+        conn.close()
+        self.assertLess(os.path.getsize(self.hex_path), hex_size * 0.7)
+
+
+class TestUtxoSet(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = connect(self.db_path, "ingest")
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def expected_utxos(self, conn):
+        """
+        The unspent outputs computed from the block tables: every output no
+        stored input spends.
+        """
+        return sorted(conn.execute("""
+            SELECT o.txid, o.output_index, o.value_sat, o.script_pubkey FROM tx_output o
+            WHERE NOT EXISTS (SELECT 1 FROM tx_input i WHERE i.prev_txid = o.txid AND i.prev_vout = o.output_index)
+        """).fetchall())
+
+    def stored_utxos(self, conn):
+        return sorted(conn.execute("SELECT txid, vout, value_sat, script_pubkey FROM utxo").fetchall())
+
+    def test_set_matches_unspent_outputs(self):
+        """The utxo table and its totals equal the outputs no input spends."""
+        with FakeNode(chain_length=10) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            rpc = make_rpc(node)
+            # Several runs, so spends also look up outputs committed by an earlier writer.
+            for end in (20, 30):
+                sync_to_tip(self.conn, rpc, start_height=0, commit_every=4)
+                node.hashes += [f"{h:064x}" for h in range(len(node.hashes), end)]
+            sync_to_tip(self.conn, rpc, commit_every=4)
+            expected = self.expected_utxos(self.conn)
+        self.assertEqual(self.stored_utxos(self.conn), expected)
+        self.assertEqual(supply(self.conn), (29, len(expected), sum(row[2] for row in expected)))
+        script = expected[0][3]
+        self.assertEqual(balance(self.conn, script), sum(row[2] for row in expected if row[3] == script))
+
+    def test_cache_serves_recent_spends(self):
+        """Spends of outputs created in recent blocks are served from memory."""
+        with FakeNode(chain_length=20) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            utxos = UtxoSet(self.conn)
+            writer = BlockWriter(self.conn, blocks_per_commit=5, extensions=[utxos])
+            for height in range(20):
+                writer.add_block(node.block(height))
+            writer.flush()
+        self.assertEqual(utxos.misses, 0)
+        # Two spends inside every block, plus one of the previous coinbase.
+        self.assertEqual(utxos.hits, 2 + 19 * 3)
+        self.assertEqual(self.stored_utxos(self.conn), self.expected_utxos(self.conn))
+        self.assertIn("100.0% hit rate", utxos.report())
+
+    def test_cache_activity_is_exported(self):
+        """Hits, misses and evictions of the UTXO cache reach the metrics."""
+        before = [metric.values.get((), 0) for metric in
+                  (metrics.UTXO_CACHE_HITS, metrics.UTXO_CACHE_MISSES, metrics.UTXO_CACHE_EVICTIONS)]
+        with FakeNode(chain_length=20) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            utxos = UtxoSet(self.conn, cache_size=2)
+            writer = BlockWriter(self.conn, blocks_per_commit=2, extensions=[utxos])
+            for height in range(20):
+                writer.add_block(node.block(height))
+            writer.flush()
+        after = [metric.values[()] for metric in
+                 (metrics.UTXO_CACHE_HITS, metrics.UTXO_CACHE_MISSES, metrics.UTXO_CACHE_EVICTIONS)]
+        self.assertEqual([a - b for a, b in zip(after, before)], [utxos.hits, utxos.misses, utxos.evictions])
+        self.assertGreater(utxos.misses, 0)
+        self.assertIn("utxo_cache_entries 2", metrics.render_prometheus())
+
+    def test_reorg_restores_spent_outputs(self):
+        """Rolling back restores outputs spent above the fork, in both hash storage modes."""
+        blob_path = make_database(SCHEMA_BLOB_PATH)
+        blob_conn = connect(blob_path, "ingest")
+        try:
+            with FakeNode(chain_length=30) as node:
+                node.txs_per_block = 3
+                node.spend_across_blocks = True
+                for conn in (self.conn, blob_conn):
+                    sync_to_tip(conn, make_rpc(node), start_height=0, commit_every=50)
+                node.reorg(fork_height=24, new_length=33)
+                for conn in (self.conn, blob_conn):
+                    sync_to_tip(conn, make_rpc(node), commit_every=50)
+            expected = self.expected_utxos(self.conn)
+            self.assertEqual(self.stored_utxos(self.conn), expected)
+            self.assertEqual(self.stored_utxos(blob_conn), expected)
+            for conn in (self.conn, blob_conn):
+                self.assertEqual(supply(conn), (32, len(expected), sum(row[2] for row in expected)))
+            self.assertEqual(self.conn.execute("SELECT MIN(height) FROM utxo_undo").fetchone()[0], 1)
+        finally:
+            blob_conn.close()
+            remove_database(blob_path)
+
+    def test_balance_uses_script_index(self):
+        """A balance lookup reads the script index instead of the whole set."""
+        UtxoSet(self.conn)
+        plan = " ".join(row[3] for row in self.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT COALESCE(SUM(value_sat), 0) FROM utxo WHERE script_pubkey = ?", ("",)))
+        self.assertIn("idx_utxo_script", plan)
+
+
+class TestAddressIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = connect(self.db_path, "ingest")
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def expected_balances(self, node, end):
+        """
+        Replays the fake chain up to `end` and returns, per height, the
+        balance of every address after that block.
+        """
+        unspent, balances = {}, []
+        for height in range(end):
+            for tx in node.block(height)["tx"]:
+                for vin in tx["vin"]:
+                    unspent.pop((vin.get("txid"), vin.get("vout")), None)
+                for vout in tx["vout"]:
+                    address = script_to_address(vout["scriptPubKey"]["hex"])
+                    unspent[(tx["txid"], vout["n"])] = (address, round(vout["value"] * 100_000_000))
+            totals = {}
+            for address, value_sat in unspent.values():
+                totals[address] = totals.get(address, 0) + value_sat
+            balances.append(totals)
+        return balances
+
+    def check_balances(self, node, end):
+        expected = self.expected_balances(node, end)
+        for height, totals in enumerate(expected):
+            for address, value_sat in totals.items():
+                self.assertEqual(balance_at(self.conn, address, height), value_sat, (address, height))
+        for address, value_sat in expected[-1].items():
+            self.assertEqual(balance_at(self.conn, address), value_sat)
+
+    def test_known_addresses(self):
+        """Standard output scripts encode to their published addresses."""
+        self.assertEqual(script_to_address("76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac"),
+                         "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa")
+        self.assertEqual(script_to_address("0014751e76e8199196d454941c45d1b3a323f1433bd6"),
+                         "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4")
+        self.assertEqual(script_to_address("0014751e76e8199196d454941c45d1b3a323f1433bd6", "test"),
+                         "tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx")
+        self.assertEqual(
+            script_to_address("00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262"),
+            "bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3")
+        self.assertEqual(
+            script_to_address("512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"),
+            "bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0")
+        self.assertEqual(script_to_address("a914" + "00" * 20 + "87"), "31h1vYVSYuKP6AhS86fbRdMw9XHieotbST")
+        self.assertIsNone(script_to_address("6a0474657374"))
+
+    def test_balance_history_survives_reorg(self):
+        """balance_at matches a replay of the chain at every height, before and after a reorg."""
+        with FakeNode(chain_length=30) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            utxos = UtxoSet(self.conn)
+            addresses = AddressIndex(self.conn, utxos, checkpoint_interval=5)
+            writer = BlockWriter(self.conn, blocks_per_commit=4, extensions=[utxos, addresses])
+            for height in range(30):
+                writer.add_block(node.block(height))
+            writer.flush()
+            self.check_balances(node, 30)
+            self.assertGreater(self.conn.execute("SELECT COUNT(*) FROM address_checkpoint").fetchone()[0], 10)
+
+            node.reorg(fork_height=21, new_length=33)
+            writer.rollback_to(21, node.hashes[21])
+            for height in range(22, 33):
+                writer.add_block(node.block(height))
+            writer.flush()
+            self.check_balances(node, 33)
+
+    def test_streamed_blocks_checkpoint_whole_blocks(self):
+        """Checkpoints of streamed blocks cover every transaction of their block."""
+        for interval in (1, 3):
+            with self.subTest(interval=interval), FakeNode(chain_length=8) as node:
+                self.conn.close()
+                remove_database(self.db_path)
+                self.db_path = make_database()
+                self.conn = connect(self.db_path, "ingest")
+                node.txs_per_block = 4
+                node.spend_across_blocks = True
+                utxos = UtxoSet(self.conn)
+                addresses = AddressIndex(self.conn, utxos, checkpoint_interval=interval)
+                writer = BlockWriter(self.conn, extensions=[utxos, addresses])
+                for height in range(8):
+                    body = json.dumps({"result": node.block(height), "error": None, "id": 1}).encode()
+                    writer.write_streamed(StreamedBlock([body]))
+                self.check_balances(node, 8)
+                for address, height in self.conn.execute("SELECT address, height FROM address_checkpoint"):
+                    total = self.conn.execute(
+                        "SELECT SUM(delta_sat) FROM address_activity WHERE address = ? AND height <= ?",
+                        (address, height)
+                    ).fetchone()[0]
+                    self.assertEqual(balance_at(self.conn, address, height), total)
+
+    def test_balance_at_reads_a_bounded_range(self):
+        """The activity after a checkpoint is read through the address index."""
+        AddressIndex(self.conn, UtxoSet(self.conn))
+        plan = " ".join(row[3] for row in self.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT COALESCE(SUM(delta_sat), 0) FROM address_activity "
+            "WHERE address = ? AND height > ? AND height <= ?", ("", 0, 0)))
+        self.assertIn("idx_address_activity_address (address=? AND height>? AND height<?)", plan)
+
+
+class TestRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.hex_path = make_database()
+        self.blob_path = make_database(SCHEMA_BLOB_PATH)
+        # Halve the subsidy every 4 blocks so the fake coinbases soon claim fees.
+        patcher = mock.patch("rollups.HALVING_INTERVAL", 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        remove_database(self.hex_path)
+        remove_database(self.blob_path)
+
+    def sync_with_reorg(self, path):
+        conn = connect(path, "ingest")
+        with FakeNode(chain_length=30) as node:
+            sync_to_tip(conn, make_rpc(node), start_height=0, commit_every=4)
+            node.reorg(fork_height=22, new_length=35)
+            sync_to_tip(conn, make_rpc(node), commit_every=4)
+        conn.close()
+        return node
+
+    def dump_rollups(self, path):
+        conn = sqlite3.connect(path)
+        dump = {table: conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+                for table in ("block_stats", "daily_stats", "epoch_stats")}
+        conn.close()
+        return dump
+
+    def test_rollups_follow_blocks_and_reorgs(self):
+        """Block, day and epoch totals match the stored chain after a reorg."""
+        node = self.sync_with_reorg(self.hex_path)
+        expected = []
+        for height in range(35):
+            block = node.block(height)
+            outputs = [round(vout["value"] * 100_000_000) for tx in block["tx"] for vout in tx["vout"]]
+            coinbase = sum(outputs[:node.outputs_per_tx])
+            expected.append((height, block["time"], len(block["tx"]), block["size"], block["weight"],
+                             len(block["tx"]) - 1, len(outputs), sum(outputs),
+                             max(coinbase - block_subsidy(height), 0)))
+        dump = self.dump_rollups(self.hex_path)
+        self.assertEqual(dump["block_stats"], expected)
+        self.assertGreater(sum(row[8] for row in expected), 0)
+        conn = sqlite3.connect(self.hex_path)
+        for table, key in (("daily_stats", "date(time, 'unixepoch')"), ("epoch_stats", "height / 2016")):
+            totals = conn.execute(f"""
+                SELECT {key}, COUNT(*), SUM(tx_count), SUM(size), SUM(weight), SUM(input_count),
+                       SUM(output_count), SUM(output_sat), SUM(fee_sat)
+                FROM block_stats GROUP BY 1 ORDER BY 1
+            """).fetchall()
+            self.assertEqual(dump[table], totals)
+        conn.close()
+
+    def test_rebuild_matches_incremental_rollups(self):
+        """rollups.py --rebuild reproduces the incrementally maintained tables in both storage modes."""
+        self.sync_with_reorg(self.hex_path)
+        self.sync_with_reorg(self.blob_path)
+        incremental = self.dump_rollups(self.hex_path)
+        self.assertEqual(self.dump_rollups(self.blob_path), incremental)
+        for path in (self.hex_path, self.blob_path):
+            self.assertEqual(rebuild_rollups(path, chunk_size=7), 35)
+            self.assertEqual(self.dump_rollups(path), incremental)
+
+
+class TestTransactionFees(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = connect(self.db_path, "ingest")
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def expected_fees(self, node, start, end):
+        """
+        (txid, height, fee_sat, vsize) of every non-coinbase transaction in
+        [start, end), computed by replaying the fake chain from genesis.
+        """
+        values, fees = {}, []
+        for height in range(end):
+            for tx in node.block(height)["tx"]:
+                output_sat = 0
+                for vout in tx["vout"]:
+                    values[(tx["txid"], vout["n"])] = round(vout["value"] * 100_000_000)
+                    output_sat += values[(tx["txid"], vout["n"])]
+                if "coinbase" not in tx["vin"][0] and height >= start:
+                    input_sat = sum(values[(vin["txid"], vin["vout"])] for vin in tx["vin"])
+                    fees.append((tx["txid"], height, input_sat - output_sat, (tx["weight"] + 3) // 4))
+        return sorted(fees)
+
+    def stored_fees(self):
+        return self.conn.execute("SELECT txid, height, fee_sat, vsize FROM tx_fee ORDER BY txid").fetchall()
+
+    def test_fees_follow_blocks_and_reorgs(self):
+        """Every non-coinbase transaction gets its fee, vsize and feerate, also after a reorg."""
+        with FakeNode(chain_length=30) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            sync_to_tip(self.conn, make_rpc(node), start_height=0, commit_every=4)
+            node.reorg(fork_height=21, new_length=33)
+            sync_to_tip(self.conn, make_rpc(node), commit_every=4)
+            expected = self.expected_fees(node, 0, 33)
+        self.assertEqual(self.stored_fees(), expected)
+        for fee_sat, vsize, feerate in self.conn.execute("SELECT fee_sat, vsize, feerate FROM tx_fee"):
+            self.assertAlmostEqual(feerate, fee_sat / vsize)
+
+    def test_evicted_prevouts_come_from_the_utxo_table(self):
+        """Spends the UTXO cache misses are resolved from the utxo table; unknown prevouts come from the node."""
+        with FakeNode(chain_length=20) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            utxos = UtxoSet(self.conn, cache_size=4)
+            fees = TransactionFees(self.conn, utxos)
+            writer = BlockWriter(self.conn, blocks_per_commit=3, extensions=[utxos, fees])
+            for height in range(10, 20):
+                writer.add_block(node.block(height))
+            writer.flush()
+            # Block 10 spends the coinbase of block 9, which is not stored.
+            self.assertEqual(fees.unresolved, 1)
+            self.assertGreater(utxos.evictions, 0)
+            self.assertGreater(utxos.misses, 0)
+            self.assertEqual(len(self.stored_fees()), len(self.expected_fees(node, 10, 20)) - 1)
+
+            utxos = UtxoSet(self.conn)
+            fees = TransactionFees(self.conn, utxos, make_rpc(node))
+            writer = BlockWriter(self.conn, extensions=[utxos, fees])
+            writer.add_block(node.block(10))
+            self.assertEqual((fees.rpc_lookups, fees.unresolved), (1, 0))
+            self.assertEqual(self.stored_fees(), self.expected_fees(node, 10, 20))
+        self.assertIn("without a fee", fees.report())
+
+    def test_backfill_with_deferred_indexes_needs_no_rpc(self):
+        """A bulk load without indexes and with a tiny UTXO cache computes every fee without the node."""
+        def small_cache_extensions(conn, rpc):
+            utxos = UtxoSet(conn, cache_size=2)
+            return [utxos, TransactionFees(conn, utxos)]
+
+        with FakeNode(chain_length=30) as node:
+            node.txs_per_block = 3
+            node.spend_across_blocks = True
+            make_rpc(node)
+            with mock.patch("backfill.default_extensions", side_effect=small_cache_extensions):
+                backfill(self.db_path, 0, 29, workers=2, decoders=1, checkpoint_every=3)
+            expected = self.expected_fees(node, 0, 30)
+        self.assertEqual(self.stored_fees(), expected)
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def check_store(self, node, store):
+        heights = np.arange(len(node.hashes))
+        blocks = [node.block(height) for height in heights]
+        np.testing.assert_array_equal(store["height"], heights)
+        np.testing.assert_array_equal(store["time"], [block["time"] for block in blocks])
+        np.testing.assert_array_equal(store["ntx"], [block["nTx"] for block in blocks])
+        np.testing.assert_array_equal(store["bits"], [0x1D00FFFF] * len(blocks))
+        chainwork = [sum(int(limb) << (64 * i) for i, limb in enumerate(limbs)) for limbs in store["chainwork"]]
+        self.assertEqual(chainwork, [int(block["chainwork"], 16) for block in blocks])
+
+    def test_store_follows_blocks_and_reorgs(self):
+        """The columns hold every stored header, also after a reorg and a lost store."""
+        conn = connect(self.db_path, "ingest")
+        with mock.patch("header_store.MIN_CAPACITY", 16), FakeNode(chain_length=30) as node:
+            sync_to_tip(conn, make_rpc(node), start_height=0, commit_every=4)
+            node.reorg(fork_height=21, new_length=70)
+            sync_to_tip(conn, make_rpc(node), commit_every=10)
+            self.check_store(node, HeaderStore(default_header_path(self.db_path)))
+            self.assertEqual(HeaderStore(default_header_path(self.db_path)).capacity, 128)
+
+            shutil.rmtree(default_header_path(self.db_path))
+            store = HeaderStore(default_header_path(self.db_path))
+            self.assertEqual(store.sync(conn), 70)
+        self.check_store(node, store)
+        conn.close()
+
+    def test_statistics_skip_missing_heights(self):
+        """Only the run of heights ending at the tip is used, so holes are not averaged in as intervals."""
+        path = tempfile.mkdtemp()
+        try:
+            store = HeaderStore(path)
+            self.assertEqual(store.contiguous_start(), 0)
+            rows = [(height, 1600000000 + 600 * height, 0, "1d00ffff", 1, 1, 285, 1140, "%064x" % height)
+                    for height in [3, 4, 10, 11, 12]]
+            store.write(rows)
+            self.assertEqual(store.contiguous_start(), 10)
+            store.flush()
+            with mock.patch("header_store.default_path", return_value=path), \
+                    mock.patch("builtins.print") as printed:
+                header_store_main(["--window", "3"])
+            output = "\n".join(call.args[0] for call in printed.call_args_list)
+            self.assertIn("3 contiguous headers from height 10", output)
+            self.assertIn("mean 600s", output)
+            self.assertIn("max 600s", output)
+        finally:
+            shutil.rmtree(path)
+
+    def test_memory_database_has_no_store(self):
+        """In-memory databases get no header store instead of one in the working directory."""
+        conn = sqlite3.connect(":memory:")
+        with open(SCHEMA_PATH) as f:
+            conn.executescript(f.read())
+        extensions = default_extensions(conn)
+        self.assertNotIn("HeaderStoreWriter", [type(extension).__name__ for extension in extensions])
+        self.assertRaises(ValueError, HeaderStoreWriter, conn)
+        self.assertFalse(os.path.exists(default_header_path("")))
+        conn.close()
+
+    def test_vectorized_helpers_match_exact_arithmetic(self):
+        """Difficulty, work and hashrate agree with integer arithmetic on the compact targets."""
+        bits = np.array([0x1D00FFFF, 0x1B0404CB, 0x17053894], dtype=np.uint32)
+        targets = [(int(b) & 0xFFFFFF) << (8 * ((int(b) >> 24) - 3)) for b in bits]
+        work = [2 ** 256 // (target + 1) for target in targets]
+        np.testing.assert_allclose(difficulty_from_bits(bits), [(0xFFFF << 208) / t for t in targets], rtol=1e-12)
+        np.testing.assert_allclose(block_work(bits), [float(w) for w in work], rtol=1e-12)
+        np.testing.assert_allclose(cumulative_work(bits, 5.0),
+                                   [float(sum(work[:i + 1]) + 5) for i in range(len(work))], rtol=1e-12)
+        limbs = np.array([[w & (2 ** 64 - 1), w >> 64, 0, 0] for w in work], dtype=np.uint64)
+        np.testing.assert_allclose(chainwork_to_float(limbs), [float(w) for w in work], rtol=1e-12)
+
+        times = 1600000000 + 600 * np.arange(300)
+        constant = np.full(300, 0x1D00FFFF, dtype=np.uint32)
+        rates = rolling_hashrate(times, constant, window=144)
+        self.assertTrue(np.isnan(rates[:144]).all())
+        np.testing.assert_allclose(rates[144:], work[0] / 600, rtol=1e-12)
+        self.assertEqual(interval_stats(times)["median"], 600)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def rpc_count(self, method):
+        return dict(metrics.RPC_SECONDS.samples()).get((method,), (None, 0, 0))[2]
+
+    def test_sync_updates_counters_and_tip_lag(self):
+        """Syncing counts RPC calls, blocks and rows, and the lag gauges follow the node's tip."""
+        conn = connect(self.db_path, "ingest")
+        blocks_before = metrics.BLOCKS_WRITTEN.snapshot().get("total", 0)
+        outputs_before = metrics.ROWS_WRITTEN.snapshot().get("tx_output", 0)
+        calls_before = self.rpc_count("getblockcount")
+        getblock_before = self.rpc_count("getblock")
+        with mock.patch("metrics.exporting", True), FakeNode(chain_length=20) as node:
+            rpc = make_rpc(node)
+            sync_to_tip(conn, rpc, start_height=0, commit_every=5)
+            self.assertEqual(metrics.TIP_LAG_BLOCKS.snapshot()["total"], 0)
+            self.assertEqual(metrics.TIP_LAG_SECONDS.snapshot()["total"], 0)
+
+            node.hashes.extend(f"{h:064x}" for h in range(20, 25))
+            record_node_tip(rpc, 24)
+            self.assertEqual(metrics.TIP_LAG_BLOCKS.snapshot()["total"], 5)
+            self.assertEqual(metrics.TIP_LAG_SECONDS.snapshot()["total"], 5 * 600)
+        conn.close()
+
+        outputs = sum(len(node.block(h)["tx"]) * node.outputs_per_tx for h in range(20))
+        self.assertEqual(metrics.BLOCKS_WRITTEN.snapshot()["total"] - blocks_before, 20)
+        self.assertEqual(metrics.ROWS_WRITTEN.snapshot()["tx_output"] - outputs_before, outputs)
+        self.assertEqual(self.rpc_count("getblockcount") - calls_before, 1)
+        self.assertEqual(self.rpc_count("getblock") - getblock_before, 20)
+        self.assertEqual(metrics.COMMITTED_HEIGHT.snapshot()["total"], 19)
+
+    def test_endpoint_and_snapshots(self):
+        """The HTTP endpoint serves Prometheus text and JSON; the snapshot file has rates."""
+        metrics.COMMIT_SECONDS.observe(0.003)
+        server = metrics.serve_metrics(0)
+        try:
+            base = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(base + "/metrics") as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+                text = response.read().decode()
+            with urllib.request.urlopen(base + "/metrics.json") as response:
+                data = json.load(response)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn("# TYPE writer_commit_duration_seconds histogram", text)
+        self.assertIn('writer_commit_duration_seconds_bucket{le="+Inf"}', text)
+        self.assertIn('writer_commit_duration_seconds_bucket{le="0.005"}', text)
+        count = data["metrics"]["writer_commit_duration_seconds"]["total"]["count"]
+        self.assertIn(f"writer_commit_duration_seconds_count {count}", text)
+
+        path = self.db_path + ".metrics.json"
+        writer = metrics.SnapshotWriter(path, interval=60)
+        metrics.BLOCKS_WRITTEN.inc(10)
+        writer.close()
+        with open(path) as f:
+            snapshot = json.load(f)
+        os.remove(path)
+        self.assertGreater(snapshot["rates_per_second"]["ingest_blocks_total:total"], 0)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+        for suffix in (".trace.json", ".prof", ".collapsed"):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def test_trace_has_a_span_per_stage(self):
+        """A traced sync writes Chrome trace events for RPC, decode, insert and commit."""
+        conn = connect(self.db_path, "ingest")
+        tracer = profiling.Tracer(self.db_path + ".trace.json")
+        with mock.patch("profiling.tracer", tracer), FakeNode(chain_length=10) as node:
+            sync_to_tip(conn, make_rpc(node), start_height=0, commit_every=5)
+        conn.close()
+        tracer.write()
+        with open(self.db_path + ".trace.json") as f:
+            events = json.load(f)["traceEvents"]
+        spans = {}
+        for event in events:
+            spans.setdefault(event["name"], []).append(event)
+        self.assertEqual(len(spans["commit"]), 2)
+        self.assertEqual(len(spans["insert"]), 2)
+        self.assertEqual(len(spans["decode"]), 10)
+        self.assertEqual([e["ph"] for e in spans["rpc getblock"]], ["b", "e"] * 10)
+        self.assertEqual(spans["rpc getblockcount"][0]["ph"], "X")
+        commit = spans["commit"][0]
+        self.assertTrue(all(e["dur"] >= 0 and e["ts"] > 0 for e in spans["commit"] + spans["insert"]))
+        self.assertEqual(commit["args"], {"blocks": 5})
+
+    def test_block_range_profile(self):
+        """Profiling a block range writes pstats and collapsed stacks covering only that range."""
+        conn = connect(self.db_path, "ingest")
+        profiler = profiling.BlockRangeProfiler(5, 9, self.db_path, interval=0.001)
+        with mock.patch("profiling.block_profiler", profiler), FakeNode(chain_length=20) as node:
+            sync_to_tip(conn, make_rpc(node), start_height=0, commit_every=5)
+        conn.close()
+        self.assertTrue(profiler.done)
+        functions = {name for _, _, name in pstats.Stats(self.db_path + ".prof").stats}
+        self.assertIn("flush", functions)
+        self.assertIn("add_decoded", functions)
+        with open(self.db_path + ".collapsed") as f:
+            for line in f:
+                stack, count = line.rsplit(" ", 1)
+                self.assertGreater(int(count), 0)
+                self.assertIn(";", stack)
+
+    def test_stack_sampler_collapses_thread_stacks(self):
+        """A sample records each thread's stack, outermost frame first."""
+        stop = threading.Event()
+
+        def waiting_worker():
+            stop.wait()
+
+        worker = threading.Thread(target=waiting_worker, name="worker")
+        worker.start()
+        sampler = profiling.StackSampler()
+        try:
+            sampler.sample()
+        finally:
+            stop.set()
+            worker.join()
+        stacks = [stack for stack in sampler.stacks if stack.startswith("worker;")]
+        self.assertEqual(len(stacks), 1)
+        self.assertIn(";waiting_worker (test_update_db.py:", stacks[0])
+        self.assertIn(";wait (threading.py:", stacks[0])
+        self.assertEqual(profiling.parse_block_range("100:200"), (100, 200))
+        self.assertEqual(profiling.parse_block_range("7"), (7, 7))
+
+
+def mock_rpc(server, **kwargs):
+    """
+    Points a BitcoinRPC client at a MockBitcoind.
+    """
+    os.environ.update(server.environment())
+    return BitcoinRPC(**kwargs)
+
+
+class TestMockBitcoind(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_verbosities_describe_the_same_block(self):
+        """getblock 0/1/2, getblockheader and REST agree, and the chain is deterministic."""
+        chain = MockChain.synthetic(12, seed=7, txs_per_block=6)
+        self.assertEqual(MockChain.synthetic(12, seed=7, txs_per_block=6).tip["hash"], chain.tip["hash"])
+        with MockBitcoind(chain) as server:
+            rpc = mock_rpc(server)
+            block_hash = rpc.call("getblockhash", [5])
+            raw = rpc.call("getblock", [block_hash, 0])
+            summary = rpc.call("getblock", [block_hash, 1])
+            block = rpc.call("getblock", [block_hash, 2])
+            header = rpc.call("getblockheader", [block_hash])
+            rest = rpc.session.get(f"{rpc.rpc_url}/rest/block/{block_hash}.bin").content
+            self.assertEqual(rpc.call("getbestblockhash"), chain.tip["hash"])
+            self.assertEqual(rpc.call("getblockcount"), 11)
+            self.assertIsNone(rpc.call("getblockhash", [12]))
+            tx = rpc.call("getrawtransaction", [block["tx"][1]["txid"], True])
+        parsed = parse_block(bytes.fromhex(raw), header)
+        self.assertEqual(rest.hex(), raw)
+        self.assertEqual(parsed["hash"], block_hash)
+        self.assertEqual(summary["tx"], [t["txid"] for t in block["tx"]])
+        self.assertEqual(len(block["tx"]), 6)
+        self.assertEqual(header["confirmations"], 7)
+        self.assertEqual(header["nextblockhash"], chain.at(6)["hash"])
+        for field in ("merkleroot", "time", "bits", "chainwork", "size", "weight", "strippedsize"):
+            self.assertEqual(block[field], parsed[field], field)
+        self.assertEqual(tx["hex"], block["tx"][1]["hex"])
+        coinbase_sat = sum(round(Decimal(str(v["value"])) * 100_000_000) for v in block["tx"][0]["vout"])
+        fees_sat = sum(round(Decimal(str(t["fee"])) * 100_000_000) for t in block["tx"][1:])
+        self.assertEqual(coinbase_sat, 50 * 100_000_000 + fees_sat)
+
+    def test_update_database_against_synthetic_chain(self):
+        """update_database ingests a synthetic chain with consistent fees and UTXO totals."""
+        chain = MockChain.synthetic(30, seed=1, txs_per_block=8)
+        with MockBitcoind(chain) as server:
+            os.environ.update(server.environment())
+            self.assertEqual(update_database(self.db_path, start_height=0), 30)
+        conn = connect(self.db_path, "serve")
+        stored = [row[0] for row in conn.execute("SELECT hash FROM block ORDER BY height")]
+        fees = dict(conn.execute("SELECT txid, fee_sat FROM tx_fee"))
+        height, _, total_sat = supply(conn)
+        conn.close()
+        self.assertEqual(stored, [chain.at(h)["hash"] for h in range(30)])
+        self.assertEqual(fees, {txid: fee for block in chain.blocks for txid, fee in block["fees"].items()})
+        self.assertEqual((height, total_sat), (29, 30 * 50 * 100_000_000))
+
+    def test_injected_reorg_errors_and_latency(self):
+        """Reorgs, RPC errors, 503s and latency reach the client the way bitcoind produces them."""
+        chain = MockChain.synthetic(20, seed=2)
+        conn = connect(self.db_path, "ingest")
+        with MockBitcoind(chain, latency=0.02) as server:
+            rpc = mock_rpc(server)
+            sync_to_tip(conn, rpc, start_height=0, commit_every=5)
+            server.reorg(depth=3)
+            self.assertEqual(sync_to_tip(conn, rpc), 4)
+            stored = [row[0] for row in conn.execute("SELECT hash FROM block ORDER BY height")]
+            self.assertEqual(stored, [chain.at(h)["hash"] for h in range(21)])
+
+            server.fail_next("getblockcount", 2)
+            self.assertIsNone(rpc.call("getblockcount"))
+            self.assertEqual(rpc.call_batch([("getblockcount", [])])[0][1]["message"], "Injected failure")
+            started = time.perf_counter()
+            self.assertEqual(rpc.call("getblockcount"), 20)
+            self.assertGreaterEqual(time.perf_counter() - started, 0.02)
+            server.error_rate = 1.0
+            self.assertIsNone(rpc.call("getblockcount"))
+        conn.close()
+
+    def test_waitfornewblock_mempool_and_fixtures(self):
+        """Mined blocks wake waitfornewblock and confirm the mempool; fixtures replay the same chain."""
+        chain = MockChain.synthetic(10, seed=3)
+        with MockBitcoind(chain) as server:
+            rpc = mock_rpc(server)
+            mempool = rpc.call("getrawmempool")
+            self.assertEqual(rpc.call("waitfornewblock", [50])["height"], 9)
+            threading.Timer(0.1, server.mine).start()
+            tip = rpc.call("waitfornewblock", [5000])
+            self.assertEqual((tip["height"], tip["hash"]), (10, chain.tip["hash"]))
+            self.assertEqual(chain.tip["txids"][1:], mempool)
+
+            path = self.db_path + ".fixture.json.gz"
+            try:
+                record_fixture(rpc, 4, 10, path)
+                recorded = MockChain.load(path, seed=3)
+            finally:
+                os.remove(path)
+        self.assertEqual((recorded.base_height, recorded.height), (4, 10))
+        for height in range(4, 11):
+            # A recording has no fees: the node only reports them with undo data.
+            original = chain.verbose_block(chain.at(height), 2)
+            for tx in original["tx"]:
+                tx.pop("fee", None)
+            self.assertEqual(recorded.verbose_block(recorded.at(height), 2), original)
+        recorded.mine(2)
+        self.assertEqual(recorded.height, 12)
+
+
+class TestConnectionProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def test_bulk_ingest_profile_pragmas(self):
+        """The bulk-ingest profile switches to WAL with relaxed syncing."""
+        conn = connect(self.db_path, "bulk-ingest")
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 0)
+        self.assertEqual(conn.execute("PRAGMA temp_store").fetchone()[0], 2)
+        conn.close()
+
+    def test_reader_is_not_blocked_by_open_write_transaction(self):
+        """A serve connection reads while the ingester holds a write transaction."""
+        writer = connect(self.db_path, "ingest")
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("INSERT INTO sync_state (id, height, hash) VALUES (1, 5, 'abc')")
+        reader = connect(self.db_path, "serve")
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM sync_state").fetchone()[0], 0)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute("DELETE FROM sync_state")
+        writer.commit()
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM sync_state").fetchone()[0], 1)
+        reader.close()
+        writer.close()
+
+    def test_unknown_profile_is_rejected(self):
+        """Typos in the profile name fail loudly."""
+        with self.assertRaises(ValueError):
+            connect(self.db_path, "fast")
+
+
+class TestStreamingDecode(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        remove_database(self.db_path)
+
+    def test_split_chunks_decode_like_json_loads(self):
+        """Values cut at any byte boundary, escapes and brackets in strings decode correctly."""
+        reply = {
+            "result": {
+                "hash": "ab" * 32, "height": 7, "difficulty": 1.25, "nextblockhash": None,
+                "tx": [{"txid": "t1", "note": 'quote " and \\ and ]}[{', "vout": [{"value": 0.1}]},
+                       {"txid": "t2", "vin": [], "nested": [[1, [2]], {"a": {}}]}],
+                "weight": 4000
+            },
+            "error": None,
+            "id": "pythonclient"
+        }
+        body = json.dumps(reply).encode()
+        expected = json.loads(body, parse_float=Decimal)["result"]
+        for size in (1, 2, 7, len(body)):
+            streamed = StreamedBlock(body[i:i + size] for i in range(0, len(body), size))
+            self.assertEqual(list(streamed.transactions()), expected["tx"])
+            header = dict(expected)
+            del header["tx"]
+            self.assertEqual(streamed.header, header)
+            self.assertIsNone(streamed.error)
+
+    def test_error_reply_yields_no_transactions(self):
+        """A JSON-RPC error is reported instead of a block."""
+        body = json.dumps({"result": None, "error": {"code": -5, "message": "Block not found"}, "id": 1})
+        streamed = StreamedBlock([body.encode()])
+        self.assertEqual(list(streamed.transactions()), [])
+        self.assertEqual(streamed.error["code"], -5)
+        self.assertFalse(BlockWriter(self.conn).write_streamed(StreamedBlock([body.encode()])))
+
+    def test_streamed_sync_matches_whole_block_sync(self):
+        """Streaming ingestion stores exactly the rows of whole-block ingestion."""
+        other_path = make_database()
+        other = sqlite3.connect(other_path)
+        try:
+            with FakeNode(chain_length=30) as node:
+                rpc = make_rpc(node)
+                self.assertEqual(sync_to_tip(self.conn, rpc, start_height=0, stream=True), 30)
+                self.assertEqual(sync_to_tip(other, rpc, start_height=0), 30)
+                stats = rpc.connection_stats.snapshot()
+            self.assertEqual(dump_tables(self.conn), dump_tables(other))
+            self.assertEqual(load_sync_state(self.conn), (29, node.hashes[29]))
+            # Streamed replies are read to the end, so the connection is reused.
+            self.assertEqual(len(stats), 1)
+        finally:
+            other.close()
+            remove_database(other_path)
+
+    def test_streamed_sync_handles_reorg(self):
+        """A streamed block that does not extend the stored chain is rolled back."""
+        with FakeNode(chain_length=30) as node:
+            rpc = make_rpc(node)
+            sync_to_tip(self.conn, rpc, start_height=0, stream=True)
+            node.reorg(fork_height=24, new_length=33)
+            sync_to_tip(self.conn, rpc, stream=True)
+        stored = [row[0] for row in self.conn.execute("SELECT hash FROM block ORDER BY height")]
+        self.assertEqual(stored, node.hashes)
+
+    def test_peak_memory_is_bounded_by_one_transaction(self):
+        """Streaming a large block through the default extensions allocates far less than writing it whole."""
+        with FakeNode(chain_length=1) as node:
+            node.txs_per_block = 3000
+            body = json.dumps({"result": node.block(0), "error": None, "id": 1}).encode()
+        chunks = [body[i:i + 65536] for i in range(0, len(body), 65536)]
+
+        def make_writer(conn):
+            # Small caches, so only the state kept per block is measured.
+            extensions = default_extensions(conn)
+            extensions[0].cache_size = 100
+            return BlockWriter(conn, extensions=extensions)
+
+        other_path = make_database()
+        other = sqlite3.connect(other_path)
+        try:
+            streamed_writer, whole_writer = make_writer(self.conn), make_writer(other)
+            tracemalloc.start()
+            streamed_writer.write_streamed(StreamedBlock(iter(chunks)))
+            streamed_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            whole_writer.add_block(json.loads(body, parse_float=Decimal)["result"])
+            whole_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertEqual(dump_tables(self.conn), dump_tables(other))
+            for table in ("utxo", "utxo_stats", "tx_fee", "address_balance", "block_stats"):
+                query = f"SELECT * FROM {table} ORDER BY 1, 2"
+                self.assertEqual(self.conn.execute(query).fetchall(), other.execute(query).fetchall(), table)
+        finally:
+            other.close()
+            remove_database(other_path)
+        self.assertLess(streamed_peak * 5, whole_peak)
+
+
+class TestBlockNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = make_database()
+
+    def tearDown(self):
+        remove_database(self.db_path)
+
+    def mine_later(self, node, count, delay, publisher=None, after_height=None):
+        """
+        Extends the fake chain after `delay` seconds (and once `after_height`
+        is stored, if given), announcing each block. Returns the thread and a
+        list that receives the announcement times.
+        """
+        announced = []
+
+        def mine():
+            time.sleep(delay)
+            while after_height is not None and after_height not in self.stored_heights():
+                time.sleep(0.01)
+            for _ in range(count):
+                node.hashes.append(hashlib.sha256(f"mined:{len(node.hashes)}".encode()).hexdigest())
+                announced.append(time.monotonic())
+                if publisher:
+                    publisher.publish(node.hashes[-1])
+
+        thread = threading.Thread(target=mine)
+        thread.start()
+        return thread, announced
+
+    def stored_heights(self):
+        conn = sqlite3.connect(self.db_path)
+        heights = [row[0] for row in conn.execute("SELECT height FROM block ORDER BY height")]
+        conn.close()
+        return heights
+
+    def test_zmq_notification_triggers_ingest(self):
+        """A hashblock message from the stand-in publisher starts a sync at once."""
+        publisher = LocalBlockPublisher()
+        with FakeNode(chain_length=10) as node:
+            make_rpc(node)
+            notifier = ZMQBlockNotifier(socket=publisher.subscriber())
+            thread, announced = self.mine_later(node, 1, 0.05, publisher, after_height=9)
+            committed = follow(self.db_path, notifier=notifier, start_height=0, max_cycles=1, wait_timeout=5)
+            finished = time.monotonic()
+            thread.join()
+        self.assertEqual(committed, 11)
+        self.assertEqual(self.stored_heights(), list(range(11)))
+        self.assertLess(finished - announced[0], 0.5)
+
+    def test_interrupted_catch_up_closes_notifier(self):
+        """Ctrl-C during the initial sync still closes the notifier."""
+        notifier = mock.Mock()
+        notifier.name = "test"
+        with FakeNode(chain_length=10) as node:
+            make_rpc(node)
+            with mock.patch("block_notify.sync_to_tip", side_effect=KeyboardInterrupt):
+                self.assertRaises(KeyboardInterrupt, follow, self.db_path, notifier=notifier, start_height=0)
+        notifier.close.assert_called_once()
+
+    def test_follow_keeps_one_writer(self):
+        """Every sync round of follow() shares one writer, so the extensions' caches stay warm."""
+        publisher = LocalBlockPublisher()
+        with FakeNode(chain_length=10) as node:
+            make_rpc(node)
+            notifier = ZMQBlockNotifier(socket=publisher.subscriber())
+            thread, _ = self.mine_later(node, 2, 0.05, publisher, after_height=9)
+            with mock.patch("update_db.default_extensions", wraps=default_extensions) as extensions:
+                committed = follow(self.db_path, notifier=notifier, start_height=0, max_cycles=2, wait_timeout=5)
+            thread.join()
+        self.assertEqual(committed, 12)
+        self.assertEqual(extensions.call_count, 1)
+
+    def test_long_poll_returns_on_new_block(self):
+        """waitfornewblock wakes the follower when the tip changes."""
+        with FakeNode(chain_length=10) as node:
+            notifier = LongPollNotifier(make_rpc(node))
+            self.assertIsNone(notifier.wait(0.05))
+            thread, _ = self.mine_later(node, 1, 0.1)
+            self.assertIsNotNone(notifier.wait(5))
+            thread.join()
+            self.assertEqual(notifier.last_hash, node.hashes[-1])
+
+    def test_polling_interval_adapts(self):
+        """Idle polls back off exponentially and a new block resets the interval."""
+        with FakeNode(chain_length=10) as node:
+            notifier = PollingNotifier(make_rpc(node), min_interval=0.001, max_interval=0.004)
+            intervals = []
+            for _ in range(4):
+                self.assertIsNone(notifier.wait(1))
+                intervals.append(notifier.interval)
+            node.hashes.append("ff" * 32)
+            self.assertEqual(notifier.wait(1), "ff" * 32)
+        self.assertEqual(intervals, [0.002, 0.004, 0.004, 0.004])
+        self.assertEqual(notifier.interval, 0.001)
+
+
+if __name__ == "__main__":
+    unittest.main()
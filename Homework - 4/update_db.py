@@ -1,148 +1,572 @@
-import os
-import requests
-import sqlite3
-from time import sleep
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-class BitcoinRPC:
-    """
-    This class communicates with the Bitcoin Core node via RPC.
-    It sends JSON-RPC requests and returns the results.
-    """
-#    def __init__(self):
-#        self.rpc_user = os.getenv("RPC_USERNAME")
-#        self.rpc_password = os.getenv("RPC_PASSWORD")
-#        self.rpc_host = os.getenv("RPC_HOST", "127.0.0.1")
-#        self.rpc_port = os.getenv("RPC_PORT", "8332")
-#        self.rpc_url = f"http://{self.rpc_host}:{self.rpc_port}"
-
-    def __init__(self):
-        self.rpc_user = os.getenv("RPC_USERNAME")
-        self.rpc_password = os.getenv("RPC_PASSWORD")
-        self.rpc_host = os.getenv("RPC_HOST", "127.0.0.1")
-        self.rpc_port = os.getenv("RPC_PORT", "8332")
-        print("Loaded RPC credentials:")
-        print("User:", self.rpc_user)
-        print("Password:", self.rpc_password)
-        self.rpc_url = f"http://{self.rpc_host}:{self.rpc_port}"
-
-
-    def call(self, method, params=[]):
-        payload = {
-            "jsonrpc": "1.0",
-            "id": "pythonclient",
-            "method": method,
-            "params": params
-        }
-        try:
-            response = requests.post(
-                self.rpc_url,
-                auth=(self.rpc_user, self.rpc_password),
-                json=payload
-            )
-            response.raise_for_status()
-            return response.json()["result"]
-        except Exception as e:
-            print(f"RPC call error for method {method}: {e}")
-            return None
-
-def update_database():
-    """
-    Fetch the latest block and its transactions from Bitcoin Core,
-    then update the SQLite database (blockchain.db) with the block and transaction data.
-    """
-    # Connect to the SQLite database (it should already have been created using schema.sql)
-    conn = sqlite3.connect("blockchain.db")
-    cursor = conn.cursor()
-
-    rpc = BitcoinRPC()
-
-    # Fetch the best (latest) block hash.
-    best_block_hash = rpc.call("getbestblockhash")
-    if not best_block_hash:
-        print("Failed to retrieve the best block hash.")
-        conn.close()
-        return
-
-    print("Latest block hash:", best_block_hash)
-
-    # Fetch detailed block data with verbosity=2.
-    block_data = rpc.call("getblock", [best_block_hash, 2])
-    if not block_data:
-        print("Failed to retrieve detailed block data.")
-        conn.close()
-        return
-
-    # Insert or update block data into the 'block' table.
-    try:
-        cursor.execute("""
-            INSERT OR IGNORE INTO block (
-                hash, confirmations, height, version, versionhex, merkleroot,
-                time, mediantime, nonce, bits, difficulty, chainwork, ntx,
-                previousblockhash, nextblockhash, strippedsize, size, weight
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            block_data["hash"],
-            block_data["confirmations"],
-            block_data["height"],
-            block_data["version"],
-            block_data["versionHex"],
-            block_data["merkleroot"],
-            block_data["time"],
-            block_data["mediantime"],
-            block_data["nonce"],
-            block_data["bits"],
-            block_data["difficulty"],
-            block_data["chainwork"],
-            block_data["nTx"],
-            block_data.get("previousblockhash"),
-            block_data.get("nextblockhash"),
-            block_data["strippedsize"],
-            block_data["size"],
-            block_data["weight"]
-        ))
-        print("Block inserted/updated:", block_data["hash"])
-    except Exception as e:
-        print("Error inserting block data:", e)
-
-    # Loop through the transactions in the block and update the 'transaction' table.
-    # Assumes the transaction table has columns: txid, block_hash, version, locktime, size, weight
-    transactions = block_data.get("tx", [])
-    for tx in transactions:
-        try:
-            cursor.execute("""
-                INSERT OR IGNORE INTO transaction (
-                    txid, block_hash, version, locktime, size, weight
-                )
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                tx["txid"],
-                block_data["hash"],  # associate this tx with the block's hash
-                tx["version"],
-                tx["locktime"],
-                tx["size"],
-                tx["weight"]
-            ))
-            print("Transaction inserted:", tx["txid"])
-        except Exception as e:
-            print("Error inserting transaction data for txid", tx.get("txid"), ":", e)
-
-    conn.commit()
-    conn.close()
-
-def main():
-    """
-    Periodically update the database every 5 minutes.
-    """
-    while True:
-        print("Starting update cycle...")
-        update_database()
-        print("Cycle complete. Waiting 5 minutes before next update...")
-        sleep(300)  # Sleep for 300 seconds (5 minutes)
-
-if __name__ == "__main__":
-    main()
+import argparse
+import os
+import requests
+import threading
+from decimal import Decimal
+from functools import partial
+from time import perf_counter
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+import metrics
+import profiling
+from async_rpc import fetch_blocks_ordered
+from block_writer import BlockWriter, default_extensions, load_sync_state
+from db_connection import PROFILES, connect
+from indexes import create_indexes
+from json_stream import STREAM_CHUNK_SIZE, StreamedBlock
+from reorg import HeaderWindow, ReorgDetected
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Maximum number of calls sent in one JSON-RPC batch. Keep this at or below the
+# node's rpcworkqueue (32 in our bitcoin.conf).
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", "32"))
+
+class ConnectionStats:
+    """
+    Thread-safe counters describing how often each pooled HTTP connection
+    was opened and how many requests it carried.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._next_id = 0
+
+    def register(self):
+        with self._lock:
+            conn_id = self._next_id
+            self._next_id += 1
+            self._connections[conn_id] = {"connects": 0, "requests": 0}
+        return conn_id
+
+    def record_connect(self, conn_id):
+        with self._lock:
+            self._connections[conn_id]["connects"] += 1
+
+    def record_request(self, conn_id):
+        with self._lock:
+            self._connections[conn_id]["requests"] += 1
+
+    def snapshot(self):
+        """
+        Returns a dict of connection id -> {"connects", "requests", "reused"},
+        where "reused" counts requests that did not need a fresh TCP connect.
+        """
+        with self._lock:
+            return {
+                conn_id: dict(c, reused=max(c["requests"] - c["connects"], 0))
+                for conn_id, c in self._connections.items()
+            }
+
+    def total_reused(self):
+        return sum(c["reused"] for c in self.snapshot().values())
+
+
+class CountingHTTPConnection(HTTPConnection):
+    """
+    urllib3 connection that reports connects and requests to ConnectionStats.
+    """
+
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+        self.conn_id = stats.register() if stats else None
+
+    def connect(self):
+        super().connect()
+        if self.stats:
+            self.stats.record_connect(self.conn_id)
+
+    def request(self, *args, **kwargs):
+        if self.stats:
+            self.stats.record_request(self.conn_id)
+        return super().request(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conn_kw["stats"] = stats
+
+
+class PooledRPCAdapter(HTTPAdapter):
+    """
+    Keep-alive HTTP adapter whose connections are counted in `stats`.
+    pool_block=True makes extra threads wait for a free connection instead of
+    opening throwaway ones, so the node never sees more than pool_size sockets.
+    """
+
+    def __init__(self, pool_size, stats):
+        self.stats = stats
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme,
+            http=partial(CountingHTTPConnectionPool, stats=self.stats)
+        )
+
+
+def observe_call(method, started):
+    """
+    Records one RPC round trip in the latency histogram and, when tracing,
+    as a span.
+    """
+    elapsed = perf_counter() - started
+    metrics.RPC_SECONDS.observe(elapsed, method)
+    profiling.record_span(f"rpc {method}", started, elapsed)
+
+
+class BitcoinRPC:
+    """
+    This class communicates with the Bitcoin Core node via RPC.
+    It sends JSON-RPC requests and returns the results.
+    """
+#    def __init__(self):
+#        self.rpc_user = os.getenv("RPC_USERNAME")
+#        self.rpc_password = os.getenv("RPC_PASSWORD")
+#        self.rpc_host = os.getenv("RPC_HOST", "127.0.0.1")
+#        self.rpc_port = os.getenv("RPC_PORT", "8332")
+#        self.rpc_url = f"http://{self.rpc_host}:{self.rpc_port}"
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.rpc_user = os.getenv("RPC_USERNAME")
+        self.rpc_password = os.getenv("RPC_PASSWORD")
+        self.rpc_host = os.getenv("RPC_HOST", "127.0.0.1")
+        self.rpc_port = os.getenv("RPC_PORT", "8332")
+        print("Loaded RPC credentials:")
+        print("User:", self.rpc_user)
+        print("Password:", self.rpc_password)
+        self.rpc_url = f"http://{self.rpc_host}:{self.rpc_port}"
+
+        # One keep-alive session shared by every thread using this client.
+        # Sending requests through a shared Session is safe as long as nobody
+        # mutates it afterwards; the urllib3 pool underneath is locked.
+        self.pool_size = pool_size or int(os.getenv("RPC_POOL_SIZE", "8"))
+        self.timeout = (
+            connect_timeout or float(os.getenv("RPC_CONNECT_TIMEOUT", "5")),
+            read_timeout or float(os.getenv("RPC_READ_TIMEOUT", "120"))
+        )
+        self.use_rest = os.getenv("RPC_USE_REST", "0") == "1"
+        self.connection_stats = ConnectionStats()
+        self.session = requests.Session()
+        self.session.auth = (self.rpc_user or "", self.rpc_password or "")
+        self.session.mount("http://", PooledRPCAdapter(self.pool_size, self.connection_stats))
+
+    def close(self):
+        self.session.close()
+
+
+    def call(self, method, params=[]):
+        payload = {
+            "jsonrpc": "1.0",
+            "id": "pythonclient",
+            "method": method,
+            "params": params
+        }
+        started = perf_counter()
+        try:
+            response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["result"]
+        except Exception as e:
+            metrics.RPC_ERRORS.inc(1, method)
+            print(f"RPC call error for method {method}: {e}")
+            return None
+        finally:
+            observe_call(method, started)
+
+    def call_raw(self, method, params=[]):
+        """
+        Like call(), but returns the undecoded response body (bytes) so the
+        JSON can be parsed somewhere else, e.g. in a worker process.
+        """
+        payload = {
+            "jsonrpc": "1.0",
+            "id": "pythonclient",
+            "method": method,
+            "params": params
+        }
+        started = perf_counter()
+        try:
+            response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            metrics.RPC_ERRORS.inc(1, method)
+            print(f"RPC call error for method {method}: {e}")
+            return None
+        finally:
+            observe_call(method, started)
+
+    def stream_block(self, block_hash, parse_float=Decimal):
+        """
+        Requests getblock verbosity=2 without reading the reply, and returns
+        a json_stream.StreamedBlock that decodes it transaction by
+        transaction as the body arrives. Returns None if the request fails.
+        """
+        payload = {
+            "jsonrpc": "1.0",
+            "id": "pythonclient",
+            "method": "getblock",
+            "params": [block_hash, 2]
+        }
+        started = perf_counter()
+        try:
+            response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout, stream=True)
+            # bitcoind answers RPC errors with HTTP 500 and a JSON body.
+            if response.status_code != 500:
+                response.raise_for_status()
+        except Exception as e:
+            metrics.RPC_ERRORS.inc(1, "getblock_stream")
+            print(f"RPC call error for method getblock: {e}")
+            return None
+        finally:
+            # Time to the response headers; the body is read while it is decoded.
+            observe_call("getblock_stream", started)
+        return StreamedBlock(response.iter_content(STREAM_CHUNK_SIZE), parse_float, on_close=response.close)
+
+    def get_raw_block(self, block_hash):
+        """
+        Returns the serialized block as bytes, or None on failure.
+        With RPC_USE_REST=1 the binary REST endpoint (rest=1 in bitcoin.conf)
+        is used, which skips hex encoding on the node; otherwise getblock
+        verbosity=0 returns the block as hex.
+        """
+        if self.use_rest:
+            started = perf_counter()
+            try:
+                response = self.session.get(f"{self.rpc_url}/rest/block/{block_hash}.bin", timeout=self.timeout)
+                response.raise_for_status()
+                return response.content
+            except Exception as e:
+                metrics.RPC_ERRORS.inc(1, "rest_block")
+                print(f"REST block fetch error for {block_hash}: {e}")
+                return None
+            finally:
+                observe_call("rest_block", started)
+        block_hex = self.call("getblock", [block_hash, 0])
+        return bytes.fromhex(block_hex) if block_hex else None
+
+    def call_batch(self, calls, batch_size=RPC_BATCH_SIZE):
+        """
+        Sends several RPC calls using JSON-RPC array payloads.
+        `calls` is a list of (method, params) tuples. The calls are split into
+        chunks of at most `batch_size` so a single request never floods the
+        node's rpcworkqueue. Returns a list of (result, error) tuples in the
+        same order as `calls`; error is None when that item succeeded.
+        """
+        results = []
+        for start in range(0, len(calls), batch_size):
+            chunk = calls[start:start + batch_size]
+            payload = [
+                {
+                    "jsonrpc": "1.0",
+                    "id": start + i,
+                    "method": method,
+                    "params": list(params)
+                }
+                for i, (method, params) in enumerate(chunk)
+            ]
+            # Batches are timed per round trip, labelled by their first method.
+            label = f"batch:{chunk[0][0]}"
+            started = perf_counter()
+            try:
+                response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout)
+                # A batch the node rejects as a whole (malformed, too large) is
+                # answered with a single error object, usually with HTTP 500.
+                if response.status_code != 500:
+                    response.raise_for_status()
+                replies = response.json()
+                if not isinstance(replies, list):
+                    error = replies.get("error") if isinstance(replies, dict) else None
+                    raise ValueError(f"batch rejected by the node: {error or replies}")
+            except Exception as e:
+                metrics.RPC_ERRORS.inc(1, label)
+                print(f"RPC batch error for {len(chunk)} calls: {e}")
+                results.extend((None, str(e)) for _ in chunk)
+                continue
+            finally:
+                observe_call(label, started)
+
+            # bitcoind may answer batch items in any order, so match them by id.
+            by_id = {reply.get("id"): reply for reply in replies}
+            for i, (method, _) in enumerate(chunk):
+                reply = by_id.get(start + i)
+                if reply is None:
+                    results.append((None, f"no reply for {method}"))
+                elif reply.get("error"):
+                    results.append((None, reply["error"]))
+                else:
+                    results.append((reply.get("result"), None))
+        return results
+
+    def get_block_hashes(self, start_height, end_height):
+        """
+        Returns the block hashes for every height in [start_height, end_height]
+        using batched getblockhash calls. Heights that failed map to None.
+        """
+        heights = range(start_height, end_height + 1)
+        replies = self.call_batch([("getblockhash", [h]) for h in heights])
+        for height, (_, error) in zip(heights, replies):
+            if error:
+                print(f"getblockhash failed for height {height}: {error}")
+        return [result for result, _ in replies]
+
+    def get_block_headers(self, block_hashes):
+        """
+        Returns the verbose block header for each hash using batched
+        getblockheader calls. Hashes that failed map to None.
+        """
+        replies = self.call_batch([("getblockheader", [h, True]) for h in block_hashes])
+        for block_hash, (_, error) in zip(block_hashes, replies):
+            if error:
+                print(f"getblockheader failed for {block_hash}: {error}")
+        return [result for result, _ in replies]
+
+def handle_reorg(writer, rpc, window):
+    """
+    Finds the fork point between the stored chain and the node's active
+    chain, then removes the orphaned blocks and moves the sync checkpoint
+    back in a single transaction. Returns the fork height.
+    """
+    fork_height = window.find_fork_point(rpc)
+    if fork_height is None:
+        raise RuntimeError(
+            f"Reorg is deeper than the {window.size}-block window; a manual rescan is needed."
+        )
+    removed = writer.rollback_to(fork_height, window.get(fork_height))
+    window.truncate(fork_height)
+    print(f"Reorg detected: rolled back {removed} blocks to height {fork_height}.")
+    return fork_height
+
+def stream_blocks(rpc, writer, window, start_height, end_height):
+    """
+    Streaming counterpart of async_rpc.fetch_blocks_ordered for hosts short
+    on memory: fetches the blocks one at a time and writes each transaction
+    as soon as it is decoded from the reply. Raises ReorgDetected for a block
+    that does not extend the stored chain. Returns the last height written.
+    """
+    last_height = start_height - 1
+    for chunk_start in range(start_height, end_height + 1, RPC_BATCH_SIZE):
+        chunk_end = min(chunk_start + RPC_BATCH_SIZE - 1, end_height)
+        for height, block_hash in zip(range(chunk_start, chunk_end + 1),
+                                      rpc.get_block_hashes(chunk_start, chunk_end)):
+            profiling.block_started(height)
+            streamed = rpc.stream_block(block_hash) if block_hash else None
+
+            def validate(header):
+                if not window.connects(height, header.get("previousblockhash")):
+                    raise ReorgDetected(height)
+
+            if streamed is None or writer.write_streamed(streamed, validate) is None:
+                print(f"Failed to fetch block at height {height}; stopping.")
+                return last_height
+            window.add(height, block_hash)
+            last_height = height
+    return last_height
+
+def record_node_tip(rpc, tip_height):
+    """
+    Passes the node's tip to the lag gauges. Its block time costs two more
+    RPC calls, so it is only looked up while metrics are being exported.
+    """
+    tip_time = None
+    if metrics.exporting:
+        tip_hash = rpc.call("getblockhash", [tip_height])
+        header = rpc.call("getblockheader", [tip_hash, True]) if tip_hash else None
+        tip_time = header["time"] if header else None
+    metrics.record_node_tip(tip_height, tip_time)
+
+def sync_writer(conn, rpc, commit_every=100):
+    """
+    The checkpointing BlockWriter sync_to_tip uses. Callers that sync
+    repeatedly build it once and pass it to every call, so the extensions'
+    caches stay warm between blocks.
+    """
+    return BlockWriter(conn, blocks_per_commit=commit_every, track_sync_state=True,
+                       extensions=default_extensions(conn, rpc))
+
+def sync_to_tip(conn, rpc, start_height=None, commit_every=100, stream=False, writer=None):
+    """
+    Ingests every block after the sync checkpoint up to the node's current
+    tip and returns the number of blocks committed. Blocks are committed
+    together with the checkpoint, at most `commit_every` blocks at a time, so
+    a killed run resumes right after the last committed block. Blocks that
+    do not build on the stored chain trigger a rollback to the fork point,
+    after which the new branch is ingested. With `stream`, blocks are
+    fetched one by one and decoded transaction by transaction (see
+    stream_blocks) instead of being fetched concurrently as whole blocks.
+    `writer` (see sync_writer) replaces a new writer with `commit_every`.
+    """
+    window = HeaderWindow.load(conn)
+    writer = writer or sync_writer(conn, rpc, commit_every)
+    committed = 0
+    while True:
+        state = load_sync_state(conn)
+        tip_height = rpc.call("getblockcount")
+        if tip_height is None:
+            print("Failed to retrieve the block count.")
+            return committed
+        record_node_tip(rpc, tip_height)
+
+        if state is not None:
+            # The checkpoint block itself may have been orphaned while we slept.
+            if rpc.call("getblockhash", [state[0]]) not in (state[1], None):
+                handle_reorg(writer, rpc, window)
+                continue
+            next_height = state[0] + 1
+        elif start_height is not None:
+            next_height = start_height
+        else:
+            # First run: continue after blocks loaded before the checkpoint
+            # existed, or start at the current tip.
+            max_height = conn.execute("SELECT MAX(height) FROM block").fetchone()[0]
+            next_height = max_height + 1 if max_height is not None else tip_height
+
+        if next_height > tip_height:
+            print(f"Already synced to tip at height {tip_height}.")
+            return committed
+
+        print(f"Syncing heights {next_height}..{tip_height}...")
+
+        def handle_block(height, block_data):
+            if not window.connects(height, block_data.get("previousblockhash")):
+                raise ReorgDetected(height)
+            writer.add_block(block_data)
+            window.add(height, block_data["hash"])
+
+        try:
+            if stream:
+                last_height = stream_blocks(rpc, writer, window, next_height, tip_height)
+            else:
+                last_height = fetch_blocks_ordered(next_height, tip_height, handle_block)
+        except ReorgDetected as e:
+            # Everything ingested so far links up, so keep it and unwind from there.
+            writer.flush()
+            committed += e.height - next_height
+            print(f"Block at height {e.height} does not extend the stored chain.")
+            handle_reorg(writer, rpc, window)
+            continue
+        writer.flush()
+        ingested = last_height - next_height + 1
+        committed += ingested
+        print(f"Synced {ingested} blocks; checkpoint at height {last_height}.")
+        for extension in writer.extensions:
+            print(extension.report())
+        return committed
+
+def update_database(db_path="blockchain.db", start_height=None, profile="ingest", stream=False):
+    """
+    Bring the SQLite database (blockchain.db) up to date with Bitcoin Core,
+    ingesting every block between the last sync checkpoint and the tip.
+    """
+    # Connect to the SQLite database (it should already have been created using schema.sql)
+    conn = connect(db_path, profile)
+    # An interrupted bulk load may have left the indexes dropped.
+    create_indexes(conn)
+    rpc = BitcoinRPC()
+    try:
+        return sync_to_tip(conn, rpc, start_height=start_height, stream=stream)
+    finally:
+        rpc.close()
+        conn.close()
+
+def main(argv=None):
+    """
+    Without arguments, follow the chain tip, ingesting new blocks as soon as
+    bitcoind announces them (ZMQ, long-polling or adaptive polling) and
+    resuming from the sync checkpoint. `update_db.py backfill --from H1 --to H2 --workers N`
+    loads a historical height range instead, and `update_db.py import-blocks
+    --datadir /data` loads blocks from the node's files without RPC.
+    """
+    parser = argparse.ArgumentParser(description="Load Bitcoin Core blocks into blockchain.db")
+    parser.add_argument("--db", default="blockchain.db")
+    parser.add_argument("--start-height", type=int,
+                        help="first height to ingest when the database has no sync checkpoint")
+    parser.add_argument("--notify", default="auto", choices=["auto", "zmq", "longpoll", "poll"],
+                        help="how new blocks are detected while following the tip")
+    parser.add_argument("--zmq-endpoint", help="bitcoind zmqpubhashblock endpoint, e.g. tcp://127.0.0.1:28332")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="longest polling interval in seconds when falling back to polling")
+    parser.add_argument("--stream", action="store_true",
+                        help="decode getblock replies one transaction at a time to bound memory use")
+    parser.add_argument("--profile", choices=sorted(PROFILES),
+                        help="SQLite tuning profile (default: ingest, or bulk-ingest for backfill)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", "0")),
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (0 = off)")
+    parser.add_argument("--metrics-json", default=os.getenv("METRICS_JSON"),
+                        help="write a JSON metrics snapshot to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="seconds between JSON metrics snapshots")
+    parser.add_argument("--trace", help="write a Chrome trace of the ingest stages to this file at exit")
+    parser.add_argument("--profile-blocks", metavar="FIRST:LAST",
+                        help="cProfile and stack-sample the ingestion of this block range")
+    parser.add_argument("--profile-output", default="profile",
+                        help="file prefix of the --profile-blocks output (.prof and .collapsed)")
+    subparsers = parser.add_subparsers(dest="command")
+    backfill_parser = subparsers.add_parser("backfill", help="load a historical height range")
+    backfill_parser.add_argument("--from", dest="from_height", type=int, required=True)
+    backfill_parser.add_argument("--to", dest="to_height", type=int, required=True)
+    backfill_parser.add_argument("--workers", type=int, default=8,
+                                 help="concurrent RPC fetches")
+    backfill_parser.add_argument("--decoders", type=int,
+                                 help="decoder processes (default: one per CPU core)")
+    backfill_parser.add_argument("--checkpoint-every", type=int, default=500,
+                                 help="commit after this many blocks")
+    backfill_parser.add_argument("--raw", action="store_true",
+                                 help="fetch serialized blocks and decode them with raw_block.py")
+    backfill_parser.add_argument("--keep-indexes", action="store_true",
+                                 help="keep the indexes during the load (for short ranges on a large database)")
+    import_parser = subparsers.add_parser("import-blocks",
+                                          help="offline import from the node's blk*.dat files")
+    import_parser.add_argument("--datadir", default="/data", help="bitcoind data directory")
+    import_parser.add_argument("--network", default="main", choices=["main", "test", "testnet4", "signet", "regtest"])
+    import_parser.add_argument("--commit-every", type=int, default=1000)
+    import_parser.add_argument("--keep-indexes", action="store_true",
+                               help="keep the indexes during the import instead of rebuilding them at the end")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        profiling.enable_tracing(args.trace)
+    if args.profile_blocks:
+        profiling.profile_blocks(*profiling.parse_block_range(args.profile_blocks), args.profile_output)
+    server = metrics.serve_metrics(args.metrics_port) if args.metrics_port else None
+    snapshots = metrics.SnapshotWriter(args.metrics_json, args.metrics_interval) if args.metrics_json else None
+    try:
+        run_command(args)
+    finally:
+        if snapshots is not None:
+            snapshots.close()
+        if server is not None:
+            server.shutdown()
+
+def run_command(args):
+    if args.command == "backfill":
+        from backfill import backfill
+        backfill(args.db, args.from_height, args.to_height, workers=args.workers,
+                 checkpoint_every=args.checkpoint_every, profile=args.profile or "bulk-ingest",
+                 raw=args.raw, defer_indexes=not args.keep_indexes, decoders=args.decoders)
+        return
+
+    if args.command == "import-blocks":
+        from blk_import import import_blocks
+        import_blocks(args.datadir, args.db, network=args.network, commit_every=args.commit_every,
+                      profile=args.profile or "bulk-ingest", start_height=args.start_height,
+                      defer_indexes=not args.keep_indexes)
+        return
+
+    from block_notify import follow
+    follow(args.db, mode=args.notify, zmq_endpoint=args.zmq_endpoint, profile=args.profile or "ingest",
+           max_interval=args.interval, start_height=args.start_height, stream=args.stream)
+
+if __name__ == "__main__":
+    main()
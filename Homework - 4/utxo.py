@@ -0,0 +1,277 @@
+import os
+from collections import OrderedDict
+
+import metrics
+from db_connection import STORAGE_TABLES, hash_storage
+from reorg import REORG_WINDOW
+
+# Maximum number of committed outputs kept in memory after a commit. Most
+# outputs are spent within a few blocks of being created, so a spend usually
+# finds its output here instead of looking it up in the table.
+UTXO_CACHE_SIZE = int(os.getenv("UTXO_CACHE_SIZE", "1000000"))
+
+# The set of unspent outputs, keyed like tx_output. txid uses the storage
+# format of the database's hash mode (hex text or 32-byte BLOB).
+UTXO_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {utxo} (
+        txid {hash_type} NOT NULL,
+        vout INTEGER NOT NULL,
+        value_sat INTEGER NOT NULL,
+        script_pubkey TEXT,
+        height INTEGER NOT NULL,
+        PRIMARY KEY (txid, vout)
+    ) WITHOUT ROWID
+"""
+
+# With BLOB hashes, utxo presents the hex txid like the other views.
+UTXO_VIEW_SQL = """
+    CREATE VIEW IF NOT EXISTS utxo AS
+    SELECT lower(hex(txid)) AS txid, vout, value_sat, script_pubkey, height
+    FROM utxo_bin
+"""
+
+# The outputs spent by the most recent REORG_WINDOW blocks, so a rollback
+# can put them back. `height` is the spending block.
+UTXO_UNDO_SQL = """
+    CREATE TABLE IF NOT EXISTS utxo_undo (
+        height INTEGER NOT NULL,
+        txid {hash_type} NOT NULL,
+        vout INTEGER NOT NULL,
+        value_sat INTEGER NOT NULL,
+        script_pubkey TEXT,
+        created_height INTEGER NOT NULL
+    )
+"""
+
+UTXO_UNDO_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_utxo_undo_height ON utxo_undo(height)"
+
+# Running totals of the set, so supply queries read one row.
+UTXO_STATS_SQL = """
+    CREATE TABLE IF NOT EXISTS utxo_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        height INTEGER,
+        utxo_count INTEGER NOT NULL,
+        total_sat INTEGER NOT NULL
+    )
+"""
+
+
+def is_unspendable(script_pubkey):
+    """
+    OP_RETURN outputs can never be spent, so (like Bitcoin Core) they are
+    kept out of the set and its totals.
+    """
+    return script_pubkey.startswith("6a")
+
+
+class UtxoSet:
+    """
+    BlockWriter extension that maintains the utxo table in the same
+    transaction as the blocks. Outputs created since the last commit live in
+    a write-back cache and are only inserted at commit time, so outputs
+    spent within the same commit group never touch the table. Spent outputs
+    of recent blocks are saved in utxo_undo for rollback_to.
+    """
+
+    def __init__(self, conn, cache_size=UTXO_CACHE_SIZE):
+        self.conn = conn
+        self.cache_size = cache_size
+        self.blob_hashes = hash_storage(conn) == "blob"
+        self.table = STORAGE_TABLES[hash_storage(conn)]["utxo"]
+        hash_type = "BLOB" if self.blob_hashes else "VARCHAR(255)"
+        conn.execute(UTXO_TABLE_SQL.format(utxo=self.table, hash_type=hash_type))
+        if self.blob_hashes:
+            conn.execute(UTXO_VIEW_SQL)
+        conn.execute(UTXO_UNDO_SQL.format(hash_type=hash_type))
+        conn.execute(UTXO_UNDO_INDEX_SQL)
+        conn.execute(UTXO_STATS_SQL)
+        conn.commit()
+        # (txid, vout) -> [value_sat, script_pubkey, height, dirty]
+        self.cache = OrderedDict()
+        self.hits = self.misses = self.missing = self.evictions = 0
+        # Counts already added to the metrics.
+        self.published = (0, 0, 0)
+        # Called as listener(height, spending txid, value_sat, script_pubkey)
+        # for every spent output, by the time flush() returns.
+        self.spend_listeners = []
+        # Called as listener(height, spending txid, prev_txid, prev_vout) for
+        # every spend of an output the set does not have, during flush().
+        self.missing_listeners = []
+        self.discard()
+
+    def discard(self):
+        """
+        Forgets everything not yet committed, after the writer rolled back.
+        Clean cache entries may describe rows of the aborted transaction, so
+        the whole cache is dropped.
+        """
+        self.cache.clear()
+        self.lookups = []
+        self.deletes = []
+        self.undo = []
+        self.count_delta = 0
+        self.sat_delta = 0
+
+    def add_rows(self, height, input_rows, output_rows):
+        """
+        Applies one block (or one transaction of a streamed block) in the
+        cache: its outputs are added first, then its inputs spend outputs.
+        Rows are the decoded tx_input/tx_output rows with hex txids.
+        """
+        for txid, n, value_sat, script_pubkey in output_rows:
+            if not is_unspendable(script_pubkey):
+                self.cache[(txid, n)] = [value_sat, script_pubkey, height, True]
+                self.count_delta += 1
+                self.sat_delta += value_sat
+        for row in input_rows:
+            txid, prev_txid, prev_vout = row[0], row[2], row[3]
+            if prev_txid is None:
+                continue
+            entry = self.cache.pop((prev_txid, prev_vout), None)
+            if entry is None:
+                self.misses += 1
+                self.lookups.append((height, txid, prev_txid, prev_vout))
+                continue
+            self.hits += 1
+            value_sat, script_pubkey, created_height, dirty = entry
+            self.count_delta -= 1
+            self.sat_delta -= value_sat
+            for listener in self.spend_listeners:
+                listener(height, txid, value_sat, script_pubkey)
+            if not dirty:
+                self.deletes.append((prev_txid, prev_vout))
+            if created_height < height:
+                self.undo.append((height, prev_txid, prev_vout, value_sat, script_pubkey, created_height))
+
+    def key(self, txid):
+        return bytes.fromhex(txid) if self.blob_hashes else txid
+
+    def flush(self, cursor, height):
+        """
+        Writes the pending changes inside the writer's transaction; `height`
+        is the last block of the commit.
+        """
+        for spent_height, spending_txid, txid, vout in self.lookups:
+            row = cursor.execute(
+                f"DELETE FROM {self.table} WHERE txid = ? AND vout = ? "
+                f"RETURNING value_sat, script_pubkey, height",
+                (self.key(txid), vout)
+            ).fetchone()
+            if row is None:
+                # Spends an output from before the first ingested block.
+                self.missing += 1
+                for listener in self.missing_listeners:
+                    listener(spent_height, spending_txid, txid, vout)
+                continue
+            self.count_delta -= 1
+            self.sat_delta -= row[0]
+            self.undo.append((spent_height, txid, vout) + row)
+            for listener in self.spend_listeners:
+                listener(spent_height, spending_txid, row[0], row[1])
+        cursor.executemany(
+            f"DELETE FROM {self.table} WHERE txid = ? AND vout = ?",
+            ((self.key(txid), vout) for txid, vout in self.deletes)
+        )
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (txid, vout, value_sat, script_pubkey, height) "
+            f"VALUES (?, ?, ?, ?, ?)",
+            ((self.key(txid), vout, entry[0], entry[1], entry[2])
+             for (txid, vout), entry in self.cache.items() if entry[3])
+        )
+        oldest_undo = height - REORG_WINDOW
+        cursor.executemany(
+            "INSERT INTO utxo_undo (height, txid, vout, value_sat, script_pubkey, created_height) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((h, self.key(txid), vout, value_sat, script, created)
+             for h, txid, vout, value_sat, script, created in self.undo if h > oldest_undo)
+        )
+        cursor.execute("DELETE FROM utxo_undo WHERE height <= ?", (oldest_undo,))
+        self.save_stats(cursor, height, self.count_delta, self.sat_delta)
+
+        for entry in self.cache.values():
+            entry[3] = False
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+        self.lookups, self.deletes, self.undo = [], [], []
+        self.count_delta = self.sat_delta = 0
+        self.record_metrics()
+
+    def record_metrics(self):
+        """
+        Adds the cache activity since the last flush to the metrics, once
+        per flush rather than once per input.
+        """
+        counts = (self.hits, self.misses, self.evictions)
+        for metric, count, published in zip(
+                (metrics.UTXO_CACHE_HITS, metrics.UTXO_CACHE_MISSES, metrics.UTXO_CACHE_EVICTIONS),
+                counts, self.published):
+            metric.inc(count - published)
+        self.published = counts
+        metrics.UTXO_CACHE_ENTRIES.set(len(self.cache))
+
+    def spill(self, cursor, height):
+        """
+        Writes the changes of a partly received streamed block, leaving only
+        the clean cache (at most cache_size entries) in memory. The writer's
+        transaction still covers the whole block.
+        """
+        self.flush(cursor, height)
+
+    def save_stats(self, cursor, height, count_delta, sat_delta):
+        cursor.execute("""
+            INSERT INTO utxo_stats (id, height, utxo_count, total_sat) VALUES (1, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                height = excluded.height,
+                utxo_count = utxo_count + excluded.utxo_count,
+                total_sat = total_sat + excluded.total_sat
+        """, (height, count_delta, sat_delta))
+
+    def rollback(self, cursor, fork_height):
+        """
+        Undoes every block above `fork_height`: removes the outputs they
+        created and restores the outputs they spent. Runs in the writer's
+        rollback transaction, before the block rows are deleted.
+        """
+        self.discard()
+        created = cursor.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(value_sat), 0) FROM {self.table} WHERE height > ?",
+            (fork_height,)
+        ).fetchone()
+        cursor.execute(f"DELETE FROM {self.table} WHERE height > ?", (fork_height,))
+        restored = cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM(value_sat), 0) FROM utxo_undo WHERE height > ? AND created_height <= ?",
+            (fork_height, fork_height)
+        ).fetchone()
+        cursor.execute(f"""
+            INSERT OR REPLACE INTO {self.table} (txid, vout, value_sat, script_pubkey, height)
+            SELECT txid, vout, value_sat, script_pubkey, created_height FROM utxo_undo
+            WHERE height > ? AND created_height <= ?
+        """, (fork_height, fork_height))
+        cursor.execute("DELETE FROM utxo_undo WHERE height > ?", (fork_height,))
+        self.save_stats(cursor, fork_height, restored[0] - created[0], restored[1] - created[1])
+
+    def report(self):
+        """
+        Cache effectiveness since this set was opened.
+        """
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (f"UTXO cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), "
+                f"{self.evictions} evictions, {len(self.cache)} cached, {self.missing} spends of unknown outputs")
+
+
+def supply(conn):
+    """
+    Returns (height, unspent output count, total satoshis) from the running
+    totals, or None before the first commit.
+    """
+    return conn.execute("SELECT height, utxo_count, total_sat FROM utxo_stats WHERE id = 1").fetchone()
+
+
+def balance(conn, script_pubkey):
+    """
+    Unspent satoshis locked by `script_pubkey` (hex), via idx_utxo_script.
+    """
+    return conn.execute("SELECT COALESCE(SUM(value_sat), 0) FROM utxo WHERE script_pubkey = ?",
+                        (script_pubkey,)).fetchone()[0]